@@ -92,6 +92,28 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Facets and balances per book version, see gemcore.cache.
+    'books': {
+        'BACKEND': os.environ.get(
+            'BOOK_CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('BOOK_CACHE_LOCATION', 'books'),
+        'TIMEOUT': int(os.environ.get('BOOK_CACHE_TIMEOUT', 3600)),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.environ.get('BOOK_CACHE_MAX_ENTRIES', 1000)),
+        },
+    },
+}
+BOOK_CACHE_ALIAS = 'books'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
 _VALIDATORS = (
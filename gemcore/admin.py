@@ -1,7 +1,8 @@
 from django.contrib import admin
 
 from gemcore.models import (
-    Account, Book, Entry, EntryHistory, ParserConfig, TagRegex)
+    Account, Book, Entry, EntryHistory, ImportJob, MonthTotal, ParserConfig,
+    TagRegex)
 
 
 class TagRegexInline(admin.StackedInline):
@@ -55,11 +56,26 @@ class EntryHistoryAdmin(admin.ModelAdmin):
     pass
 
 
+class ImportJobAdmin(admin.ModelAdmin):
+
+    list_display = (
+        'name', 'book', 'account', 'who', 'status', 'created', 'rows',
+        'entries', 'duplicates')
+    list_filter = ('status', 'book', 'account')
+
+
+class MonthTotalAdmin(admin.ModelAdmin):
+
+    list_display = (
+        'book', 'account', 'month', 'is_income', 'entry_count', 'amount')
+    list_filter = ('book', 'account', 'is_income')
+
+
 class ParserConfigAdmin(admin.ModelAdmin):
 
     list_display = (
-        'name', 'date_format', 'separators', 'when', 'what', 'amount', 'notes',
-        'ignore_rows', 'country')
+        'name', 'file_format', 'date_format', 'separators', 'when', 'what',
+        'amount', 'notes', 'ignore_rows', 'country')
 
     def separators(self, instance):
         return '100%s000%s00' % (
@@ -75,5 +91,7 @@ admin.site.register(Account, AccountAdmin)
 admin.site.register(Book, BookAdmin)
 admin.site.register(Entry, EntryAdmin)
 admin.site.register(EntryHistory, EntryHistoryAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
+admin.site.register(MonthTotal, MonthTotalAdmin)
 admin.site.register(ParserConfig, ParserConfigAdmin)
 admin.site.register(TagRegex, TagRegexAdmin)
@@ -0,0 +1,138 @@
+import json
+
+from django.contrib.auth.decorators import login_required
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_GET
+
+from gemcore.cache import book_cache
+from gemcore.export import CURSOR_CHUNK_SIZE, ENTRY_COLUMNS
+from gemcore.models import Book
+from gemcore.pagination import (
+    InvalidCursor,
+    KeysetPage,
+    make_cursor,
+    seek_after,
+)
+from gemcore.views import filter_entries
+
+
+# (key, lookup) of the entry values returned, the id is needed for cursors.
+API_COLUMNS = (('id', 'id'),) + ENTRY_COLUMNS
+
+
+def dumps(value):
+    return json.dumps(value, cls=DjangoJSONEncoder)
+
+
+def bad_request(message):
+    return JsonResponse({'error': message}, status=400)
+
+
+def stream_entries(entries, limit=None):
+    """Yield the JSON document of the entries, a row at a time.
+
+    At most limit entries are included, and if there are more the cursor
+    to continue from is given as "next".
+
+    """
+    keys = [k for k, lookup in API_COLUMNS]
+    rows = entries.order_by(*KeysetPage.ordering).values_list(
+        *(lookup for k, lookup in API_COLUMNS))
+    if limit is not None:
+        rows = rows[:limit + 1]
+
+    yield '{"entries": ['
+    last = next_cursor = None
+    for i, row in enumerate(rows.iterator(chunk_size=CURSOR_CHUNK_SIZE)):
+        if i == limit:
+            next_cursor = make_cursor(last['when'], last['what'], last['id'])
+            break
+        last = dict(zip(keys, row))
+        yield (', ' if i else '') + dumps(last)
+    yield '], "next": %s}' % dumps(next_cursor)
+
+
+@require_GET
+@login_required
+def entries(request, book_slug):
+    book = get_object_or_404(Book, slug=book_slug, users=request.user)
+    entries, filters = filter_entries(request.GET, book)
+
+    limit = request.GET.get('limit')
+    if limit:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = -1
+        if limit < 1:
+            return bad_request('Invalid limit, a positive integer expected.')
+    else:
+        limit = None
+
+    after = request.GET.get('after')
+    if after:
+        try:
+            entries = seek_after(entries, after)
+        except InvalidCursor:
+            return bad_request('Invalid cursor %r.' % after)
+
+    return StreamingHttpResponse(
+        stream_entries(entries, limit), content_type='application/json')
+
+
+def stream_balance(balance):
+    """Yield the JSON document of the balance, a month at a time."""
+    if balance is None:
+        balance = {'complete': None, 'months': []}
+    yield '{"complete": %s, "months": [' % dumps(balance['complete'])
+    for i, month in enumerate(balance['months']):
+        yield (', ' if i else '') + dumps(month)
+    yield ']}'
+
+
+@require_GET
+@login_required
+def balance(request, book_slug):
+    book = get_object_or_404(Book, slug=book_slug, users=request.user)
+    entries, filters = filter_entries(request.GET, book)
+    params = dict(filters)
+    del params['qs']
+    balance = book_cache.get_or_set(
+        book, 'balance', params, lambda: book.balance(entries))
+    return StreamingHttpResponse(
+        stream_balance(balance), content_type='application/json')
+
+
+def stream_breakdown(breakdown, key):
+    """Yield the JSON document of the breakdown, a row at a time.
+
+    The rows are read from a server side cursor, ordered by key.
+
+    """
+    rows = breakdown.order_by(key)
+    yield '{"%s": [' % key
+    for i, row in enumerate(rows.iterator(chunk_size=CURSOR_CHUNK_SIZE)):
+        yield (', ' if i else '') + dumps(row)
+    yield ']}'
+
+
+@require_GET
+@login_required
+def month_breakdown(request, book_slug):
+    book = get_object_or_404(Book, slug=book_slug, users=request.user)
+    entries, filters = filter_entries(request.GET, book)
+    return StreamingHttpResponse(
+        stream_breakdown(book.month_breakdown(entries), 'month'),
+        content_type='application/json')
+
+
+@require_GET
+@login_required
+def year_breakdown(request, book_slug):
+    book = get_object_or_404(Book, slug=book_slug, users=request.user)
+    entries, filters = filter_entries(request.GET, book)
+    return StreamingHttpResponse(
+        stream_breakdown(book.year_breakdown(entries), 'year'),
+        content_type='application/json')
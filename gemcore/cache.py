@@ -0,0 +1,110 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import models
+
+
+# Stored in place of None, so a cached None is told apart from a miss.
+NONE = '__none__'
+# What the hit and miss counters count.
+OUTCOMES = ('hits', 'misses')
+
+
+def normalize(value):
+    """Return a JSON serializable version of the filtering value.
+
+    Empty values are dropped and sequences sorted, so equivalent filters
+    (say, the same tags in a different order) share their cache key.
+
+    """
+    if isinstance(value, dict):
+        return {
+            str(k): normalize(v) for k, v in value.items()
+            if v not in (None, '', [], ())}
+    if isinstance(value, models.QuerySet):
+        value = value.values_list('pk', flat=True)
+    if isinstance(value, models.Model):
+        return value.pk
+    if isinstance(value, (list, tuple, set, frozenset, models.QuerySet)):
+        return sorted((normalize(v) for v in value), key=str)
+    return value
+
+
+class BookCache(object):
+    """Cache results computed from the entries of a book.
+
+    Keys include the book version, which is bumped on every write touching
+    the book entries, so stale results are never read and just expire (or
+    get evicted) from the configured cache backend.
+
+    Hits and misses are counted per kind of result in the cache itself, so
+    all the processes sharing the backend add to the same counters.
+
+    """
+
+    def __init__(self, alias=None):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias or settings.BOOK_CACHE_ALIAS]
+
+    def make_key(self, book, kind, params=None):
+        params = json.dumps(
+            normalize(params or {}), sort_keys=True, default=str)
+        digest = hashlib.md5(params.encode('utf-8')).hexdigest()
+        return 'book:%s:v%s:%s:%s' % (book.id, book.version, kind, digest)
+
+    def get_or_set(self, book, kind, params, compute):
+        """Return the cached result for the book, calling compute if missing.
+
+        The book version is the one of the given instance, so it should have
+        been just read from the DB.
+
+        """
+        key = self.make_key(book, kind, params)
+        result = self.cache.get(key)
+        if result is not None:
+            self.count(kind, 'hits')
+            return None if result == NONE else result
+
+        self.count(kind, 'misses')
+        result = compute()
+        self.cache.set(key, NONE if result is None else result)
+        return result
+
+    def stats_key(self, outcome, kind=None):
+        return 'stats:%s:%s' % (outcome, kind or '')
+
+    def count(self, kind, outcome):
+        key = self.stats_key(outcome, kind)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # First count, kinds are listed for stats to find them.
+            self.cache.add(key, 0, None)
+            self.cache.incr(key)
+            kinds = self.cache.get(self.stats_key('kinds'), [])
+            if kind not in kinds:
+                self.cache.set(
+                    self.stats_key('kinds'), sorted(kinds + [kind]), None)
+
+    def stats(self):
+        """Return the hits and misses per kind of result so far."""
+        kinds = self.cache.get(self.stats_key('kinds'), [])
+        keys = [self.stats_key(o, k) for k in kinds for o in OUTCOMES]
+        counts = self.cache.get_many(keys)
+        return {
+            kind: {o: counts.get(self.stats_key(o, kind), 0) for o in OUTCOMES}
+            for kind in kinds}
+
+    def reset_stats(self):
+        kinds = self.cache.get(self.stats_key('kinds'), [])
+        self.cache.delete_many(
+            [self.stats_key('kinds')] +
+            [self.stats_key(o, k) for k in kinds for o in OUTCOMES])
+
+
+book_cache = BookCache()
@@ -0,0 +1,46 @@
+import csv
+
+from gemcore.pagination import KeysetPage
+
+
+# Rows fetched per round trip from the server side cursor, when exporting
+# here or streaming from gemcore.api.
+CURSOR_CHUNK_SIZE = 2000
+# (name, lookup) of the entry values exported, as CSV headers or JSON keys.
+ENTRY_COLUMNS = (
+    ('when', 'when'),
+    ('what', 'what'),
+    ('amount', 'amount'),
+    ('is_income', 'is_income'),
+    ('account', 'account__slug'),
+    ('currency', 'account__currency'),
+    ('who', 'who__username'),
+    ('country', 'country'),
+    ('tags', 'tags'),
+    ('notes', 'notes'),
+)
+TAGS_COLUMN = [h for h, lookup in ENTRY_COLUMNS].index('tags')
+
+
+class Echo(object):
+    """A file-like object returning what is written, for csv.writer."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(entries, chunk_size=CURSOR_CHUNK_SIZE):
+    """Yield the entries as CSV lines, header first.
+
+    Only the exported columns are selected, and they are read from a server
+    side cursor, so no more than chunk_size rows are in memory at once.
+
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow([h for h, lookup in ENTRY_COLUMNS])
+    rows = entries.order_by(*KeysetPage.ordering).values_list(
+        *(lookup for h, lookup in ENTRY_COLUMNS))
+    for row in rows.iterator(chunk_size=chunk_size):
+        row = list(row)
+        row[TAGS_COLUMN] = ','.join(row[TAGS_COLUMN])
+        yield writer.writerow(row)
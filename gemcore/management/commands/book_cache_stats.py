@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from gemcore.cache import book_cache
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Show the hits and misses of the book cache per kind of result, as '
+        'counted by every process sharing the cache backend.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset', action='store_true', default=False,
+            help='Start counting again from zero after showing them.')
+
+    def handle(self, *args, **options):
+        stats = book_cache.stats()
+        for kind, counts in stats.items():
+            total = counts['hits'] + counts['misses']
+            self.stdout.write(
+                '%s: %s hits, %s misses (%.1f%% hit rate)' % (
+                    kind, counts['hits'], counts['misses'],
+                    100 * counts['hits'] / total if total else 0))
+        if not stats:
+            self.stdout.write('No lookups counted.')
+        if options['reset']:
+            book_cache.reset_stats()
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.http import QueryDict
+
+from gemcore.export import CURSOR_CHUNK_SIZE, iter_csv
+from gemcore.models import Book
+from gemcore.views import filter_entries
+
+
+class Command(BaseCommand):
+
+    help = 'Export the (filtered) entries of a book as CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--book', required=True,
+            choices=Book.objects.all().values_list('slug', flat=True))
+        parser.add_argument(
+            '--filter', default='',
+            help='Filters as in the entries page query string, for instance '
+                 '"year=2020&tag=food".')
+        parser.add_argument(
+            '--output',
+            help='File to write the CSV to, instead of the standard output.')
+        parser.add_argument(
+            '--chunk-size', type=int, default=CURSOR_CHUNK_SIZE,
+            help='Rows fetched from the DB at once.')
+
+    def handle(self, *args, **options):
+        book = Book.objects.get(slug=options['book'])
+        entries, filters = filter_entries(QueryDict(options['filter']), book)
+        lines = iter_csv(entries, chunk_size=options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', newline='') as output:
+                output.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
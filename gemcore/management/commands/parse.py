@@ -1,23 +1,97 @@
-import argparse
+import glob
+import time
+
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from django.contrib.auth import get_user_model
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 
-from gemcore.models import Account, Book
-from gemcore.parser import CSVParser
+from gemcore.models import Account, Book, TagRegex
+from gemcore.parser import BULK_BATCH_SIZE, DuplicateEntryError, get_parser
 
 
 User = get_user_model()
 
 
+def group_imports(imports):
+    """Split the (account, path) imports in groups that can run at once.
+
+    Entries can only clash on their unique constraint when they share the
+    account, and importing into an account may also create entries in the
+    accounts it transfers to. Accounts linked that way end up in the same
+    group, so a group imported in order has deterministic conflicts.
+
+    """
+    parent = {}
+
+    def find(i):
+        while parent.setdefault(i, i) != i:
+            i = parent[i]
+        return i
+
+    transfers = TagRegex.objects.filter(
+        transfer__isnull=False).values_list('account', 'transfer')
+    for account, transfer in transfers:
+        parent[find(account)] = find(transfer)
+
+    groups = {}
+    for account, path in imports:
+        groups.setdefault(find(account.id), []).append((account, path))
+    return list(groups.values())
+
+
+def parse_files(imports, book_id, user_id, **kwargs):
+    """Parse the (account, path) imports, in order, counting the results.
+
+    This runs in the worker processes of the pool.
+
+    """
+    book = Book.objects.get(id=book_id)
+    user = User.objects.get(id=user_id)
+    result = []
+    for account, path in imports:
+        start = time.monotonic()
+        with open(path) as csv_file:
+            parsed = get_parser(account).parse(
+                csv_file, book=book, user=user, summary=True, **kwargs)
+        result.append((
+            account, path, parsed['entries'], parsed['duplicates'],
+            parsed['errors'], time.monotonic() - start))
+    return result
+
+
 class Command(BaseCommand):
 
-    help = 'Parse a csv files of expense/income entries.'
+    help = (
+        'Parse files of expense/income entries, in the format of the '
+        'account parser config.')
 
     def add_arguments(self, parser):
         parser.add_argument(
             '--dry-run', action='store_true', dest='dry-run', default=False)
-        parser.add_argument('--file', type=argparse.FileType('r'))
+        parser.add_argument(
+            '--bulk', action='store_true', default=False,
+            help='Validate rows in memory and insert them in batches.')
+        parser.add_argument(
+            '--batch-size', type=int, default=BULK_BATCH_SIZE,
+            help='Entries inserted per query when using --bulk.')
+        parser.add_argument(
+            '--progress-every', type=float, default=1,
+            help='Seconds between progress reports.')
+        parser.add_argument(
+            '--jobs', type=int, default=1,
+            help='Amount of processes importing files at once.')
+        parser.add_argument(
+            '--file', action='append', dest='files', default=[],
+            help='File or glob pattern to parse for --account '
+                 '(can be repeated).')
+        parser.add_argument(
+            '--import', action='append', dest='imports', default=[],
+            nargs=2, metavar=('ACCOUNT', 'FILE'),
+            help='File or glob pattern to parse for the given account '
+                 '(can be repeated).')
         accounts = Account.objects.filter(active=True).values_list(
             'slug', flat=True)
         parser.add_argument('--account', choices=accounts)
@@ -28,20 +102,114 @@ class Command(BaseCommand):
             '--user',
             choices=User.objects.all().values_list('username', flat=True))
 
+    def find_imports(self, options):
+        patterns = [(options['account'], f) for f in options['files']]
+        patterns.extend(options['imports'])
+        if not patterns:
+            raise CommandError('No files given, use --file or --import.')
+
+        imports = []
+        for slug, pattern in patterns:
+            if slug is None:
+                raise CommandError('Missing --account for %r.' % pattern)
+            try:
+                account = Account.objects.get(slug=slug, active=True)
+            except Account.DoesNotExist:
+                raise CommandError('Invalid account %r.' % slug)
+            paths = sorted(glob.glob(pattern))
+            if not paths:
+                raise CommandError('No file matches %r.' % pattern)
+            imports.extend((account, path) for path in paths)
+        return imports
+
+    def progress(self, rows, entries, duplicates, errors, elapsed):
+        msg = (
+            '%s rows in %.1fs (%.0f rows/s): %s entries, %s duplicates, '
+            '%s errors' % (
+                rows, elapsed, rows / elapsed if elapsed else 0, entries,
+                duplicates, sum(errors.values())))
+        if errors:
+            msg += ' (%s)' % ', '.join(
+                '%s %s' % (v, k) for k, v in sorted(errors.items()))
+        self.stdout.write(msg)
+
+    def parse_file(self, account, path, book, user, options):
+        dry_run = options['dry-run']
+        self.stdout.write(
+            'Parsing (dry run %s) %s for %s' % (dry_run, path, account))
+
+        rows = entries = duplicates = 0
+        errors = Counter()
+        start = reported = time.monotonic()
+        with open(path) as csv_file:
+            for parsed in get_parser(account).iter_parse(
+                    csv_file, book=book, user=user, dry_run=dry_run,
+                    bulk=options['bulk'], batch_size=options['batch_size']):
+                rows += 1
+                if isinstance(parsed.error, DuplicateEntryError):
+                    duplicates += 1
+                    if dry_run:
+                        self.stdout.write(
+                            '=== DUPLICATE: %s (line %s) ===' % (
+                                parsed.error, parsed.line))
+                elif parsed.error is not None:
+                    error = parsed.error.__class__.__name__
+                    errors[error] += 1
+                    self.stdout.write('=== ERROR: %s (line %s) ===\n%s' % (
+                        error, parsed.line, parsed.error))
+                else:
+                    entries += 1
+                    if dry_run:
+                        self.stdout.write('=== ENTRY: %s ===' % parsed.entry)
+
+                now = time.monotonic()
+                if now - reported >= options['progress_every']:
+                    self.progress(
+                        rows, entries, duplicates, errors, now - start)
+                    reported = now
+
+        elapsed = time.monotonic() - start
+        self.progress(rows, entries, duplicates, errors, elapsed)
+        return account, path, entries, duplicates, errors, elapsed
+
+    def parse_in_pool(self, imports, book, user, options):
+        groups = group_imports(imports)
+        kwargs = dict(
+            dry_run=options['dry-run'], bulk=options['bulk'],
+            batch_size=options['batch_size'])
+        # Workers are forked, and must not share the parent connections.
+        connections.close_all()
+        with ProcessPoolExecutor(
+                max_workers=min(options['jobs'], len(groups))) as pool:
+            futures = [
+                pool.submit(parse_files, group, book.id, user.id, **kwargs)
+                for group in groups]
+            for future in as_completed(futures):
+                for account, path, entries, duplicates, errors, elapsed in (
+                        future.result()):
+                    self.stdout.write('Parsed %s for %s' % (path, account))
+                    rows = entries + duplicates + sum(errors.values())
+                    self.progress(rows, entries, duplicates, errors, elapsed)
+                    yield account, path, entries, duplicates, errors, elapsed
+
     def handle(self, *args, **options):
-        account = Account.objects.get(slug=options['account'])
+        imports = self.find_imports(options)
         book = Book.objects.get(slug=options['book'])
         user = User.objects.get(username=options['user'])
-        csv_file = options['file']
-        dry_run = options['dry-run']
-        self.stdout.write('Parsing (dry run %s) %s for %s' %
-                          (dry_run, csv_file.name, account))
-        result = CSVParser(account=account).parse(
-            csv_file, book=book, user=user, dry_run=dry_run)
-        for error, traceback in result['errors'].items():
-            self.stdout.write('=== ERROR: %s ===' % error)
-            self.stdout.write('\n'.join(str(i[0]) for i in traceback))
-            self.stdout.write('\n\n')
-        if dry_run:
-            for entry in result['entries']:
-                self.stdout.write('=== ENTRY: %s ===' % entry)
+
+        start = time.monotonic()
+        if options['jobs'] > 1 and len(imports) > 1:
+            parsed = list(self.parse_in_pool(imports, book, user, options))
+        else:
+            parsed = [
+                self.parse_file(account, path, book, user, options)
+                for account, path in imports]
+
+        if len(parsed) > 1:
+            entries = sum(p[2] for p in parsed)
+            duplicates = sum(p[3] for p in parsed)
+            errors = sum((p[4] for p in parsed), Counter())
+            self.stdout.write('Total for %s files:' % len(parsed))
+            self.progress(
+                entries + duplicates + sum(errors.values()), entries,
+                duplicates, errors, time.monotonic() - start)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from gemcore.models import Book, MonthTotal
+
+
+class Command(BaseCommand):
+
+    help = 'Rebuild the month totals of entries from scratch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--book', action='append', dest='books',
+            choices=Book.objects.all().values_list('slug', flat=True),
+            help='Only rebuild the totals for this book (can be repeated).')
+
+    def handle(self, *args, **options):
+        books = None
+        if options['books']:
+            books = Book.objects.filter(slug__in=options['books'])
+        MonthTotal.objects.rebuild(books=books)
+        totals = MonthTotal.objects.all()
+        if books is not None:
+            totals = totals.filter(book__in=books)
+        self.stdout.write('Rebuilt %s month totals.' % totals.count())
@@ -0,0 +1,97 @@
+import time
+import traceback
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from gemcore.models import ImportJob
+from gemcore.parser import ChunkedTextFile, DuplicateEntryError, get_parser
+
+
+# ImportJob fields updated while the job runs.
+PROGRESS_FIELDS = [
+    'rows', 'entries', 'duplicates', 'errors', 'messages', 'updated']
+
+
+def run_job(job, progress_every=1):
+    """Import the content of the (already claimed) job, saving progress."""
+    csv_file = ChunkedTextFile(job.iter_content(), name=job.name)
+    reported = time.monotonic()
+    try:
+        for parsed in get_parser(job.account).iter_parse(
+                csv_file, book=job.book, user=job.who, bulk=True):
+            job.rows += 1
+            if isinstance(parsed.error, DuplicateEntryError):
+                job.duplicates += 1
+            elif parsed.error is not None:
+                error = parsed.error.__class__.__name__
+                job.errors[error] = job.errors.get(error, 0) + 1
+                if len(job.messages) < job.MAX_MESSAGES:
+                    job.messages.append('Line %s: %s: %s' % (
+                        parsed.line, error, parsed.error))
+            else:
+                job.entries += 1
+
+            if time.monotonic() - reported >= progress_every:
+                job.updated = now()
+                job.save(update_fields=PROGRESS_FIELDS)
+                reported = time.monotonic()
+    except Exception:
+        job.status = ImportJob.FAILED
+        job.failure = traceback.format_exc()
+    else:
+        job.status = ImportJob.DONE
+
+    job.finished = job.updated = now()
+    job.save(
+        update_fields=PROGRESS_FIELDS + ['status', 'failure', 'finished'])
+    job.importchunk_set.all().delete()
+    return job
+
+
+class Command(BaseCommand):
+
+    help = 'Import the files queued from the web, as they are uploaded.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true', default=False,
+            help='Exit once there are no queued imports.')
+        parser.add_argument(
+            '--sleep', type=float, default=2,
+            help='Seconds to wait for new imports when there are none.')
+        parser.add_argument(
+            '--progress-every', type=float, default=1,
+            help='Seconds between saving the progress of an import.')
+        parser.add_argument(
+            '--stale-after', type=float, default=3600,
+            help='Seconds without progress after which a running import is '
+                 'considered abandoned (its worker died) and marked as '
+                 'failed.')
+
+    def handle(self, *args, **options):
+        while True:
+            # checked between imports, so any worker left running notices
+            stale = ImportJob.objects.fail_stale(
+                timedelta(seconds=options['stale_after']))
+            if stale:
+                self.stdout.write(
+                    'Marked %s stale imports as failed.' % stale)
+
+            job = ImportJob.objects.claim()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+
+            self.stdout.write('Importing %s' % job)
+            start = time.monotonic()
+            run_job(job, progress_every=options['progress_every'])
+            self.stdout.write(
+                '%s in %.1fs: %s rows, %s entries, %s duplicates, '
+                '%s errors' % (
+                    job, time.monotonic() - start, job.rows, job.entries,
+                    job.duplicates, sum(job.errors.values())))
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.13 on 2026-10-16 19:52
+
+from decimal import Decimal
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gemcore', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthTotal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('is_income', models.BooleanField()),
+                ('entry_count', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=14)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='gemcore.Account')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='gemcore.Book')),
+            ],
+            options={
+                'unique_together': {('book', 'account', 'month', 'is_income')},
+            },
+        ),
+        migrations.RunSQL(
+            "INSERT INTO gemcore_monthtotal "
+            "(book_id, account_id, month, is_income, entry_count, amount) "
+            "SELECT book_id, account_id, date_trunc('month', \"when\")::date, "
+            "is_income, COUNT(*), SUM(amount) FROM gemcore_entry "
+            "GROUP BY 1, 2, 3, 4;",
+            migrations.RunSQL.noop),
+    ]
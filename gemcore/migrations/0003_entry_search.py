@@ -0,0 +1,39 @@
+# Generated by Django 2.2.13 on 2026-10-16 20:00
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gemcore', '0002_monthtotal'),
+    ]
+
+    # Keep the search vector current on every write, including bulk ones.
+    trigger = (
+        "CREATE TRIGGER gemcore_entry_search_update "
+        "BEFORE INSERT OR UPDATE OF what, notes, search ON gemcore_entry "
+        "FOR EACH ROW EXECUTE PROCEDURE "
+        "tsvector_update_trigger(search, 'pg_catalog.simple', what, notes);")
+    drop_trigger = (
+        "DROP TRIGGER IF EXISTS gemcore_entry_search_update ON gemcore_entry;")
+    populate = (
+        "UPDATE gemcore_entry SET search = to_tsvector("
+        "'pg_catalog.simple', coalesce(what, '') || ' ' || "
+        "coalesce(notes, ''));")
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='search',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search'], name='gemcore_ent_search_7089b0_gin'),
+        ),
+        migrations.RunSQL(trigger, drop_trigger),
+        migrations.RunSQL(populate, migrations.RunSQL.noop),
+    ]
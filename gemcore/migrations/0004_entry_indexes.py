@@ -0,0 +1,26 @@
+# Generated by Django 2.2.13 on 2026-10-16 20:02
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gemcore', '0003_entry_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['book', 'when'], name='gemcore_ent_book_id_e53c2b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=models.Index(fields=['book', 'account', 'when'], name='gemcore_ent_book_id_77d761_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='entry',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['tags'], name='gemcore_ent_tags_7dc769_gin'),
+        ),
+    ]
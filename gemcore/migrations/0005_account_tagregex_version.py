@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-16 20:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gemcore', '0004_entry_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='account',
+            name='tagregex_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
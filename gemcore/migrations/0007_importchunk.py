@@ -0,0 +1,30 @@
+# Generated by Django 2.2.13 on 2026-10-16 23:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gemcore', '0006_importjob'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='importjob',
+            name='content',
+        ),
+        migrations.CreateModel(
+            name='ImportChunk',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('content', models.TextField()),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='gemcore.ImportJob')),
+            ],
+            options={
+                'unique_together': {('job', 'index')},
+            },
+        ),
+    ]
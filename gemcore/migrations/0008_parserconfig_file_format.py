@@ -0,0 +1,34 @@
+# Generated by Django 2.2.13 on 2026-10-17 00:12
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gemcore', '0007_importchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parserconfig',
+            name='file_format',
+            field=models.CharField(choices=[('csv', 'csv'), ('ofx', 'ofx'), ('qif', 'qif'), ('camt.053', 'camt.053')], default='csv', max_length=16),
+        ),
+        migrations.AlterField(
+            model_name='parserconfig',
+            name='amount',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.PositiveSmallIntegerField(), blank=True, default=list, size=2),
+        ),
+        migrations.AlterField(
+            model_name='parserconfig',
+            name='what',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.PositiveSmallIntegerField(), blank=True, default=list, size=None),
+        ),
+        migrations.AlterField(
+            model_name='parserconfig',
+            name='when',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.PositiveSmallIntegerField(), blank=True, default=list, size=None),
+        ),
+    ]
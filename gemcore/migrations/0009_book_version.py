@@ -0,0 +1,18 @@
+# Generated by Django 2.2.13 on 2026-10-17 01:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gemcore', '0008_parserconfig_file_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
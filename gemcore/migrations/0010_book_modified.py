@@ -0,0 +1,19 @@
+# Generated by Django 2.2.13 on 2026-10-17 01:40
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gemcore', '0009_book_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='modified',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
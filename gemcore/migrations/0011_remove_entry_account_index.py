@@ -0,0 +1,17 @@
+# Generated by Django 2.2.13 on 2026-10-16 23:09
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gemcore', '0010_book_modified'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='entry',
+            name='gemcore_ent_book_id_77d761_idx',
+        ),
+    ]
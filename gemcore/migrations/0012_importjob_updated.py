@@ -0,0 +1,19 @@
+# Generated by Django 2.2.13 on 2026-10-16 23:11
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gemcore', '0011_remove_entry_account_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='updated',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
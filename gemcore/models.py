@@ -2,6 +2,7 @@
 
 import operator
 import re
+import threading
 
 from collections import defaultdict, OrderedDict
 from datetime import date, datetime, timedelta
@@ -9,11 +10,23 @@ from decimal import Decimal
 from functools import reduce
 
 from django.contrib.auth.models import User
-from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVectorField,
+)
+from django.core.exceptions import EmptyResultSet, ValidationError
 from django.core.validators import MinValueValidator
 from django.db import connection, models, transaction
 from django.db.models.functions import TruncMonth, TruncYear
-from django.db.models.signals import pre_delete
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+)
 from django.dispatch import receiver
 from django.utils.text import slugify
 from django.utils.timezone import now
@@ -42,6 +55,35 @@ TAGS = [
 ]
 
 
+# Count the entries of a "filtered" CTE (with "id" and "tags" columns) per tag,
+# using DISTINCT since merged entries may repeat tags.
+TAG_COUNTS_SQL = (
+    'SELECT tag, COUNT(DISTINCT id) FROM filtered, unnest(tags) AS tag '
+    'GROUP BY tag')
+
+
+# Group the entries of a "filtered" CTE (with "book_id", "account_id", "day",
+# "is_income" and "amount" columns) into the MonthTotal columns.
+MONTH_TOTALS_SQL = (
+    "SELECT book_id, account_id, date_trunc('month', day)::date AS month, "
+    'is_income, COUNT(*) AS entry_count, SUM(amount) AS amount '
+    'FROM filtered GROUP BY 1, 2, 3, 4')
+
+
+RUNNING_BALANCE_PERIODS = ('day', 'month')
+
+# Formats of the files imported with a ParserConfig.
+CSV = 'csv'
+FILE_FORMATS = (CSV, 'ofx', 'qif', 'camt.053')
+
+# Pieces of an ImportJob text written or read per query.
+IMPORT_CHUNKS_BATCH_SIZE = 16
+
+# Text search configuration for Entry.search, no stemming since entries mix
+# languages (and are mostly names of shops and services).
+SEARCH_CONFIG = 'simple'
+
+
 class DryRunError(Exception):
     """Dry run requested."""
 
@@ -56,18 +98,53 @@ def month_year_iter(start, end):
         yield date(y, m + 1, 1)
 
 
+def sort_tags(counts):
+    """Sort (tag, count) pairs as in TAGS, leaving unknown tags last."""
+    order = {t: i for i, t in enumerate(TAGS)}
+    return OrderedDict(
+        sorted(counts, key=lambda i: (order.get(i[0], len(TAGS)), i[0])))
+
+
+class CounterFieldsMixin(object):
+    """Keep save() from writing back fields only changed with F() updates.
+
+    The counter_fields of an instance read before a concurrent bump are
+    stale, so they are left out when saving updates an existing row. Rows
+    not there yet (or anymore) are inserted with them as usual.
+
+    """
+
+    counter_fields = ()
+
+    def _do_update(self, base_qs, using, pk_val, values, *args, **kwargs):
+        # values are (field, model, value) triples
+        values = [v for v in values if v[0].name not in self.counter_fields]
+        return super(CounterFieldsMixin, self)._do_update(
+            base_qs, using, pk_val, values, *args, **kwargs)
+
+
 class ParserConfig(models.Model):
 
     name = models.TextField(unique=True)
+    file_format = models.CharField(
+        max_length=16, default=CSV, choices=((i, i) for i in FILE_FORMATS))
     country = models.CharField(max_length=2, choices=countries)
+    # Only used by CSV and QIF files, the others use fixed formats.
     date_format = models.CharField(max_length=128, default='%Y-%m-%d')
     decimal_point = models.CharField(max_length=1, default='.')
     thousands_sep = models.CharField(max_length=1, default=',')
     ignore_rows = models.PositiveSmallIntegerField()
 
-    when = ArrayField(base_field=models.PositiveSmallIntegerField())
-    what = ArrayField(base_field=models.PositiveSmallIntegerField())
-    amount = ArrayField(base_field=models.PositiveSmallIntegerField(), size=2)
+    # Indexes of the CSV columns, only used by CSV files.
+    when = ArrayField(
+        base_field=models.PositiveSmallIntegerField(), default=list,
+        blank=True)
+    what = ArrayField(
+        base_field=models.PositiveSmallIntegerField(), default=list,
+        blank=True)
+    amount = ArrayField(
+        base_field=models.PositiveSmallIntegerField(), size=2, default=list,
+        blank=True)
     notes = ArrayField(
         base_field=models.PositiveSmallIntegerField(), default=list,
         blank=True)
@@ -77,27 +154,59 @@ class ParserConfig(models.Model):
     def __str__(self):
         return self.name
 
+    def clean(self):
+        if self.file_format == CSV:
+            errors = {
+                k: 'This field is required for CSV files.'
+                for k in ('when', 'what', 'amount') if not getattr(self, k)}
+            if errors:
+                raise ValidationError(errors)
+
 
-class Book(models.Model):
+class Book(CounterFieldsMixin, models.Model):
 
     name = models.CharField(max_length=256)
     slug = models.SlugField(unique=True)
     users = models.ManyToManyField(User)
+    # Bumped whenever the book's entries change, see gemcore.cache.
+    version = models.PositiveIntegerField(default=0, editable=False)
+    # When the book or its entries last changed, for conditional requests.
+    modified = models.DateTimeField(default=now, editable=False)
 
     def __str__(self):
         return self.name
 
+    counter_fields = ('version',)
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
+        self.modified = now()
         return super(Book, self).save(*args, **kwargs)
 
+    @classmethod
+    def bump_versions(cls, ids):
+        """Invalidate the cached results of the books with the given ids."""
+        cls.objects.filter(id__in=ids).update(
+            version=models.F('version') + 1, modified=now())
+
     def latest_entries(self):
-        return self.entry_set.all().order_by('-when')[:5]
+        return self.entry_set.for_display().order_by('-when')[:5]
 
     def by_text(self, text):
-        return self.entry_set.filter(
-            models.Q(what__icontains=text) | models.Q(notes__icontains=text))
+        words = re.findall(r'\w+', text)
+        if not words:
+            return self.entry_set.filter(
+                models.Q(what__icontains=text) |
+                models.Q(notes__icontains=text))
+
+        # match every word as a prefix, using the indexed search vector
+        query = SearchQuery(
+            ' & '.join("'%s':*" % w for w in words),
+            config=SEARCH_CONFIG, search_type='raw')
+        return self.entry_set.filter(search=query).annotate(
+            rank=SearchRank(models.F('search'), query)).order_by(
+            '-rank', '-when')
 
     def accounts(self, entries=None):
         if entries is None:
@@ -110,32 +219,23 @@ class Book(models.Model):
         if entries is None:
             entries = self.entry_set.all()
 
-        if not entries:
-            return {}
-
-        entries = ', '.join(str(e.id) for e in entries)
-        cursor = connection.cursor()
-        cursor.execute(
-            "SELECT gemcore_entry.country, COUNT(*) FROM gemcore_entry "
-            "WHERE gemcore_entry.book_id = %s "
-            "AND gemcore_entry.id IN (%s) "
-            "GROUP BY gemcore_entry.country "
-            "ORDER BY gemcore_entry.country ASC;" % (self.id, entries))
-        result = OrderedDict(cursor.fetchall())
-        return result
+        result = entries.filter(book=self).order_by('country').values_list(
+            'country').annotate(models.Count('id'))
+        return OrderedDict(result)
 
     def currencies(self, entries=None):
         if entries is None:
             entries = self.entry_set.all()
 
-        result = defaultdict(int)
-        for d in entries.values_list('account__currency', flat=True):
-            result[d] += 1
+        result = entries.order_by().values_list(
+            'account__currency').annotate(models.Count('id'))
         return dict(result)
 
     def month_breakdown(self, entries=None):
         if entries is None:
-            entries = self.entry_set.all()
+            return self.monthtotal_set.values('month').annotate(
+                count=models.Sum('entry_count'),
+                total=models.Sum('amount')).filter(count__gt=0)
         # Truncate to month and add to select list
         entries = entries.annotate(month=TruncMonth('when')).values('month')
         # Group By month and select the count of the grouping
@@ -154,7 +254,10 @@ class Book(models.Model):
 
     def year_breakdown(self, entries=None):
         if entries is None:
-            entries = self.entry_set.all()
+            totals = self.monthtotal_set.annotate(year=TruncYear('month'))
+            return totals.values('year').annotate(
+                count=models.Sum('entry_count'),
+                total=models.Sum('amount')).filter(count__gt=0)
         # Truncate to year and add to select list
         entries = entries.annotate(year=TruncYear('when')).values('year')
         # Group By year and select the count of the grouping
@@ -175,25 +278,71 @@ class Book(models.Model):
         if entries is None:
             entries = self.entry_set.all()
 
-        if not entries:
-            return {}
-
-        result = OrderedDict()
-        for tag in TAGS:
-            tag_count = entries.filter(tags__contains=[tag]).count()
-            if tag_count:
-                result[tag] = tag_count
+        try:
+            sql, params = entries.order_by().values_list(
+                'id', 'tags').query.sql_with_params()
+        except EmptyResultSet:
+            return OrderedDict()
 
-        return result
+        cursor = connection.cursor()
+        cursor.execute(
+            'WITH filtered (id, tags) AS (%s) %s;' % (sql, TAG_COUNTS_SQL),
+            params)
+        return sort_tags(cursor.fetchall())
 
     def who(self, entries=None):
         if entries is None:
             entries = self.entry_set.all()
-        result = defaultdict(int)
-        for d in entries.values_list('who__username', flat=True):
-            result[d] += 1
+        result = entries.order_by().values_list(
+            'who__username').annotate(models.Count('id'))
         return dict(result)
 
+    def facets(self, entries=None):
+        """Return the countries, currencies, months, tags, who and years
+        counts for the given entries, all computed in a single query."""
+        if entries is None:
+            entries = self.entry_set.all()
+
+        result = {
+            'countries': OrderedDict(), 'currencies': {}, 'months': {},
+            'tags': OrderedDict(), 'who': {}, 'years': {}}
+        columns = entries.order_by().values_list(
+            'id', 'country', 'when', 'tags', 'account__currency',
+            'who__username')
+        try:
+            sql, params = columns.query.sql_with_params()
+        except EmptyResultSet:
+            return result
+
+        cursor = connection.cursor()
+        cursor.execute(
+            'WITH filtered (id, country, day, tags, currency, who) AS (%s) '
+            "SELECT 'countries', country, COUNT(*) FROM filtered "
+            'GROUP BY 2 '
+            "UNION ALL SELECT 'currencies', currency, COUNT(*) FROM filtered "
+            'GROUP BY 2 '
+            "UNION ALL SELECT 'months', EXTRACT(MONTH FROM day)::text, "
+            'COUNT(*) FROM filtered GROUP BY 2 '
+            "UNION ALL SELECT 'tags', * FROM (%s) AS tags "
+            "UNION ALL SELECT 'who', who, COUNT(*) FROM filtered GROUP BY 2 "
+            "UNION ALL SELECT 'years', EXTRACT(YEAR FROM day)::text, "
+            'COUNT(*) FROM filtered GROUP BY 2 '
+            'ORDER BY 1, 2;' % (sql, TAG_COUNTS_SQL), params)
+
+        tags = []
+        for facet, key, count in cursor.fetchall():
+            if facet == 'months':
+                key = date(1900, int(key), 1)
+            elif facet == 'years':
+                key = int(key)
+            elif facet == 'tags':
+                tags.append((key, count))
+                continue
+            result[facet][key] = count
+        result['tags'] = sort_tags(tags)
+
+        return result
+
     def calculate_balance(self, entries=None, start=None, end=None):
         if entries is None:
             entries = self.entry_set.all()
@@ -227,29 +376,118 @@ class Book(models.Model):
         return result
 
     def balance(self, entries=None, start=None, end=None):
-        result = self.calculate_balance(entries, start, end)
-        if not result:
+        if entries is None:
+            if start is None and end is None:
+                return self.totals_balance()
+            entries = self.entry_set.all()
+        if start:
+            entries = entries.filter(when__gte=start)
+        if end:
+            entries = entries.filter(when__lte=end)
+
+        try:
+            sql, params = entries.order_by().values_list(
+                'when', 'amount', 'is_income').query.sql_with_params()
+        except EmptyResultSet:
+            return
+
+        # Totals per month plus the grand total (the row with a NULL month).
+        cursor = connection.cursor()
+        cursor.execute(
+            'WITH filtered (day, amount, is_income) AS (%s) '
+            "SELECT date_trunc('month', day)::date, MIN(day), MAX(day), "
+            'COALESCE(SUM(amount) FILTER (WHERE is_income), 0), '
+            'COALESCE(SUM(amount) FILTER (WHERE NOT is_income), 0) '
+            "FROM filtered GROUP BY ROLLUP (date_trunc('month', day));" % sql,
+            params)
+        totals = {row[0]: row[1:] for row in cursor.fetchall()}
+
+        first, last, income, expense = totals.pop(None)
+        if first is None:
             return
 
-        months = []
-        last_month = None
+        months = {k: v[2:] for k, v in totals.items()}
+        return self._balance(
+            start or first, end or last, income, expense, months)
+
+    def running_balance(self, entries=None, period='month'):
+        """Return the income, expense, result and cumulative balance of the
+        entries per day or month, oldest first."""
+        if period not in RUNNING_BALANCE_PERIODS:
+            raise ValueError(
+                'Period should be one of %s (got %r).' %
+                (', '.join(RUNNING_BALANCE_PERIODS), period))
+        if entries is None:
+            entries = self.entry_set.all()
+
+        try:
+            sql, params = entries.order_by().values_list(
+                'when', 'amount', 'is_income').query.sql_with_params()
+        except EmptyResultSet:
+            return []
+
+        cursor = connection.cursor()
+        cursor.execute(
+            'WITH filtered (day, amount, is_income) AS (%s) '
+            'SELECT start, income, expense, income - expense, '
+            'SUM(income - expense) OVER (ORDER BY start) FROM ('
+            "SELECT date_trunc('%s', day)::date AS start, "
+            'COALESCE(SUM(amount) FILTER (WHERE is_income), 0) AS income, '
+            'COALESCE(SUM(amount) FILTER (WHERE NOT is_income), 0) AS expense '
+            'FROM filtered GROUP BY 1) AS totals ORDER BY start;' %
+            (sql, period), params)
+        keys = ('start', 'income', 'expense', 'result', 'balance')
+        return [dict(zip(keys, row)) for row in cursor.fetchall()]
+
+    def totals_balance(self, accounts=None):
+        """Like balance, but reading the month totals instead of entries."""
+        entries = self.entry_set.all()
+        totals = self.monthtotal_set.all()
+        if accounts is not None:
+            entries = entries.filter(account__in=accounts)
+            totals = totals.filter(account__in=accounts)
+
+        bounds = entries.aggregate(
+            first=models.Min('when'), last=models.Max('when'))
+        if bounds['first'] is None:
+            return
+
+        totals = totals.order_by().values('month').annotate(
+            income=models.Sum('amount', filter=models.Q(is_income=True)),
+            expense=models.Sum('amount', filter=models.Q(is_income=False)))
+        months = {
+            t['month']: (t['income'] or Decimal(0), t['expense'] or Decimal(0))
+            for t in totals}
+        income = sum((i for i, e in months.values()), Decimal(0))
+        expense = sum((e for i, e in months.values()), Decimal(0))
+        return self._balance(
+            bounds['first'], bounds['last'], income, expense, months)
+
+    def _balance(self, start, end, income, expense, months):
+        result = {
+            'start': start, 'end': end,
+            'income': income, 'expense': expense, 'result': income - expense,
+        }
+        # Range test (inclusive).
+        assert start <= end
+
+        balances = []
         sanity_check = Decimal(0)
-        for next_month in month_year_iter(result['start'], result['end']):
-            if last_month is not None:
-                end_of_month = next_month - timedelta(days=1)
-                month_balance = self.calculate_balance(
-                    entries, start=last_month, end=end_of_month)
-                sanity_check += month_balance['result']
-                months.append(month_balance)
-            last_month = next_month
-
-        month_balance = self.calculate_balance(entries, last_month, end)
-        sanity_check += month_balance['result']
-        months.append(month_balance)
+        for month in month_year_iter(start, end):
+            end_of_month = (month + timedelta(days=31)).replace(day=1)
+            end_of_month = min(end_of_month - timedelta(days=1), end)
+            income, expense = months.get(month, (Decimal(0), Decimal(0)))
+            month_balance = {
+                'start': month, 'end': end_of_month,
+                'income': income, 'expense': expense,
+                'result': income - expense,
+            }
+            sanity_check += month_balance['result']
+            balances.append(month_balance)
 
         assert sanity_check == result['result']
 
-        return {'complete': result, 'months': months}
+        return {'complete': result, 'months': balances}
 
     def breakdown(self, entries=None, start=None, end=None):
         result = self.calculate_balance(entries, start, end)
@@ -311,10 +549,12 @@ class Book(models.Model):
 class AccountManager(models.Manager):
 
     def by_book(self, book, **kwargs):
-        return self.filter(users__book=book, active=True, **kwargs).distinct()
+        accounts = self.filter(users__book=book, active=True, **kwargs)
+        # str() of an account lists its users
+        return accounts.distinct().prefetch_related('users')
 
 
-class Account(models.Model):
+class Account(CounterFieldsMixin, models.Model):
 
     name = models.CharField(max_length=256)
     slug = models.SlugField(unique=True)
@@ -324,6 +564,8 @@ class Account(models.Model):
     parser_config = models.ForeignKey(
         ParserConfig, null=True, blank=True, on_delete=models.CASCADE)
     active = models.BooleanField(default=True)
+    # Bumped whenever the account's TagRegex change, see tag_matcher.
+    tagregex_version = models.PositiveIntegerField(default=0, editable=False)
 
     objects = AccountManager()
 
@@ -332,24 +574,82 @@ class Account(models.Model):
 
     def __str__(self):
         result = '%s %s' % (self.currency, self.name)
-        if self.users.count() == 1:
-            result += ' %s' % self.users.get().username
+        # all() so a prefetch of the users saves the query
+        users = self.users.all()
+        if len(users) == 1:
+            result += ' %s' % users[0].username
         return result
 
+    counter_fields = ('tagregex_version',)
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
         return super(Account, self).save(*args, **kwargs)
 
+    def tag_matcher(self):
+        """The TagMatcher for this account, compiled once per process."""
+        cached = _tag_matchers.get(self.id)
+        if cached is None or cached[0] != self.tagregex_version:
+            regexes = self.tagregex_set.select_related(
+                'transfer').order_by('id')
+            cached = (self.tagregex_version, TagMatcher(regexes))
+            _tag_matchers[self.id] = cached
+        return cached[1]
+
     def tags_for(self, value):
+        return self.tag_matcher().match(value)
+
+
+class TagMatcher(object):
+    """Match a value against a set of TagRegex, all compiled up front.
+
+    When it is safe to do so (no groups nor flags that could change the
+    meaning of the other patterns), the patterns are also joined in a
+    single alternation so values matching none are rejected at once.
+
+    """
+
+    def __init__(self, regexes):
+        super(TagMatcher, self).__init__()
+        self.patterns = [
+            (re.compile(i.regex), i.tag, i.transfer) for i in regexes]
+        self.prefilter = None
+        default_flags = re.compile('').flags
+        if self.patterns and all(
+                p.groups == 0 and p.flags == default_flags
+                for p, tag, transfer in self.patterns):
+            self.prefilter = re.compile('|'.join(
+                '(?:%s)' % p.pattern for p, tag, transfer in self.patterns))
+
+    def match(self, value):
         tags = {}
-        for i in self.tagregex_set.all():
-            pattern = re.compile(i.regex)
+        if self.prefilter is not None and not self.prefilter.match(value):
+            return tags
+        for pattern, tag, transfer in self.patterns:
             if pattern.match(value):
-                tags[i.tag] = i.transfer
+                tags[tag] = transfer
         return tags
 
 
+# Compiled TagMatcher per account id, as (tagregex_version, matcher).
+_tag_matchers = {}
+
+
+class TagRegexQuerySet(models.QuerySet):
+
+    def update(self, **kwargs):
+        # The account may change too, invalidate the old and new ones.
+        with transaction.atomic():
+            ids = list(self.values_list('id', flat=True))
+            regexes = TagRegex.objects.filter(id__in=ids)
+            accounts = set(regexes.values_list('account', flat=True))
+            result = super(TagRegexQuerySet, self).update(**kwargs)
+            accounts.update(regexes.values_list('account', flat=True))
+            bump_tag_matchers(accounts)
+        return result
+
+
 class TagRegex(models.Model):
 
     account = models.ForeignKey(Account, on_delete=models.CASCADE)
@@ -359,10 +659,60 @@ class TagRegex(models.Model):
         Account, related_name='transfers', null=True, blank=True,
         on_delete=models.CASCADE)
 
+    objects = TagRegexQuerySet.as_manager()
+
     class Meta:
         unique_together = ('account', 'regex', 'tag')
 
 
+# Set while EntryQuerySet.delete runs, which does in bulk what the pre and
+# post delete signals would do per entry.
+_bulk_delete = threading.local()
+
+
+class EntryQuerySet(models.QuerySet):
+
+    def for_display(self):
+        """Fetch what str() and the entries list use, in a fixed amount of
+        queries no matter how many entries there are."""
+        return self.select_related('account', 'book', 'who').prefetch_related(
+            'account__users')
+
+    def delete(self):
+        with transaction.atomic():
+            ids = list(self.values_list('id', flat=True))
+            entries = Entry._base_manager.filter(id__in=ids)
+            MonthTotal.objects.remove_entries(entries)
+            Book.bump_versions(entries.values('book'))
+            # Deleting ignores select_related, but the entry history
+            # (recorded on pre_delete) needs these for every entry.
+            entries = Entry.objects.filter(id__in=ids).prefetch_related(
+                'account', 'book', 'who')
+            _bulk_delete.active = True
+            try:
+                return super(EntryQuerySet, entries).delete()
+            finally:
+                _bulk_delete.active = False
+
+    def update(self, **kwargs):
+        if not MonthTotal.ENTRY_FIELDS.intersection(kwargs):
+            # No need for a transaction, a spare version bump is harmless.
+            Book.bump_versions(self.values('book'))
+            return super(EntryQuerySet, self).update(**kwargs)
+
+        # The filtering may not match the entries once updated, keep the ids.
+        with transaction.atomic():
+            ids = list(self.values_list('id', flat=True))
+            entries = Entry._base_manager.filter(id__in=ids)
+            Book.bump_versions(entries.values('book'))
+            MonthTotal.objects.remove_entries(entries)
+            result = super(EntryQuerySet, self).update(**kwargs)
+            MonthTotal.objects.add_entries(entries)
+            if 'book' in kwargs or 'book_id' in kwargs:
+                Book.bump_versions(entries.values('book'))
+        return result
+
+
 class Entry(models.Model):
 
     book = models.ForeignKey(Book, on_delete=models.CASCADE)
@@ -379,8 +729,20 @@ class Entry(models.Model):
             choices=((i, i) for i in TAGS), max_length=256))
     country = models.CharField(max_length=2, choices=countries)
     notes = models.TextField(blank=True)
+    # Kept current by a database trigger from what and notes.
+    search = SearchVectorField(null=True, editable=False)
+
+    objects = EntryQuerySet.as_manager()
+
+    # Attributes of the MonthTotal.ENTRY_FIELDS, compared on save.
+    TOTALS_ATTRS = ('book_id', 'account_id', 'when', 'is_income', 'amount')
 
     class Meta:
+        indexes = [
+            models.Index(fields=['book', 'when']),
+            GinIndex(fields=['search']),
+            GinIndex(fields=['tags']),
+        ]
         unique_together = (
             'book', 'account', 'when', 'what', 'amount', 'is_income')
         verbose_name_plural = 'Entries'
@@ -391,11 +753,115 @@ class Entry(models.Model):
             '+' if self.is_income else '-', self.amount, self.account,
             ' | ' + self.notes if self.notes else '')
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if (update_fields is not None and
+                not MonthTotal.ENTRY_FIELDS.intersection(update_fields)):
+            # No need for a transaction, a spare version bump is harmless.
+            super(Entry, self).save(*args, **kwargs)
+            Book.bump_versions([self.book_id])
+            return
+
+        with transaction.atomic():
+            previous = None
+            if self.pk is not None:
+                previous = Entry._base_manager.filter(
+                    pk=self.pk).select_for_update().values_list(
+                    *self.TOTALS_ATTRS).first()
+            current = tuple(getattr(self, a) for a in self.TOTALS_ATTRS)
+            if previous is not None and previous != current:
+                # the book may be changing too
+                Book.bump_versions([previous[0]])
+                MonthTotal.objects.remove_entries(
+                    Entry._base_manager.filter(pk=self.pk))
+            super(Entry, self).save(*args, **kwargs)
+            if previous != current:
+                MonthTotal.objects.add_entries(
+                    Entry._base_manager.filter(pk=self.pk))
+            Book.bump_versions([self.book_id])
+
     @property
     def money(self):
         return self.amount if self.is_income else -self.amount
 
 
+class MonthTotalManager(models.Manager):
+
+    def _execute(self, template, entries):
+        try:
+            sql, params = entries.order_by().values_list(
+                'book', 'account', 'when', 'is_income',
+                'amount').query.sql_with_params()
+        except EmptyResultSet:
+            return
+
+        cursor = connection.cursor()
+        cursor.execute(
+            'WITH filtered (book_id, account_id, day, is_income, amount) '
+            'AS (%s) %s;' % (sql, template), params)
+
+    def add_entries(self, entries):
+        self._execute(
+            'INSERT INTO gemcore_monthtotal '
+            '(book_id, account_id, month, is_income, entry_count, amount) '
+            'SELECT * FROM (%s) AS added '
+            'ON CONFLICT (book_id, account_id, month, is_income) DO UPDATE '
+            'SET entry_count = '
+            'gemcore_monthtotal.entry_count + EXCLUDED.entry_count, '
+            'amount = gemcore_monthtotal.amount + EXCLUDED.amount'
+            % MONTH_TOTALS_SQL, entries)
+
+    def remove_entries(self, entries):
+        self._execute(
+            'UPDATE gemcore_monthtotal AS total '
+            'SET entry_count = total.entry_count - removed.entry_count, '
+            'amount = total.amount - removed.amount '
+            'FROM (%s) AS removed '
+            'WHERE total.book_id = removed.book_id '
+            'AND total.account_id = removed.account_id '
+            'AND total.month = removed.month '
+            'AND total.is_income = removed.is_income' % MONTH_TOTALS_SQL,
+            entries)
+
+    @transaction.atomic
+    def rebuild(self, books=None):
+        totals = self.all()
+        entries = Entry.objects.all()
+        if books is not None:
+            totals = totals.filter(book__in=books)
+            entries = entries.filter(book__in=books)
+        totals.delete()
+        self.add_entries(entries)
+        Book.bump_versions(entries.values('book'))
+
+
+class MonthTotal(models.Model):
+    """Amount and number of entries per book, account, month and type."""
+
+    # Entry fields that change the totals an entry is accounted in.
+    ENTRY_FIELDS = frozenset(
+        ('book', 'book_id', 'account', 'account_id', 'when', 'is_income',
+         'amount'))
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    month = models.DateField()
+    is_income = models.BooleanField()
+    entry_count = models.IntegerField(default=0)
+    amount = models.DecimalField(
+        decimal_places=2, max_digits=14, default=Decimal(0))
+
+    objects = MonthTotalManager()
+
+    class Meta:
+        unique_together = ('book', 'account', 'month', 'is_income')
+
+    def __str__(self):
+        return '%s %s %s: %s%s (%s entries)' % (
+            self.book, self.account, self.month.strftime('%Y-%m'),
+            '+' if self.is_income else '-', self.amount, self.entry_count)
+
+
 class EntryHistory(models.Model):
 
     DELETE = 'delete'
@@ -423,6 +889,186 @@ class EntryHistory(models.Model):
             self.account_slug, self.who_username, self.when, self.tags)
 
 
+class ImportJobManager(models.Manager):
+
+    def claim(self):
+        """Mark the oldest queued job as running and return it, if any.
+
+        Jobs locked by other workers are skipped, so many can run at once.
+
+        """
+        with transaction.atomic():
+            job = self.filter(status=ImportJob.QUEUED).order_by(
+                'created').select_for_update(skip_locked=True).first()
+            if job is not None:
+                job.status = ImportJob.RUNNING
+                job.started = job.updated = now()
+                job.save(update_fields=['status', 'started', 'updated'])
+        return job
+
+    def fail_stale(self, timeout):
+        """Mark as failed the running jobs with no progress within timeout.
+
+        Their worker is assumed to have died mid-import, and nothing else
+        would ever finish them. Return the amount of jobs failed.
+
+        """
+        with transaction.atomic():
+            stale = list(self.filter(
+                status=ImportJob.RUNNING,
+                updated__lt=now() - timeout).select_for_update(
+                skip_locked=True).values_list('id', flat=True))
+            ImportChunk.objects.filter(job__in=stale).delete()
+            return self.filter(id__in=stale).update(
+                status=ImportJob.FAILED, finished=now(),
+                failure='The import made no progress in %s.' % timeout)
+
+
+class ImportJob(models.Model):
+    """A file of entries for an account, imported by run_imports."""
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    # Amount of error messages kept, the errors are counted regardless.
+    MAX_MESSAGES = 100
+
+    book = models.ForeignKey(Book, on_delete=models.CASCADE)
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    who = models.ForeignKey(User, on_delete=models.CASCADE)
+    name = models.TextField(blank=True)
+    status = models.CharField(
+        max_length=16, default=QUEUED,
+        choices=((i, i) for i in (QUEUED, RUNNING, DONE, FAILED)))
+    created = models.DateTimeField(default=now)
+    started = models.DateTimeField(null=True, blank=True)
+    # Last time the worker saved progress, jobs not updated in a while are
+    # failed by ImportJob.objects.fail_stale.
+    updated = models.DateTimeField(default=now)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    rows = models.PositiveIntegerField(default=0)
+    entries = models.PositiveIntegerField(default=0)
+    duplicates = models.PositiveIntegerField(default=0)
+    # Amount of errors per exception name.
+    errors = JSONField(default=dict, blank=True)
+    messages = ArrayField(
+        base_field=models.TextField(), default=list, blank=True)
+    failure = models.TextField(blank=True)
+
+    objects = ImportJobManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created']),
+        ]
+
+    def __str__(self):
+        return '%s for %s in %s (%s)' % (
+            self.name or 'CSV content', self.account.name, self.book,
+            self.status)
+
+    @property
+    def is_finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    def add_content(self, chunks, batch_size=IMPORT_CHUNKS_BATCH_SIZE):
+        """Store the pieces of text to import, batch_size at a time."""
+        batch = []
+        for index, content in enumerate(chunks):
+            batch.append(ImportChunk(job=self, index=index, content=content))
+            if len(batch) >= batch_size:
+                ImportChunk.objects.bulk_create(batch)
+                batch = []
+        ImportChunk.objects.bulk_create(batch)
+
+    def iter_content(self, chunk_size=IMPORT_CHUNKS_BATCH_SIZE):
+        """Yield the pieces of text to import, in order, from a cursor."""
+        return self.importchunk_set.order_by('index').values_list(
+            'content', flat=True).iterator(chunk_size=chunk_size)
+
+
+class ImportChunk(models.Model):
+    """A piece of the text of an ImportJob, removed once imported."""
+
+    job = models.ForeignKey(ImportJob, on_delete=models.CASCADE)
+    index = models.PositiveIntegerField()
+    content = models.TextField()
+
+    class Meta:
+        unique_together = ('job', 'index')
+
+
+def bump_account_books(account_id):
+    # Results show the account currency of entries, and pages list the
+    # accounts of the book users.
+    Book.bump_versions(
+        Entry.objects.filter(account=account_id).values('book'))
+    Book.bump_versions(
+        Book.objects.filter(users__account=account_id).values('id'))
+
+
+def bump_tag_matchers(account_ids):
+    # Other processes notice the version change on their next lookup.
+    Account.objects.filter(id__in=account_ids).update(
+        tagregex_version=models.F('tagregex_version') + 1)
+    for account_id in account_ids:
+        _tag_matchers.pop(account_id, None)
+        bump_account_books(account_id)
+
+
+@receiver(post_save, sender=TagRegex)
+@receiver(post_delete, sender=TagRegex)
+def invalidate_tag_matcher(sender, instance, **kwargs):
+    bump_tag_matchers([instance.account_id])
+
+
+@receiver(post_save, sender=Account)
+@receiver(pre_delete, sender=Account)
+def invalidate_account_books(sender, instance, **kwargs):
+    # Before deleting, the account entries and users are gone afterwards.
+    bump_account_books(instance.id)
+
+
+@receiver(post_delete, sender=Entry)
+def invalidate_entry_book(sender, instance, **kwargs):
+    if not getattr(_bulk_delete, 'active', False):
+        Book.bump_versions([instance.book_id])
+
+
+@receiver(m2m_changed, sender=Book.users.through)
+def invalidate_book_users(sender, instance, action, pk_set, **kwargs):
+    if isinstance(instance, Book):
+        if action.startswith('post_'):
+            Book.bump_versions([instance.id])
+    elif action == 'pre_clear':
+        # the books of the user are unknown once cleared
+        Book.bump_versions(instance.book_set.values('id'))
+    elif action in ('post_add', 'post_remove'):
+        Book.bump_versions(pk_set)
+
+
+@receiver(m2m_changed, sender=Account.users.through)
+def invalidate_account_users(sender, instance, action, pk_set, **kwargs):
+    # Pages list the accounts of the book users.
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if isinstance(instance, Account):
+        users = instance.users.all() if action == 'pre_clear' else pk_set
+        Book.bump_versions(Book.objects.filter(users__in=users).values('id'))
+    else:
+        Book.bump_versions(instance.book_set.values('id'))
+
+
+@receiver(pre_delete, sender=Entry)
+def remove_entry_from_totals(sender, instance, **kwargs):
+    if not getattr(_bulk_delete, 'active', False):
+        MonthTotal.objects.remove_entries(
+            Entry._base_manager.filter(pk=instance.pk))
+
+
 @receiver(pre_delete, sender=Entry)
 def record_entry_history(sender, instance, **kwargs):
     EntryHistory.objects.create(
@@ -0,0 +1,97 @@
+import base64
+import json
+from datetime import datetime
+
+from django.db.models import Q
+
+
+class InvalidCursor(ValueError):
+    """The given cursor can not be decoded."""
+
+
+def encode_cursor(entry):
+    return make_cursor(entry.when, entry.what, entry.id)
+
+
+def make_cursor(when, what, pk):
+    value = json.dumps([when.isoformat(), what, pk], separators=(',', ':'))
+    cursor = base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+    # padding is dropped to keep the query string readable
+    return cursor.rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        cursor += '=' * (-len(cursor) % 4)
+        value = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        when, what, pk = json.loads(value.decode('utf-8'))
+        when = datetime.strptime(when, '%Y-%m-%d').date()
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(what, str) or not isinstance(pk, int):
+        raise InvalidCursor(cursor)
+    return when, what, pk
+
+
+def seek_after(entries, cursor):
+    """Filter the entries following the cursor, in KeysetPage.ordering."""
+    when, what, pk = decode_cursor(cursor)
+    # the redundant bound on when lets the (book, when) index seek
+    return entries.filter(when__lte=when).filter(
+        Q(when__lt=when) |
+        Q(when=when, what__gt=what) |
+        Q(when=when, what=what, id__gt=pk))
+
+
+class KeysetPage(object):
+    """A page of entries sorted by (-when, what, id), found by seeking.
+
+    Unlike Django's Paginator, no COUNT nor OFFSET is used: the next page
+    starts right after the last entry of the current one, so every page
+    costs the same no matter how deep it is.
+
+    """
+
+    ordering = ('-when', 'what', 'id')
+    reverse_ordering = ('when', '-what', '-id')
+
+    def __init__(self, entries, per_page, after=None, before=None):
+        self.per_page = per_page
+        if before is not None:
+            when, what, pk = decode_cursor(before)
+            # the redundant bound on when lets the (book, when) index seek
+            entries = entries.filter(when__gte=when).filter(
+                Q(when__gt=when) |
+                Q(when=when, what__lt=what) |
+                Q(when=when, what=what, id__lt=pk))
+            rows = list(
+                entries.order_by(*self.reverse_ordering)[:per_page + 1])
+            self.has_previous = len(rows) > per_page
+            self.has_next = True
+            self.object_list = rows[:per_page][::-1]
+        else:
+            if after is not None:
+                entries = seek_after(entries, after)
+            rows = list(entries.order_by(*self.ordering)[:per_page + 1])
+            self.has_previous = after is not None
+            self.has_next = len(rows) > per_page
+            self.object_list = rows[:per_page]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.object_list:
+            return encode_cursor(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if self.has_previous and self.object_list:
+            return encode_cursor(self.object_list[0])
@@ -1,16 +1,146 @@
 # /usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import codecs
 import csv
+import html
+import io
+import itertools
 import re
 
-from collections import defaultdict
-from datetime import datetime
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime, timedelta
 from decimal import Decimal
+from functools import lru_cache
+from xml.etree import ElementTree
 
-from django.db import transaction
+from django import forms
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.utils.functional import cached_property
+from django_countries import countries
 
 from gemcore.forms import EntryForm
+from gemcore.models import TAGS, Account, Book, Entry, MonthTotal
+
+
+# Amount of entries inserted per query when parsing in bulk.
+BULK_BATCH_SIZE = 1000
+
+# Kinds of the QIF !Type: sections with bank transactions.
+QIF_TRANSACTION_TYPES = frozenset(('bank', 'cash', 'ccard', 'oth a', 'oth l'))
+
+# The outcome of parsing a CSV row: either entry or error is set.
+ParsedRow = namedtuple('ParsedRow', ('line', 'data', 'entry', 'error'))
+
+# Encodings of uploads by BOM, and the ones tried in order without one (the
+# last one can decode anything).
+UPLOAD_BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+UPLOAD_ENCODINGS = ('utf-8', 'cp1252', 'latin-1')
+NON_ASCII = re.compile(b'[\\x80-\\xff]')
+
+
+def detect_encoding(head, boms=True, final=False):
+    """Guess the encoding of an upload from its first bytes.
+
+    If boms is False, head is not the start of the upload and any BOM like
+    bytes are just content. Unless final is True, more bytes follow head:
+    None is returned if the only non ASCII bytes are a trailing incomplete
+    UTF-8 sequence, since the next bytes are needed to tell.
+
+    """
+    for bom, encoding in UPLOAD_BOMS if boms else ():
+        if head.startswith(bom):
+            return encoding
+    for encoding in UPLOAD_ENCODINGS[:-1]:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            decoder.decode(head, final=final)
+        except UnicodeDecodeError:
+            continue
+        pending = decoder.getstate()[0]
+        if pending and not NON_ASCII.search(head, 0, len(head) - len(pending)):
+            return None
+        return encoding
+    return UPLOAD_ENCODINGS[-1]
+
+
+def decode_chunks(chunks):
+    """Decode the byte chunks of an upload, yielding text as it goes.
+
+    The encoding is detected from the first chunks with non ASCII bytes
+    (ASCII reads the same in all of UPLOAD_ENCODINGS), and newlines are
+    translated to '\\n' as when reading a file in text mode.
+
+    """
+    # the first chunk is made long enough to hold any BOM
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= max(len(bom) for bom, encoding in UPLOAD_BOMS):
+            break
+
+    newlines = io.IncrementalNewlineDecoder(None, translate=True)
+    decoder = None
+    # bytes read while the encoding is not known yet, and where they start
+    undecided = b''
+    start = None
+    for i, chunk in enumerate(itertools.chain([head], chunks)):
+        if decoder is not None:
+            text = decoder.decode(chunk)
+        elif not undecided and not NON_ASCII.search(chunk):
+            text = chunk.decode('ascii')
+        else:
+            if not undecided:
+                start = i
+            undecided += chunk
+            encoding = detect_encoding(undecided, boms=start == 0)
+            if encoding is None:
+                continue
+            decoder = codecs.getincrementaldecoder(encoding)()
+            text = decoder.decode(undecided)
+            undecided = b''
+        text = newlines.decode(text)
+        if text:
+            yield text
+    if undecided:
+        decoder = codecs.getincrementaldecoder(
+            detect_encoding(undecided, boms=start == 0, final=True))()
+        text = decoder.decode(undecided, final=True)
+    else:
+        text = decoder.decode(b'', final=True) if decoder is not None else ''
+    text = newlines.decode(text, final=True)
+    if text:
+        yield text
+
+
+class ChunkedTextFile(object):
+    """The lines of the given pieces of text, as csv.reader needs them.
+
+    Pieces are consumed as lines are read, so only the current line and
+    piece are kept in memory.
+
+    """
+
+    def __init__(self, chunks, name=''):
+        super(ChunkedTextFile, self).__init__()
+        self.chunks = chunks
+        self.name = name
+
+    def __iter__(self):
+        pending = ''
+        for chunk in self.chunks:
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if pending:
+            yield pending
 
 
 class DataToBeProcessedError(Exception):
@@ -21,21 +151,110 @@ class DataToBeProcessedError(Exception):
         super(DataToBeProcessedError, self).__init__(*args, **kwargs)
 
 
-class CSVParser(object):
+class DuplicateEntryError(Exception):
+    """The entry for this row already exists."""
 
-    def __init__(self, account):
-        super(CSVParser, self).__init__()
-        self.account = account
-        self.config = self.account.parser_config
-
-    def _parse_amount(self, row, i):
+    def __init__(self, data, *args, **kwargs):
+        self.data = data
+        if not args:
+            args = ('Entry already exists: %s %s %s%s' % (
+                data['when'].strftime('%Y-%m-%d'), data['what'],
+                '+' if data['is_income'] else '-', data['amount']),)
+        super(DuplicateEntryError, self).__init__(*args, **kwargs)
+
+
+class EntryKeys(object):
+    """The unique keys of the entries of an account in a book.
+
+    Keys are loaded as rows are looked up, for a range of dates that grows
+    at least window at a time, so a statement usually costs a query or two
+    regardless of its size and without knowing its dates up front.
+
+    """
+
+    window = timedelta(days=366)
+
+    def __init__(self, book, account):
+        super(EntryKeys, self).__init__()
+        self.entries = Entry.objects.filter(book=book, account=account)
+        self.keys = set()
+        self.start = self.end = None
+
+    @staticmethod
+    def key(data):
+        when = data['when']
+        if isinstance(when, datetime):
+            when = when.date()
+        return (
+            data['account'], when, data['what'], data['amount'],
+            data['is_income'])
+
+    def _load(self, start, end):
+        self.keys.update(
+            self.entries.filter(when__range=(start, end)).values_list(
+                'account', 'when', 'what', 'amount', 'is_income'))
+
+    def _cover(self, when):
+        if self.start is None:
+            self.start, self.end = when - self.window, when + self.window
+            self._load(self.start, self.end)
+        elif when < self.start:
+            start = min(when, self.start - self.window)
+            self._load(start, self.start - timedelta(days=1))
+            self.start = start
+        elif when > self.end:
+            end = max(when, self.end + self.window)
+            self._load(self.end + timedelta(days=1), end)
+            self.end = end
+
+    def exists(self, key):
+        self._cover(key[1])
+        return key in self.keys
+
+    def add(self, key):
+        self.keys.add(key)
+
+
+class RowPlan(object):
+    """How to read the cells of a row, resolved once for a ParserConfig.
+
+    Separators are handled with a single translation table, dates are
+    parsed once per distinct value (exports repeat the same few ones)
+    and column indexes are kept as tuples.
+
+    """
+
+    amount_junk = re.compile(r'[^\d\-.]')
+    dates_cache_size = 4096
+
+    def __init__(self, config):
+        super(RowPlan, self).__init__()
+        self.amount_columns = tuple(config.amount)
+        assert 1 <= len(self.amount_columns) <= 2, (
+            'Config amount can not be bigger than 2 elements (got %r).' %
+            config.amount)
+        self.what_columns = tuple(config.what)
+        self.when_columns = tuple(config.when)
+        self.notes_columns = tuple(config.notes)
+
+        separators = {}
+        if config.decimal_point != '.':
+            separators[config.decimal_point] = '.'
+        if config.thousands_sep:
+            # the thousands separator is dropped, even if used as point
+            separators[config.thousands_sep] = None
+        self.separators = str.maketrans(separators)
+
+        date_format = config.date_format
+        self.parse_date = lru_cache(maxsize=self.dates_cache_size)(
+            lambda value: datetime.strptime(value, date_format))
+
+    def parse_amount(self, row, i):
         result = '0'
         value = row[i]
         if value:
-            value = value.replace(self.config.thousands_sep, '')
-            if self.config.decimal_point != '.':
-                value = value.replace(self.config.decimal_point, '.')
-            result = re.sub(r'[^\d\-.]', '', value)
+            result = self.amount_junk.sub(
+                '', value.translate(self.separators))
 
         try:
             result = Decimal(result)
@@ -46,45 +265,65 @@ class CSVParser(object):
 
         return result
 
-    def find_amount(self, row):
-        if len(self.config.amount) == 1:
-            result = self._parse_amount(row, self.config.amount[0])
-        else:
-            assert len(self.config.amount) == 2, (
-                'Config amount can not be bigger than 2 elements (got %r).' %
-                self.config.amount)
-            expense = self._parse_amount(row, self.config.amount[0])
-            income = self._parse_amount(row, self.config.amount[1])
-            result = income - abs(expense)
-        return result
+    def amount(self, row):
+        if len(self.amount_columns) == 1:
+            return self.parse_amount(row, self.amount_columns[0])
+        expense = self.parse_amount(row, self.amount_columns[0])
+        income = self.parse_amount(row, self.amount_columns[1])
+        return income - abs(expense)
 
-    def find_notes(self, row):
-        notes = ([row[k] for k in self.config.notes if row[k]] +
-                 ['source: %r' % self.name])
-        return ' | '.join(notes)
+    def notes(self, row):
+        return [row[k] for k in self.notes_columns if row[k]]
 
-    def find_what(self, row):
+    def what(self, row):
         result = None
-        for i in self.config.what:
+        for i in self.what_columns:
             result = row[i].strip()
             if result:
                 break
         assert result, ('What not found (tried %r): %r' %
-                        (self.config.what, row))
+                        (list(self.what_columns), row))
         return result
 
-    def find_when(self, row):
+    def when(self, row):
         result = None
-        for i in self.config.when:
+        for i in self.when_columns:
             result = row[i]
             if result:
-                result = datetime.strptime(
-                    result, self.config.date_format)
+                result = self.parse_date(result)
                 break
         assert result, ('When not found (tried %r): %r' %
-                        (self.config.when, row))
+                        (list(self.when_columns), row))
         return result
 
+
+class CSVParser(object):
+
+    def __init__(self, account):
+        super(CSVParser, self).__init__()
+        self.account = account
+        self.config = self.account.parser_config
+
+    @cached_property
+    def plan(self):
+        return RowPlan(self.config)
+
+    def _parse_amount(self, row, i):
+        return self.plan.parse_amount(row, i)
+
+    def find_amount(self, row):
+        return self.plan.amount(row)
+
+    def find_notes(self, row):
+        notes = self.plan.notes(row) + ['source: %r' % self.name]
+        return ' | '.join(notes)
+
+    def find_what(self, row):
+        return self.plan.what(row)
+
+    def find_when(self, row):
+        return self.plan.when(row)
+
     def make_data(self, row, user, unprocessed=None):
         assert row, 'The given row %r is empty' % row
         amount = self.find_amount(row)
@@ -109,12 +348,14 @@ class CSVParser(object):
 
         return data
 
+    def _error_message(self, errors):
+        return ' | '.join(
+            '%s: %s' % (k, ', '.join(v)) for k, v in errors.items())
+
     def _validate_and_save_entry(self, data, book, dry_run=False):
         form = EntryForm(book=book, data=data)
         if not form.is_valid():
-            msg = ' | '.join(
-                '%s: %s' % (k, ', '.join(v)) for k, v in form.errors.items())
-            raise ValueError(msg)
+            raise ValueError(self._error_message(form.errors))
         if dry_run:
             entry = data
         else:
@@ -136,13 +377,88 @@ class CSVParser(object):
 
         return entry
 
-    def parse(self, fileobj, book, user, dry_run=False):
-        self.name = fileobj.name
-        result = dict(entries=[], errors=defaultdict(list))
+    def _validate_entry(self, data, book, accounts):
+        """Build an unsaved Entry validating data without any query."""
+        errors = {}
+        if data['account'] not in accounts:
+            errors['account'] = [str(
+                forms.ModelChoiceField.default_error_messages[
+                    'invalid_choice'])]
+        entry = Entry(
+            book_id=book.id, who_id=data['who'], account_id=data['account'],
+            when=data['when'], what=data['what'], amount=data['amount'],
+            is_income=data['is_income'], tags=data['tags'],
+            country=data['country'], notes=data['notes'])
+        try:
+            # Foreign keys are checked against the preloaded accounts, and
+            # choices below: iterating the country choices is very slow.
+            entry.clean_fields(
+                exclude=('book', 'who', 'account', 'country', 'tags'))
+        except ValidationError as e:
+            errors.update(e.message_dict)
+        invalid_choice = forms.ChoiceField.default_error_messages[
+            'invalid_choice']
+        if data['country'] not in countries.countries:
+            errors['country'] = [invalid_choice % {'value': data['country']}]
+        if not data['tags']:
+            errors['tags'] = [str(forms.Field.default_error_messages[
+                'required'])]
+        tags = [t for t in data['tags'] if t not in TAGS]
+        if tags:
+            errors['tags'] = [invalid_choice % {'value': tags[0]}]
+        if errors:
+            raise ValueError(self._error_message(errors))
+        return entry
+
+    def build_entries(self, data, book, accounts):
+        """Bulk counterpart of make_entry, returning the unsaved entries."""
+        if not data:
+            return []
+        entries = [self._validate_entry(data, book, accounts)]
+
+        # Needs a transfer?
+        tags = self.account.tags_for(data['what'])
+        for transfer in filter(None, tags.values()):
+            data = dict(
+                data, is_income=not data['is_income'], account=transfer.id)
+            entries.append(self._validate_entry(data, book, accounts))
+
+        return entries
+
+    def save_entries(self, batch):
+        """Insert the (line, data, entries) from batch with bulk_create.
+
+        Yield a ParsedRow per item. If any entry can not be inserted
+        (usually because it already exists), every item is saved on its
+        own so the failing rows are reported as make_entry would.
 
+        """
+        try:
+            with transaction.atomic():
+                created = Entry.objects.bulk_create(
+                    [e for line, data, entries in batch for e in entries])
+                MonthTotal.objects.add_entries(
+                    Entry.objects.filter(id__in=[e.id for e in created]))
+                Book.bump_versions({e.book_id for e in created})
+        except IntegrityError:
+            for line, data, entries in batch:
+                try:
+                    with transaction.atomic():
+                        for entry in entries:
+                            entry.pk = None
+                            entry.save()
+                except IntegrityError as error:
+                    yield ParsedRow(line, data, None, error)
+                else:
+                    yield ParsedRow(line, data, entries[0], None)
+        else:
+            for line, data, entries in batch:
+                yield ParsedRow(line, data, entries[0], None)
+
+    def read_rows(self, fileobj):
+        """Yield the (line, row) of the rows in fileobj to be parsed."""
         reader = csv.reader(fileobj)
         ignored = 0
-        unprocessed = None
         for row in reader:
             # ignore initial rows
             if ignored < self.config.ignore_rows:
@@ -152,6 +468,38 @@ class CSVParser(object):
             if not row or not any(row):
                 continue
 
+            yield reader.line_num, row
+
+    def iter_parse(self, fileobj, book, user, dry_run=False, bulk=False,
+                   batch_size=BULK_BATCH_SIZE):
+        """Parse the rows from fileobj, yielding a ParsedRow per row.
+
+        Rows are read and processed as the generator is consumed, so
+        memory use does not depend on the size of fileobj. When bulk is
+        set, rows are validated in Python against the accounts of book
+        and inserted batch_size at a time, instead of going through an
+        EntryForm and a transaction per row; rows failing validation are
+        then yielded right away, the others once their batch is saved.
+
+        A dry run validates rows as in bulk, but yields their data right
+        away instead of saving anything: after the accounts and tag rules
+        are loaded, the database is only read for the EntryKeys.
+
+        Rows whose entry already exists (as per EntryKeys, so without
+        trying to insert them) are yielded with a DuplicateEntryError.
+
+        """
+        self.name = fileobj.name
+        existing = EntryKeys(book, self.account)
+        in_memory = bulk or dry_run
+        if in_memory:
+            accounts = set(
+                Account.objects.by_book(book).values_list('id', flat=True))
+            self.account.tag_matcher()
+            batch = []
+
+        unprocessed = None
+        for line, row in self.read_rows(fileobj):
             try:
                 data = self.make_data(
                     row=row, user=user, unprocessed=unprocessed)
@@ -161,17 +509,289 @@ class CSVParser(object):
                 continue
 
             unprocessed = None
+            key = existing.key(data)
+            if existing.exists(key):
+                yield ParsedRow(line, data, None, DuplicateEntryError(data))
+                continue
+
             error = None
             try:
-                entry = self.make_entry(data, book=book, dry_run=dry_run)
+                if in_memory:
+                    entries = self.build_entries(data, book, accounts)
+                else:
+                    entry = self.make_entry(data, book=book)
             except Exception as e:
                 error = e
 
             if error is not None:
-                result['errors'][error.__class__.__name__].append(
-                    (error, data))
+                yield ParsedRow(line, data, None, error)
+                continue
+
+            # later rows for the same entry are duplicates too
+            existing.add(key)
+            if dry_run:
+                yield ParsedRow(line, data, data, None)
+            elif bulk:
+                assert entries, 'Entries should not be empty'
+                batch.append((line, data, entries))
+                if len(batch) >= batch_size:
+                    yield from self.save_entries(batch)
+                    batch = []
             else:
                 assert entry is not None, 'Entry should not be None'
-                result['entries'].append(entry)
+                yield ParsedRow(line, data, entry, None)
+
+        if in_memory and batch:
+            yield from self.save_entries(batch)
+
+    def parse(self, fileobj, book, user, summary=False, **kwargs):
+        """Parse the CSV rows from fileobj into entries of book.
+
+        Return the created entries, the data of the rows whose entry
+        already existed and, per exception name, the (error, data) pairs of
+        the failed rows. With summary set, only count them instead. See
+        iter_parse for the other arguments.
+
+        """
+        if summary:
+            result = dict(entries=0, duplicates=0, errors=Counter())
+        else:
+            result = dict(entries=[], duplicates=[], errors=defaultdict(list))
+
+        for parsed in self.iter_parse(fileobj, book, user, **kwargs):
+            if isinstance(parsed.error, DuplicateEntryError):
+                if summary:
+                    result['duplicates'] += 1
+                else:
+                    result['duplicates'].append(parsed.data)
+            elif parsed.error is not None:
+                name = parsed.error.__class__.__name__
+                if summary:
+                    result['errors'][name] += 1
+                else:
+                    result['errors'][name].append(
+                        (parsed.error, parsed.data))
+            elif summary:
+                result['entries'] += 1
+            else:
+                result['entries'].append(parsed.entry)
 
         return result
+
+
+class RowLayout(object):
+    """The ParserConfig settings of a RowPlan, for rows of a known layout."""
+
+    def __init__(self, when, what, amount, notes, date_format,
+                 decimal_point='.', thousands_sep=''):
+        super(RowLayout, self).__init__()
+        self.when = when
+        self.what = what
+        self.amount = amount
+        self.notes = notes
+        self.date_format = date_format
+        self.decimal_point = decimal_point
+        self.thousands_sep = thousands_sep
+
+
+class OFXParser(CSVParser):
+    """Parse the transactions of OFX files, either SGML (1.x) or XML (2.x).
+
+    Every STMTTRN is turned into a row of (date, name, memo, amount, id),
+    tags being read line by line as the file is.
+
+    """
+
+    layout = RowLayout(
+        when=[0], what=[1, 2], amount=[3], notes=[2, 4], date_format='%Y%m%d')
+
+    @cached_property
+    def plan(self):
+        return RowPlan(self.layout)
+
+    def tags(self, fileobj):
+        """Yield the (line, name, value) of the tags in fileobj.
+
+        The value of a tag is the text up to the next one, so closing tags
+        are optional as in SGML.
+
+        """
+        tag = None
+        for line, text in enumerate(fileobj, 1):
+            pieces = text.split('<')
+            if tag is not None:
+                tag[2] += pieces[0]
+            for piece in pieces[1:]:
+                if tag is not None:
+                    yield tag[0], tag[1], html.unescape(tag[2].strip())
+                name, _, value = piece.partition('>')
+                tag = [line, name.strip().upper(), value]
+        if tag is not None:
+            yield tag[0], tag[1], html.unescape(tag[2].strip())
+
+    def read_rows(self, fileobj):
+        transaction = None
+        for line, name, value in self.tags(fileobj):
+            if name == 'STMTTRN':
+                transaction = {}
+                start = line
+            elif name == '/STMTTRN' and transaction is not None:
+                yield start, [
+                    transaction.get('DTPOSTED', '')[:8],
+                    transaction.get('NAME', ''),
+                    transaction.get('MEMO', ''),
+                    transaction.get('TRNAMT', '').replace(',', '.'),
+                    transaction.get('FITID', '')]
+                transaction = None
+            elif transaction is not None and not name.startswith('/'):
+                transaction[name] = value
+
+
+class QIFParser(CSVParser):
+    """Parse the records of QIF files into rows of (date, payee, memo,
+    amount, number), dates and amounts as set in the ParserConfig."""
+
+    @cached_property
+    def plan(self):
+        return RowPlan(RowLayout(
+            when=[0], what=[1, 2], amount=[3], notes=[2, 4],
+            date_format=self.config.date_format,
+            decimal_point=self.config.decimal_point,
+            thousands_sep=self.config.thousands_sep))
+
+    def make_row(self, record):
+        return [
+            record.get('D', ''), record.get('P', ''), record.get('M', ''),
+            record.get('T', record.get('U', '')), record.get('N', '')]
+
+    def read_rows(self, fileobj):
+        record = {}
+        # line where the current record started
+        start = None
+        # whether the current section holds transactions, the others (such
+        # as !Account lists or !Type:Cat categories) are skipped
+        transactions = False
+        for line, text in enumerate(fileobj, 1):
+            text = text.strip()
+            if text.startswith(('!', '^')):
+                if record:
+                    yield start, self.make_row(record)
+                record = {}
+                if text.startswith('!'):
+                    header, _, kind = text[1:].partition(':')
+                    transactions = (
+                        header.strip().lower() == 'type' and
+                        kind.strip().lower() in QIF_TRANSACTION_TYPES)
+                continue
+            if not text or not transactions:
+                continue
+
+            if not record:
+                start = line
+            # the first value wins, splits repeat their fields
+            record.setdefault(text[0], text[1:].strip())
+
+        if record:
+            yield start, self.make_row(record)
+
+
+def local_name(element):
+    """The tag of element without its XML namespace."""
+    return element.tag.rpartition('}')[2]
+
+
+def find_child(element, *path):
+    """The descendant of element at path, matching local names only."""
+    for name in path:
+        element = next(
+            (i for i in element if local_name(i) == name), None)
+        if element is None:
+            break
+    return element
+
+
+def find_text(element, *paths):
+    """The text of the first of paths found from element, if any."""
+    for path in paths:
+        child = find_child(element, *path)
+        if child is not None and child.text and child.text.strip():
+            return child.text.strip()
+    return ''
+
+
+class Camt053Parser(CSVParser):
+    """Parse the booked entries (Ntry) of ISO 20022 camt.053 statements.
+
+    Every entry is turned into a row of (date, counterparty, remittance
+    information, additional information, amount, reference). The XML is
+    parsed as it is read, dropping each entry once used, so statements
+    are never loaded whole.
+
+    """
+
+    layout = RowLayout(
+        when=[0], what=[1, 2, 3], amount=[4], notes=[2, 3, 5],
+        date_format='%Y-%m-%d')
+
+    @cached_property
+    def plan(self):
+        return RowPlan(self.layout)
+
+    def make_row(self, entry):
+        debit = find_text(entry, ['CdtDbtInd']) == 'DBIT'
+        party = 'Cdtr' if debit else 'Dbtr'
+        details = find_child(entry, 'NtryDtls', 'TxDtls')
+        name = remittance = ''
+        if details is not None:
+            name = find_text(
+                details, ['RltdPties', party, 'Nm'],
+                ['RltdPties', party, 'Pty', 'Nm'])
+            info = find_child(details, 'RmtInf')
+            if info is not None:
+                remittance = ' '.join(
+                    i.text.strip() for i in info
+                    if local_name(i) == 'Ustrd' and i.text)
+        amount = find_text(entry, ['Amt'])
+        return [
+            find_text(
+                entry, ['BookgDt', 'Dt'], ['BookgDt', 'DtTm'],
+                ['ValDt', 'Dt'])[:10],
+            name, remittance, find_text(entry, ['AddtlNtryInf']),
+            '-' + amount if debit and amount else amount,
+            find_text(entry, ['AcctSvcrRef'])]
+
+    def read_rows(self, fileobj):
+        parser = ElementTree.XMLPullParser(events=('start', 'end'))
+        parents = []
+        for line, text in enumerate(fileobj, 1):
+            parser.feed(text)
+            for event, element in parser.read_events():
+                if event == 'start':
+                    parents.append(element)
+                    if local_name(element) == 'Ntry':
+                        start = line
+                    continue
+
+                parents.pop()
+                if local_name(element) != 'Ntry':
+                    continue
+                status = find_text(element, ['Sts', 'Cd'], ['Sts'])
+                if status in ('', 'BOOK'):
+                    yield start, self.make_row(element)
+                if parents:
+                    parents[-1].remove(element)
+        parser.close()
+
+
+# Parser classes per ParserConfig.file_format.
+PARSERS = {
+    'csv': CSVParser,
+    'ofx': OFXParser,
+    'qif': QIFParser,
+    'camt.053': Camt053Parser,
+}
+
+
+def get_parser(account):
+    """The parser for the files of account, as per its parser config."""
+    return PARSERS[account.parser_config.file_format](account)
@@ -58,10 +58,10 @@ class Factory(object):
 
         return account
 
-    def make_tag_regex(self, regex, tag, account=None):
+    def make_tag_regex(self, regex, tag, account=None, **kwargs):
         if account is None:
             account = self.make_account()
-        return account.tagregex_set.create(regex=regex, tag=tag)
+        return account.tagregex_set.create(regex=regex, tag=tag, **kwargs)
 
     def make_entry(
             self, book=None, account=None, who=None, amount=Decimal('1.0'),
@@ -14,3 +14,10 @@ class BaseTestCase(TestCase):
 
     def data_file(self, filename):
         return os.path.join(os.path.dirname(__file__), 'data', filename)
+
+    def make_bank1_parser_config(self):
+        """A ParserConfig for the columns of data/bank1.csv."""
+        # Fecha / Hora Mov.,Concepto,Importe,Comentarios,Saldo Parcial
+        return self.factory.make_parser_config(
+            when=[0], what=[1], amount=[2], notes=[3, 4],
+            date_format='%d/%m/%Y', country='FR', ignore_rows=1)
@@ -0,0 +1,171 @@
+import json
+
+from datetime import date
+from decimal import Decimal
+
+from django.urls import reverse
+
+from gemcore.tests.helpers import BaseTestCase
+
+
+class APITestCase(BaseTestCase):
+
+    def setUp(self):
+        super(APITestCase, self).setUp()
+        self.user = self.factory.make_user()
+        self.book = self.factory.make_book(users=[self.user])
+        self.account = self.factory.make_account(users=[self.user])
+        assert self.client.login(username=self.user.username, password='test')
+
+    def make_entry(self, **kwargs):
+        return self.factory.make_entry(
+            book=self.book, account=self.account, who=self.user, **kwargs)
+
+    def do_request(self, name, **kwargs):
+        url = reverse(name, args=[self.book.slug])
+        response = self.client.get(url, kwargs)
+        if response.status_code != 200:
+            return response, json.loads(response.content.decode('utf-8'))
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        content = b''.join(response.streaming_content)
+        return response, json.loads(content.decode('utf-8'))
+
+
+class EntriesAPITestCase(APITestCase):
+
+    def test_entries(self):
+        entry = self.make_entry(
+            what='Bakery', amount=Decimal('3.5'), when=date(2020, 1, 15),
+            tags=['food'], notes='Bread')
+
+        response, result = self.do_request('api-entries')
+
+        self.assertEqual(result, {
+            'entries': [{
+                'id': entry.id, 'when': '2020-01-15', 'what': 'Bakery',
+                'amount': '3.50', 'is_income': False,
+                'account': self.account.slug,
+                'currency': self.account.currency,
+                'who': self.user.username, 'country': 'AR',
+                'tags': ['food'], 'notes': 'Bread'}],
+            'next': None})
+
+    def test_empty(self):
+        response, result = self.do_request('api-entries')
+
+        self.assertEqual(result, {'entries': [], 'next': None})
+
+    def test_filtered(self):
+        self.make_entry(when=date(2020, 1, 15))
+        expected = self.make_entry(when=date(2021, 1, 15))
+        self.factory.make_entry(when=date(2021, 1, 15))
+
+        response, result = self.do_request('api-entries', year=2021)
+
+        self.assertEqual(
+            [e['id'] for e in result['entries']], [expected.id])
+
+    def test_cursor_continuation(self):
+        entries = [
+            self.make_entry(when=date(2020, 1, 1 + i)) for i in range(5)]
+        expected = [e.id for e in reversed(entries)]
+
+        seen = []
+        kwargs = {'limit': 2}
+        while True:
+            response, result = self.do_request('api-entries', **kwargs)
+            seen.extend(e['id'] for e in result['entries'])
+            if result['next'] is None:
+                break
+            kwargs['after'] = result['next']
+
+        self.assertEqual(seen, expected)
+
+    def test_invalid_limit(self):
+        for limit in ('foo', '0', '-3'):
+            response, result = self.do_request('api-entries', limit=limit)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Invalid limit', result['error'])
+
+    def test_invalid_cursor(self):
+        response, result = self.do_request('api-entries', after='garbage')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Invalid cursor', result['error'])
+
+    def test_other_book(self):
+        book = self.factory.make_book()
+        url = reverse('api-entries', args=[book.slug])
+
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 404)
+
+
+class BalanceAPITestCase(APITestCase):
+
+    def test_balance(self):
+        self.make_entry(amount=Decimal('3.5'), when=date(2020, 1, 15))
+        self.make_entry(
+            amount=Decimal('10'), when=date(2020, 2, 15), is_income=True)
+
+        response, result = self.do_request('api-balance')
+
+        self.assertEqual(result['complete'], {
+            'start': '2020-01-15', 'end': '2020-02-15', 'income': '10.00',
+            'expense': '3.50', 'result': '6.50'})
+        self.assertEqual(
+            [(m['start'], m['result']) for m in result['months']],
+            [('2020-01-01', '-3.50'), ('2020-02-01', '10.00')])
+
+    def test_empty(self):
+        response, result = self.do_request('api-balance')
+
+        self.assertEqual(result, {'complete': None, 'months': []})
+
+
+class BreakdownAPITestCase(APITestCase):
+
+    def setUp(self):
+        super(BreakdownAPITestCase, self).setUp()
+        self.make_entry(amount=Decimal('3.5'), when=date(2020, 1, 15))
+        self.make_entry(amount=Decimal('10'), when=date(2020, 1, 20))
+        self.make_entry(amount=Decimal('2'), when=date(2021, 3, 1))
+
+    def test_month_breakdown(self):
+        response, result = self.do_request('api-month-breakdown')
+
+        self.assertEqual(result, {'month': [
+            {'month': '2020-01-01', 'count': 2, 'total': '13.50'},
+            {'month': '2021-03-01', 'count': 1, 'total': '2.00'}]})
+
+    def test_year_breakdown(self):
+        response, result = self.do_request('api-year-breakdown')
+
+        self.assertEqual(result, {'year': [
+            {'year': '2020-01-01', 'count': 2, 'total': '13.50'},
+            {'year': '2021-01-01', 'count': 1, 'total': '2.00'}]})
+
+    def test_filtered(self):
+        response, result = self.do_request('api-year-breakdown', year=2021)
+
+        self.assertEqual(result, {'year': [
+            {'year': '2021-01-01', 'count': 1, 'total': '2.00'}]})
+
+    def test_empty(self):
+        book = self.factory.make_book(users=[self.user])
+        url = reverse('api-month-breakdown', args=[book.slug])
+
+        response = self.client.get(url)
+
+        content = b''.join(response.streaming_content)
+        self.assertEqual(json.loads(content.decode('utf-8')), {'month': []})
+
+    def test_other_book(self):
+        book = self.factory.make_book()
+        url = reverse('api-year-breakdown', args=[book.slug])
+
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,206 @@
+from datetime import date
+from io import StringIO
+
+from django.core.cache import caches
+from django.core.management import call_command
+
+from gemcore.cache import BookCache, normalize
+from gemcore.models import Account, Book, Entry, MonthTotal, TagRegex
+from gemcore.tests.helpers import BaseTestCase
+
+
+class BookCacheTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(BookCacheTestCase, self).setUp()
+        self.cache = BookCache()
+        self.addCleanup(caches['books'].clear)
+        self.book = self.factory.make_book()
+        self.account = self.factory.make_account()
+        self.entry = self.factory.make_entry(
+            book=self.book, account=self.account, when=date(2020, 1, 1))
+
+    def book_version(self):
+        return Book.objects.get(id=self.book.id).version
+
+    def facets(self, params=None):
+        book = Book.objects.get(id=self.book.id)
+        return self.cache.get_or_set(
+            book, 'facets', params, lambda: book.facets())
+
+    def assert_invalidated(self, change):
+        self.facets()
+        version = self.book_version()
+        change()
+        self.assertGreater(self.book_version(), version)
+        misses = self.cache.stats()['facets']['misses']
+        self.facets()
+        self.assertEqual(self.cache.stats()['facets']['misses'], misses + 1)
+
+    def test_hits_and_misses(self):
+        first = self.facets()
+        with self.assertNumQueries(1):
+            # only the book is read
+            second = self.facets()
+
+        self.assertEqual(first, second)
+        self.assertEqual(
+            self.cache.stats(), {'facets': {'hits': 1, 'misses': 1}})
+
+    def test_stats_shared(self):
+        self.facets()
+        self.facets()
+
+        # another instance (or process) on the same backend
+        self.assertEqual(
+            BookCache().stats(), {'facets': {'hits': 1, 'misses': 1}})
+
+    def test_stats_command(self):
+        self.facets()
+        self.facets()
+        self.facets({'year': 2020})
+        out = StringIO()
+
+        call_command('book_cache_stats', '--reset', stdout=out)
+
+        self.assertEqual(
+            out.getvalue(), 'facets: 1 hits, 2 misses (33.3% hit rate)\n')
+        self.assertEqual(self.cache.stats(), {})
+        out = StringIO()
+        call_command('book_cache_stats', stdout=out)
+        self.assertEqual(out.getvalue(), 'No lookups counted.\n')
+
+    def test_none_cached(self):
+        book = Book.objects.get(id=self.book.id)
+        calls = []
+
+        def compute():
+            calls.append(1)
+
+        self.assertIsNone(self.cache.get_or_set(book, 'x', None, compute))
+        self.assertIsNone(self.cache.get_or_set(book, 'x', None, compute))
+        self.assertEqual(calls, [1])
+
+    def test_key_normalized(self):
+        key = self.cache.make_key(
+            self.book, 'facets', {'tags': ['food', 'car'], 'q': None})
+        self.assertEqual(key, self.cache.make_key(
+            self.book, 'facets', {'tags': ['car', 'food'], 'year': ''}))
+        self.assertNotEqual(key, self.cache.make_key(
+            self.book, 'facets', {'tags': ['car']}))
+        self.assertNotEqual(key, self.cache.make_key(
+            self.book, 'balance', {'tags': ['car', 'food']}))
+        self.assertTrue(key.startswith(
+            'book:%s:v%s:facets:' % (self.book.id, self.book.version)))
+
+    def test_normalize(self):
+        accounts = [self.factory.make_account() for i in range(2)]
+        self.assertEqual(
+            normalize({'accounts': list(reversed(accounts)), 'when': None}),
+            {'accounts': sorted([a.id for a in accounts], key=str)})
+
+    def test_entry_created(self):
+        self.assert_invalidated(lambda: self.factory.make_entry(
+            book=self.book, account=self.account))
+
+    def test_entry_updated(self):
+        def change():
+            self.entry.what = 'Changed'
+            self.entry.save()
+
+        self.assert_invalidated(change)
+
+    def test_entry_moved_to_other_book(self):
+        other = self.factory.make_book()
+        version = other.version
+
+        def change():
+            self.entry.book = other
+            self.entry.save()
+
+        self.assert_invalidated(change)
+        self.assertGreater(Book.objects.get(id=other.id).version, version)
+
+    def test_entry_deleted(self):
+        self.assert_invalidated(self.entry.delete)
+
+    def test_queryset_update(self):
+        self.assert_invalidated(
+            lambda: Entry.objects.filter(id=self.entry.id).update(
+                notes='foo'))
+
+    def test_queryset_update_totals(self):
+        self.assert_invalidated(
+            lambda: Entry.objects.filter(id=self.entry.id).update(
+                amount=10))
+
+    def test_queryset_delete(self):
+        self.assert_invalidated(
+            lambda: Entry.objects.filter(id=self.entry.id).delete())
+
+    def test_totals_rebuilt(self):
+        self.assert_invalidated(
+            lambda: MonthTotal.objects.rebuild(books=[self.book]))
+
+    def test_account_changed(self):
+        def change():
+            self.account.currency = 'EUR'
+            self.account.save()
+
+        self.assert_invalidated(change)
+
+    def test_account_shared(self):
+        user = self.factory.make_user()
+        self.book.users.add(user)
+        account = self.factory.make_account()
+
+        self.assert_invalidated(lambda: account.users.add(user))
+        self.assert_invalidated(lambda: account.users.remove(user))
+        account.users.add(user)
+        self.assert_invalidated(account.users.clear)
+        self.assert_invalidated(lambda: user.account_set.add(account))
+
+    def test_account_deleted(self):
+        user = self.factory.make_user()
+        self.book.users.add(user)
+        account = self.factory.make_account(users=[user])
+
+        # no entries, the book lists it as an account of its users
+        self.assert_invalidated(account.delete)
+
+    def test_account_with_entries_deleted(self):
+        self.assert_invalidated(self.account.delete)
+
+    def test_tag_regex_changed(self):
+        self.assert_invalidated(lambda: self.factory.make_tag_regex(
+            regex='^Desc', tag='food', account=self.account))
+
+    def test_tag_regex_queryset_update(self):
+        tag_regex = self.factory.make_tag_regex(
+            regex='^Desc', tag='food', account=self.account)
+        other = self.factory.make_account()
+        versions = dict(Account.objects.filter(
+            id__in=[self.account.id, other.id]).values_list(
+            'id', 'tagregex_version'))
+
+        self.assert_invalidated(
+            lambda: TagRegex.objects.filter(id=tag_regex.id).update(
+                account=other))
+
+        for account in Account.objects.filter(id__in=versions):
+            self.assertGreater(
+                account.tagregex_version, versions[account.id])
+
+    def test_other_books_kept(self):
+        other = self.factory.make_book()
+        version = other.version
+        self.factory.make_entry(book=self.book, account=self.account)
+        self.assertEqual(Book.objects.get(id=other.id).version, version)
+
+    def test_book_save_keeps_version(self):
+        stale = Book.objects.get(id=self.book.id)
+        self.factory.make_entry(book=self.book, account=self.account)
+        version = self.book_version()
+        stale.name = 'Renamed'
+        stale.save()
+        self.assertEqual(self.book_version(), version)
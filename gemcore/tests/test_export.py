@@ -0,0 +1,98 @@
+import csv
+import os
+import tempfile
+
+from datetime import date
+from decimal import Decimal
+from io import StringIO
+
+from django.core.management import call_command
+from django.urls import reverse
+
+from gemcore.export import ENTRY_COLUMNS, iter_csv
+from gemcore.tests.helpers import BaseTestCase
+
+
+class ExportTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(ExportTestCase, self).setUp()
+        self.user = self.factory.make_user()
+        self.book = self.factory.make_book(users=[self.user])
+        self.account = self.factory.make_account(users=[self.user])
+        self.first = self.make_entry(
+            what='Bakery, "La Espiga"', amount=Decimal('3.5'),
+            when=date(2020, 1, 15), tags=['food', 'house'], notes='Bread')
+        self.second = self.make_entry(
+            what='Salary', amount=Decimal('100'), when=date(2021, 2, 1),
+            is_income=True)
+
+    def make_entry(self, **kwargs):
+        return self.factory.make_entry(
+            book=self.book, account=self.account, who=self.user, **kwargs)
+
+    def expected_row(self, entry):
+        return [
+            entry.when.isoformat(), entry.what, '%.2f' % entry.amount,
+            str(entry.is_income), self.account.slug, self.account.currency,
+            self.user.username, entry.country, ','.join(entry.tags),
+            entry.notes]
+
+    def read(self, content):
+        rows = list(csv.reader(StringIO(content)))
+        self.assertEqual(rows[0], [h for h, lookup in ENTRY_COLUMNS])
+        return rows[1:]
+
+    def test_iter_csv(self):
+        lines = list(iter_csv(self.book.entry_set.all(), chunk_size=1))
+
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(self.read(''.join(lines)), [
+            self.expected_row(self.second), self.expected_row(self.first)])
+
+    def test_iter_csv_empty(self):
+        lines = list(iter_csv(self.book.entry_set.none()))
+
+        self.assertEqual(self.read(''.join(lines)), [])
+
+    def test_view(self):
+        url = reverse('export-entries', args=[self.book.slug])
+        assert self.client.login(username=self.user.username, password='test')
+
+        response = self.client.get(url, {'year': 2020})
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            response['Content-Disposition'],
+            'attachment; filename="%s.csv"' % self.book.slug)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertEqual(self.read(content), [self.expected_row(self.first)])
+
+    def test_view_other_book(self):
+        book = self.factory.make_book()
+        url = reverse('export-entries', args=[book.slug])
+        assert self.client.login(username=self.user.username, password='test')
+
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_command(self):
+        out = StringIO()
+        call_command(
+            'export_entries', book=self.book.slug, filter='tag=food',
+            stdout=out)
+
+        self.assertEqual(
+            self.read(out.getvalue()), [self.expected_row(self.first)])
+
+    def test_command_output(self):
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        call_command('export_entries', book=self.book.slug, output=path)
+
+        with open(path, newline='') as f:
+            content = f.read()
+        self.assertEqual(self.read(content), [
+            self.expected_row(self.second), self.expected_row(self.first)])
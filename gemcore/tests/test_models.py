@@ -2,12 +2,19 @@
 
 from datetime import date, timedelta
 from decimal import Decimal
+from io import StringIO
 from unittest.mock import patch
 
-from django.db import IntegrityError
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncMonth
+from django.db.models.sql.compiler import SQLCompiler
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import now
 
-from gemcore.models import TAGS, Entry
+from gemcore.models import (
+    TAGS, Account, Book, Entry, MonthTotal, _tag_matchers)
 from gemcore.tests.helpers import BaseTestCase
 
 
@@ -77,6 +84,207 @@ class BookTestCase(BaseTestCase):
         result = self.book.year_breakdown()
         self.assertCountEqual(list(result), expected)
 
+    def make_facet_entries(self):
+        usd = self.factory.make_account(currency='USD')
+        eur = self.factory.make_account(currency='EUR')
+        for i, tag in enumerate(TAGS):
+            self.factory.make_entry(
+                book=self.book, account=usd if i % 2 else eur,
+                who=self.user1 if i % 3 else self.user2,
+                country='UY' if i % 4 else 'AR',
+                when=date(2010 + i % 3, 1 + i % 12, 1), tags=[tag])
+        self.factory.make_entry(
+            book=self.book, account=usd, who=self.user1, tags=TAGS[:3])
+        # entries from other books are never counted
+        self.factory.make_entry(account=usd, who=self.user1, tags=TAGS)
+
+    def assert_facets(self, entries=None):
+        with self.assertNumQueries(1):
+            result = self.book.facets(entries)
+
+        self.assertEqual(result, {
+            'countries': self.book.countries(entries),
+            'currencies': self.book.currencies(entries),
+            'months': self.book.months(entries),
+            'tags': self.book.tags(entries),
+            'who': self.book.who(entries),
+            'years': self.book.years(entries),
+        })
+        self.assertEqual(
+            list(result['tags']), list(self.book.tags(entries)))
+        return result
+
+    def test_facets_empty(self):
+        result = self.assert_facets()
+        self.assertEqual(result, {
+            'countries': {}, 'currencies': {}, 'months': {}, 'tags': {},
+            'who': {}, 'years': {}})
+
+    def test_facets(self):
+        self.make_facet_entries()
+        result = self.assert_facets()
+        self.assertEqual(result['who'], {'user1': 11, 'user2': 6})
+
+    def test_facets_filtered(self):
+        self.make_facet_entries()
+        entries = self.book.entry_set.filter(
+            who__username='user1', account__currency='USD',
+            tags__contains=['car'])
+        result = self.assert_facets(entries)
+        self.assertEqual(result['who'], {'user1': 2})
+
+    def test_facets_none(self):
+        with self.assertNumQueries(0):
+            result = self.book.facets(Entry.objects.none())
+        self.assertEqual(result, {
+            'countries': {}, 'currencies': {}, 'months': {}, 'tags': {},
+            'who': {}, 'years': {}})
+
+    def test_countries_empty(self):
+        with self.assertNumQueries(1):
+            result = self.book.countries()
+        self.assertEqual(result, {})
+
+    def test_countries(self):
+        for i, country in enumerate(('UY', 'AR', 'FR', 'AR', 'UY', 'AR')):
+            self.factory.make_entry(
+                book=self.book, country=country, is_income=bool(i % 2))
+        # entries from other books are never counted
+        self.factory.make_entry(country='AR')
+        self.factory.make_entry(country='BR')
+
+        with self.assertNumQueries(1):
+            result = self.book.countries()
+        self.assertEqual(
+            list(result.items()), [('AR', 3), ('FR', 1), ('UY', 2)])
+
+        result = self.book.countries(Entry.objects.filter(is_income=True))
+        self.assertEqual(list(result.items()), [('AR', 3)])
+
+    def fetch_counting_rows(self, func, *args):
+        rows = []
+        results_iter = SQLCompiler.results_iter
+
+        def counting_results_iter(compiler, *args, **kwargs):
+            for row in results_iter(compiler, *args, **kwargs):
+                rows.append(row)
+                yield row
+
+        with patch.object(SQLCompiler, 'results_iter', counting_results_iter):
+            result = func(*args)
+        return result, len(rows)
+
+    def assert_constant_rows(self, func, make_entry, expected):
+        for i in range(2):
+            make_entry()
+        with self.assertNumQueries(1):
+            result, rows = self.fetch_counting_rows(func)
+        self.assertEqual(result, expected(2))
+        self.assertEqual(rows, len(result))
+
+        for i in range(48):
+            make_entry()
+        with self.assertNumQueries(1):
+            result, rows = self.fetch_counting_rows(func)
+        self.assertEqual(result, expected(50))
+        self.assertEqual(rows, len(result))
+
+    def test_by_text(self):
+        coffee = self.factory.make_entry(
+            book=self.book, what='Starbucks Coffee', notes='with Manolo')
+        market = self.factory.make_entry(
+            book=self.book, what='Supermarket', notes='coffee, milk, coffee')
+        self.factory.make_entry(book=self.book, what='Gas station')
+        self.factory.make_entry(what='Coffee in other book')
+
+        self.assertEqual(list(self.book.by_text('coffee')), [market, coffee])
+        self.assertEqual(list(self.book.by_text('COF')), [market, coffee])
+        self.assertEqual(list(self.book.by_text('star cof')), [coffee])
+        self.assertEqual(list(self.book.by_text('manolo')), [coffee])
+        self.assertEqual(list(self.book.by_text('super')), [market])
+        self.assertEqual(list(self.book.by_text('tea')), [])
+
+    def test_by_text_no_words(self):
+        entry = self.factory.make_entry(book=self.book, what='A + B')
+        self.factory.make_entry(book=self.book, what='A B')
+
+        self.assertEqual(list(self.book.by_text(' + ')), [entry])
+
+    def test_by_text_follows_changes(self):
+        entry = self.factory.make_entry(book=self.book, what='Coffee')
+
+        entry.what = 'Tea'
+        entry.save()
+        self.assertEqual(list(self.book.by_text('coffee')), [])
+        self.assertEqual(list(self.book.by_text('tea')), [entry])
+
+        Entry.objects.filter(id=entry.id).update(notes='Mate')
+        self.assertEqual(list(self.book.by_text('mate')), [entry])
+
+    def test_currencies_empty(self):
+        self.assertEqual(self.book.currencies(), {})
+
+    def test_currencies(self):
+        accounts = [
+            self.factory.make_account(currency=c)
+            for c in ('USD', 'EUR', 'USD')]
+
+        def make_entry():
+            for account in accounts:
+                self.factory.make_entry(book=self.book, account=account)
+
+        self.assert_constant_rows(
+            self.book.currencies, make_entry,
+            lambda i: {'USD': 2 * i, 'EUR': i})
+        entries = Entry.objects.filter(account=accounts[1])
+        self.assertEqual(self.book.currencies(entries), {'EUR': 50})
+
+    def test_who_empty(self):
+        self.assertEqual(self.book.who(), {})
+
+    def test_who(self):
+        def make_entry():
+            self.factory.make_entry(book=self.book, who=self.user1)
+            self.factory.make_entry(book=self.book, who=self.user2)
+            self.factory.make_entry(book=self.book, who=self.user2)
+
+        # entries from other books are not counted
+        self.factory.make_entry(who=self.user1)
+        self.assert_constant_rows(
+            self.book.who, make_entry,
+            lambda i: {'user1': i, 'user2': 2 * i})
+
+    def test_tags_empty(self):
+        with self.assertNumQueries(1):
+            result = self.book.tags()
+        self.assertEqual(result, {})
+
+    def test_tags(self):
+        self.factory.make_entry(book=self.book, tags=['trips', 'car'])
+        self.factory.make_entry(book=self.book, tags=['car', 'car'])
+        self.factory.make_entry(book=self.book, tags=['zzz', 'custom'])
+        self.factory.make_entry(tags=['car', 'food'])
+
+        with self.assertNumQueries(1):
+            result = self.book.tags()
+
+        # tags as ordered in TAGS first, then the unknown ones alphabetically
+        self.assertEqual(
+            list(result.items()),
+            [('car', 2), ('trips', 1), ('custom', 1), ('zzz', 1)])
+
+    def test_tags_filtered(self):
+        for i, tag in enumerate(TAGS):
+            self.factory.make_entry(
+                book=self.book, tags=[tag, 'other'], is_income=bool(i % 2))
+
+        result = self.book.tags(self.book.entry_set.filter(is_income=True))
+
+        self.assertEqual(list(result.items()), [
+            ('car', 1), ('food', 1), ('health', 1), ('maintainance', 1),
+            ('other', 8), ('rent', 1), ('transportation', 1),
+            ('work-ish', 1), ('trips', 1)])
+
     def test_balance_one_account(self, account=None):
         # no entries
         balance = self.book.balance(Entry.objects.none())
@@ -164,6 +372,113 @@ class BookTestCase(BaseTestCase):
         }
         self.assertEqual(balance, expected)
 
+    def test_balance_empty_book(self):
+        with self.assertNumQueries(1):
+            balance = self.book.balance()
+        self.assertIsNone(balance)
+
+    def test_balance_fills_empty_months(self):
+        account = self.factory.make_account()
+        for when, amount, is_income in (
+                (date(2019, 11, 30), Decimal('10'), True),
+                (date(2019, 12, 1), Decimal('3'), False),
+                (date(2020, 3, 15), Decimal('2.5'), False),
+                (date(2020, 3, 16), Decimal('1'), True)):
+            self.factory.make_entry(
+                book=self.book, account=account, when=when, amount=amount,
+                is_income=is_income)
+
+        with self.assertNumQueries(1):
+            balance = self.book.balance(self.book.entry_set.all())
+        self.assertEqual(self.book.balance(), balance)
+
+        def month(start, end, income, expense):
+            return {
+                'start': start, 'end': end, 'income': Decimal(income),
+                'expense': Decimal(expense),
+                'result': Decimal(income) - Decimal(expense)}
+
+        expected = {
+            'complete': {
+                'start': date(2019, 11, 30),
+                'end': date(2020, 3, 16),
+                'income': Decimal('11'),
+                'expense': Decimal('5.5'),
+                'result': Decimal('5.5'),
+            },
+            'months': [
+                month(date(2019, 11, 1), date(2019, 11, 30), '10', '0'),
+                month(date(2019, 12, 1), date(2019, 12, 31), '0', '3'),
+                month(date(2020, 1, 1), date(2020, 1, 31), '0', '0'),
+                month(date(2020, 2, 1), date(2020, 2, 29), '0', '0'),
+                month(date(2020, 3, 1), date(2020, 3, 16), '1', '2.5'),
+            ],
+        }
+        self.assertEqual(balance, expected)
+
+    def test_balance_start_end(self):
+        account = self.factory.make_account()
+        for day in range(1, 29):
+            self.factory.make_entry(
+                book=self.book, account=account, when=date(2020, 2, day),
+                amount=Decimal(day), is_income=bool(day % 2))
+
+        balance = self.book.balance(
+            start=date(2020, 2, 10), end=date(2020, 2, 13))
+
+        expected = {
+            'start': date(2020, 2, 10), 'end': date(2020, 2, 13),
+            'income': Decimal('24'), 'expense': Decimal('22'),
+            'result': Decimal('2'),
+        }
+        self.assertEqual(balance['complete'], expected)
+        self.assertEqual(
+            balance['months'], [dict(expected, start=date(2020, 2, 1))])
+
+    def test_running_balance(self):
+        account = self.factory.make_account()
+        for when, amount, is_income in (
+                (date(2019, 11, 30), Decimal('10'), True),
+                (date(2019, 11, 30), Decimal('1'), False),
+                (date(2019, 12, 1), Decimal('3'), False),
+                (date(2020, 3, 15), Decimal('2.5'), False),
+                (date(2020, 3, 16), Decimal('1'), True)):
+            self.factory.make_entry(
+                book=self.book, account=account, when=when, amount=amount,
+                is_income=is_income)
+        self.factory.make_entry(when=date(2019, 12, 1), amount=Decimal(7))
+
+        def item(start, income, expense, balance):
+            return {
+                'start': start, 'income': Decimal(income),
+                'expense': Decimal(expense),
+                'result': Decimal(income) - Decimal(expense),
+                'balance': Decimal(balance)}
+
+        with self.assertNumQueries(1):
+            result = self.book.running_balance()
+        self.assertEqual(result, [
+            item(date(2019, 11, 1), '10', '1', '9'),
+            item(date(2019, 12, 1), '0', '3', '6'),
+            item(date(2020, 3, 1), '1', '2.5', '4.5'),
+        ])
+
+        result = self.book.running_balance(period='day')
+        self.assertEqual(result, [
+            item(date(2019, 11, 30), '10', '1', '9'),
+            item(date(2019, 12, 1), '0', '3', '6'),
+            item(date(2020, 3, 15), '0', '2.5', '3.5'),
+            item(date(2020, 3, 16), '1', '0', '4.5'),
+        ])
+
+    def test_running_balance_empty(self):
+        self.assertEqual(self.book.running_balance(), [])
+        self.assertEqual(self.book.running_balance(Entry.objects.none()), [])
+
+    def test_running_balance_invalid_period(self):
+        with self.assertRaises(ValueError):
+            self.book.running_balance(period='week')
+
     def assert_merge_entries_value_error(self, *entries, expected_error):
         with self.assertRaises(ValueError) as ctx:
             self.book.merge_entries(*entries)
@@ -350,3 +665,270 @@ class AccountTestCase(BaseTestCase):
         self.assertCountEqual(account.tags_for('foo'), ['food'])
         self.assertCountEqual(account.tags_for('12x'), ['fun', 'house'])
         self.assertCountEqual(account.tags_for('y12x'), [])
+
+    def test_tags_for_with_groups(self):
+        account = self.factory.make_account()
+        other = self.factory.make_account()
+        self.factory.make_tag_regex(
+            regex=r'(\w)\1', tag='house', account=account)
+        self.factory.make_tag_regex(
+            regex=r'(?i)foo', tag='food', account=account, transfer=other)
+        account = Account.objects.get(id=account.id)
+
+        self.assertIsNone(account.tag_matcher().prefilter)
+        self.assertEqual(account.tags_for('aab'), {'house': None})
+        self.assertEqual(account.tags_for('abb'), {})
+        self.assertEqual(account.tags_for('FOO'), {'food': other})
+
+    def test_tags_for_compiled_once(self):
+        account = self.factory.make_account()
+        for i in range(5):
+            self.factory.make_tag_regex(
+                regex='^%s' % i, tag=TAGS[i], account=account)
+        account = Account.objects.get(id=account.id)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(account.tags_for('3x'), {TAGS[3]: None})
+        self.assertIsNotNone(account.tag_matcher().prefilter)
+
+        account = Account.objects.get(id=account.id)
+        with self.assertNumQueries(0):
+            for i in range(100):
+                self.assertEqual(account.tags_for('x'), {})
+                self.assertEqual(account.tags_for('4'), {TAGS[4]: None})
+
+    def test_tags_for_invalidated_on_change(self):
+        account = self.factory.make_account()
+        regex = self.factory.make_tag_regex(
+            regex='foo', tag='food', account=account)
+        self.assertEqual(account.tags_for('foo'), {'food': None})
+
+        regex.tag = 'car'
+        regex.save()
+        self.assertEqual(account.tags_for('foo'), {'car': None})
+
+        self.factory.make_tag_regex(regex='fo', tag='fun', account=account)
+        self.assertEqual(
+            account.tags_for('foo'), {'car': None, 'fun': None})
+
+        regex.delete()
+        self.assertEqual(account.tags_for('foo'), {'fun': None})
+
+    def test_tags_for_invalidated_in_other_process(self):
+        account = self.factory.make_account()
+        self.factory.make_tag_regex(regex='foo', tag='food', account=account)
+        account = Account.objects.get(id=account.id)
+        stale = _tag_matchers[account.id] = (
+            account.tagregex_version, account.tag_matcher())
+
+        self.factory.make_tag_regex(regex='fo', tag='fun', account=account)
+        # another process still holds the previous matcher
+        _tag_matchers[account.id] = stale
+
+        account = Account.objects.get(id=account.id)
+        self.assertEqual(
+            account.tags_for('foo'), {'food': None, 'fun': None})
+
+    def test_save_keeps_tagregex_version(self):
+        account = self.factory.make_account()
+        stale = Account.objects.get(id=account.id)
+        self.factory.make_tag_regex(regex='foo', tag='food', account=account)
+        version = Account.objects.get(id=account.id).tagregex_version
+
+        stale.name = 'Other name'
+        stale.save()
+
+        account = Account.objects.get(id=account.id)
+        self.assertEqual(account.name, 'Other name')
+        self.assertEqual(account.tagregex_version, version)
+        self.assertGreater(version, stale.tagregex_version)
+
+    def test_save_deleted_row(self):
+        account = self.factory.make_account()
+        Account.objects.filter(id=account.id).delete()
+
+        # inserted again, as a plain save does
+        account.save()
+
+        self.assertEqual(Account.objects.get(id=account.id), account)
+
+    def test_save_new_instance_with_pk(self):
+        account = self.factory.make_account()
+        copy = Account(
+            id=account.id, name='Other name', slug=account.slug,
+            currency=account.currency)
+
+        copy.save()
+
+        account = Account.objects.get(id=account.id)
+        self.assertEqual(account.name, 'Other name')
+
+
+class MonthTotalTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(MonthTotalTestCase, self).setUp()
+        self.book = self.factory.make_book()
+        self.account = self.factory.make_account()
+
+    fields = (
+        'book', 'account', 'month', 'is_income', 'entry_count', 'total')
+
+    def assert_totals(self):
+        expected = Entry.objects.annotate(month=TruncMonth('when')).values(
+            'book', 'account', 'month', 'is_income').annotate(
+            entry_count=Count('id'), total=Sum('amount'))
+        totals = MonthTotal.objects.filter(entry_count__gt=0).annotate(
+            total=F('amount'))
+        self.assertEqual(
+            sorted(totals.values_list(*self.fields)),
+            sorted(expected.order_by().values_list(*self.fields)))
+        self.assertFalse(
+            MonthTotal.objects.filter(entry_count=0).exclude(amount=0))
+
+    def make_entries(self):
+        other = self.factory.make_account()
+        for i in range(1, 13):
+            self.factory.make_entry(
+                book=self.book, account=other if i % 3 else self.account,
+                when=date(2020, i, i), amount=Decimal(i), is_income=i > 6)
+            self.factory.make_entry(
+                book=self.book, account=self.account,
+                when=date(2020, 1 + i % 2, 28), amount=Decimal('0.5'))
+
+    def test_create(self):
+        self.make_entries()
+
+        self.assert_totals()
+        total = MonthTotal.objects.get(
+            book=self.book, account=self.account, month=date(2020, 2, 1),
+            is_income=False)
+        self.assertEqual(total.entry_count, 6)
+        self.assertEqual(total.amount, Decimal('3'))
+
+    def test_save_existing(self):
+        self.make_entries()
+        entry = Entry.objects.filter(book=self.book).first()
+
+        entry.amount = Decimal('42.42')
+        entry.when = date(2019, 12, 31)
+        entry.is_income = not entry.is_income
+        entry.account = self.factory.make_account()
+        entry.save()
+
+        self.assert_totals()
+
+    def test_save_other_fields(self):
+        self.make_entries()
+        entry = Entry.objects.filter(book=self.book).first()
+        entry.notes = 'foo'
+
+        # the update plus the book version
+        with self.assertNumQueries(2):
+            entry.save(update_fields=['notes'])
+        self.assert_totals()
+
+    def test_save_totals_unchanged(self):
+        self.make_entries()
+        entry = Entry.objects.filter(book=self.book).first()
+        entry.what = 'Other'
+
+        # the previous totals fields read (locked), the update and the book
+        # version, within a savepoint
+        with self.assertNumQueries(1 + 1 + 1 + 2):
+            entry.save()
+        self.assert_totals()
+
+    def test_delete(self):
+        self.make_entries()
+
+        Entry.objects.filter(book=self.book).first().delete()
+        self.assert_totals()
+
+        Entry.objects.filter(account=self.account, when__month=1).delete()
+        self.assert_totals()
+
+    def test_queryset_delete_queries(self):
+        def delete(count):
+            entries = [
+                self.factory.make_entry(
+                    book=self.book, account=self.account,
+                    when=date(2020, 3, 1), amount=Decimal(i))
+                for i in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                Entry.objects.filter(id__in=[e.id for e in entries]).delete()
+            self.assert_totals()
+            return len(queries)
+
+        # only the entry history is still recorded per entry
+        self.assertEqual(delete(6) - delete(2), 4)
+
+    def test_queryset_update(self):
+        self.make_entries()
+        target = self.factory.make_account()
+
+        Entry.objects.filter(account=self.account).update(account=target)
+        self.assert_totals()
+
+        Entry.objects.filter(amount__lt=3).update(
+            amount=Decimal('3.33'), when=date(2021, 5, 5))
+        self.assert_totals()
+
+    def test_queryset_update_other_fields(self):
+        self.make_entries()
+
+        # the update plus the book version
+        with self.assertNumQueries(2):
+            Entry.objects.filter(account=self.account).update(notes='foo')
+        self.assert_totals()
+
+    def test_merge_entries(self):
+        entries = [
+            self.factory.make_entry(
+                book=self.book, account=self.account, amount=Decimal(i),
+                when=date(2020, i, 1))
+            for i in range(1, 4)]
+
+        self.book.merge_entries(*entries, dry_run=True)
+        self.assert_totals()
+
+        self.book.merge_entries(*entries, when=date(2020, 5, 5))
+        self.assert_totals()
+
+    def test_cascade_delete(self):
+        self.make_entries()
+        Book.objects.filter(id=self.book.id).delete()
+
+        self.assert_totals()
+        self.assertFalse(MonthTotal.objects.exists())
+
+    def test_rebuild(self):
+        self.make_entries()
+        other = self.factory.make_entry(when=date(2020, 1, 1))
+        MonthTotal.objects.all().update(entry_count=0, amount=0)
+
+        MonthTotal.objects.rebuild(books=[self.book])
+        self.assertFalse(MonthTotal.objects.filter(
+            book=self.book, entry_count=0).exists())
+        self.assertTrue(MonthTotal.objects.filter(
+            book=other.book, entry_count=0).exists())
+
+        call_command('rebuild_totals', stdout=StringIO())
+        self.assert_totals()
+
+    def test_totals_balance(self):
+        self.make_entries()
+        accounts = Account.objects.filter(id=self.account.id)
+
+        with self.assertNumQueries(2):
+            result = self.book.totals_balance(accounts=accounts)
+
+        expected = self.book.balance(
+            self.book.entry_set.filter(account__in=accounts))
+        self.assertEqual(result, expected)
+        self.assertEqual(
+            self.book.totals_balance(),
+            self.book.balance(self.book.entry_set.all()))
+
+    def test_totals_balance_empty(self):
+        self.assertIsNone(self.book.totals_balance())
@@ -1,29 +1,63 @@
+import codecs
 import csv
+import os
+import shutil
+import tempfile
+import timeit
 
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from decimal import Decimal
+from io import StringIO
 
-from gemcore.models import Entry
-from gemcore.parser import CSVParser
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db.models import Count, Sum
+from django.test import TransactionTestCase
+from django.utils.timezone import now
+
+from gemcore.management.commands.parse import group_imports
+from gemcore.models import Entry, ImportChunk, ImportJob, MonthTotal
+from gemcore.parser import (
+    CSVParser,
+    Camt053Parser,
+    ChunkedTextFile,
+    DuplicateEntryError,
+    EntryKeys,
+    OFXParser,
+    QIFParser,
+    RowPlan,
+    decode_chunks,
+    get_parser,
+)
+from gemcore.tests.factory import Factory
 from gemcore.tests.helpers import BaseTestCase
 
 
 class CSVParserTestCase(BaseTestCase):
 
+    parse_kwargs = {}
+
     def make_account_with_parser(self, **kwargs):
         parser = self.factory.make_parser_config(**kwargs)
         user = self.factory.make_user()
         account = self.factory.make_account(users=[user], parser_config=parser)
         return account
 
-    def do_parse(self, account, csv_name, book=None):
+    def make_bank1_account(self):
+        user = self.factory.make_user()
+        return self.factory.make_account(
+            users=[user], parser_config=self.make_bank1_parser_config())
+
+    def do_parse(self, account, csv_name, book=None, **kwargs):
         user = account.users.get()
         if book is None:
             book = self.factory.make_book(users=[user])
 
+        kwargs = dict(self.parse_kwargs, **kwargs)
         fname = self.data_file(csv_name)
         with open(fname) as f:
-            result = CSVParser(account).parse(f, book=book, user=user)
+            result = CSVParser(account).parse(
+                f, book=book, user=user, **kwargs)
             f.seek(0)
             reader = csv.reader(f)
             rows = [i for i in reader if filter(bool, i)]
@@ -37,16 +71,17 @@ class CSVParserTestCase(BaseTestCase):
             (errors, len(result['errors']), result['errors']))
         self.assertEqual(len(result['entries']), entries)
         self.assertEqual(Entry.objects.all().count(), entries)
+        totals = MonthTotal.objects.aggregate(
+            count=Sum('entry_count'), amount=Sum('amount'))
+        self.assertEqual(totals, Entry.objects.aggregate(
+            count=Count('id'), amount=Sum('amount')))
 
     def assert_entry_correct(self, **kwargs):
         entries = Entry.objects.filter(**kwargs)
         self.assertEqual(entries.count(), 1)
 
     def test_bank1(self):
-        # Fecha / Hora Mov.,Concepto,Importe,Comentarios,Saldo Parcial
-        account = self.make_account_with_parser(
-            when=[0], what=[1], amount=[2], notes=[3, 4],
-            date_format='%d/%m/%Y', country='FR', ignore_rows=1)
+        account = self.make_bank1_account()
         result, rows = self.do_parse(account, 'bank1.csv')
         self.assert_result(result, errors=0, entries=225)
 
@@ -139,3 +174,837 @@ class CSVParserTestCase(BaseTestCase):
                 account=account, country=account.parser_config.country,
                 when=when, what=what, is_income=is_income, amount=amount)
             last_extra_fee = 0
+
+    def test_iter_parse(self):
+        account = self.make_bank1_account()
+        user = account.users.get()
+        book = self.factory.make_book(users=[user])
+
+        with open(self.data_file('bank1.csv')) as f:
+            rows = CSVParser(account).iter_parse(
+                f, book=book, user=user, **self.parse_kwargs)
+            first = next(rows)
+            # rows are processed as they are consumed
+            self.assertEqual(
+                Entry.objects.count(), self.parse_kwargs.get('batch_size', 1))
+            parsed = [first] + list(rows)
+
+        self.assertEqual(len(parsed), 225)
+        self.assertEqual([p.error for p in parsed], [None] * 225)
+        self.assertEqual(first.line, 2)
+        # 4 empty lines are skipped
+        self.assertEqual(parsed[-1].line, 230)
+        self.assertEqual(first.entry.what, first.data['what'])
+        self.assert_result(
+            dict(entries=[p.entry for p in parsed], errors={}),
+            errors=0, entries=225)
+
+    def test_summary(self):
+        account = self.make_bank1_account()
+        user = account.users.get()
+        book = self.factory.make_book(users=[user])
+        self.do_parse(account, 'bank1.csv', book=book)
+        Entry.objects.order_by('id')[0].delete()
+
+        result, rows = self.do_parse(
+            account, 'bank1.csv', book=book, summary=True)
+
+        self.assertEqual(result, {
+            'entries': 1, 'duplicates': 224, 'errors': {}})
+        self.assertEqual(Entry.objects.count(), 225)
+
+    def test_duplicates(self):
+        account = self.make_bank1_account()
+        user = account.users.get()
+        book = self.factory.make_book(users=[user])
+        self.do_parse(account, 'bank1.csv', book=book)
+        entry = Entry.objects.order_by('id')[100]
+        entry.delete()
+
+        result, rows = self.do_parse(account, 'bank1.csv', book=book)
+
+        self.assertEqual(dict(result['errors']), {})
+        self.assertEqual(len(result['duplicates']), 224)
+        self.assertEqual(len(result['entries']), 1)
+        self.assertEqual(result['entries'][0].what, entry.what)
+        self.assertEqual(Entry.objects.count(), 225)
+        totals = MonthTotal.objects.aggregate(count=Sum('entry_count'))
+        self.assertEqual(totals['count'], 225)
+
+    def test_dry_run(self):
+        account = self.make_bank1_account()
+        book = self.factory.make_book(users=[account.users.get()])
+
+        # user, accounts, tag regexes and 2 ranges of existing entries, no
+        # query (nor savepoint) per row
+        with self.assertNumQueries(1 + 1 + 1 + 2):
+            result, rows = self.do_parse(
+                account, 'bank1.csv', book=book, dry_run=True)
+
+        self.assertEqual(dict(result['errors']), {})
+        self.assertEqual(len(result['entries']), 225)
+        self.assertEqual(result['entries'][0]['what'], rows[1][1].strip())
+        self.assertEqual(Entry.objects.count(), 0)
+        self.assertEqual(MonthTotal.objects.count(), 0)
+
+    def test_dry_run_errors(self):
+        account = self.make_bank1_account()
+        book = self.factory.make_book(users=[self.factory.make_user()])
+
+        dry_run, rows = self.do_parse(
+            account, 'bank1.csv', book=book, dry_run=True)
+        result, rows = self.do_parse(account, 'bank1.csv', book=book)
+
+        self.assertEqual(
+            [(str(e), d) for e, d in dry_run['errors']['ValueError']],
+            [(str(e), d) for e, d in result['errors']['ValueError']])
+        self.assertEqual(len(dry_run['errors']['ValueError']), 225)
+
+    def test_duplicate_rows(self):
+        account = self.make_account_with_parser(
+            when=[0], what=[1], amount=[2], date_format='%d/%m/%Y',
+            country='FR', ignore_rows=0)
+        user = account.users.get()
+        book = self.factory.make_book(users=[user])
+        csv_file = StringIO(
+            '02/01/2020,Bakery,-3.50\n'
+            '02/01/2020,Bakery,-3.5\n'
+            '02/01/2020,Bakery,3.50\n')
+        csv_file.name = 'duplicates.csv'
+
+        parsed = sorted(CSVParser(account).iter_parse(
+            csv_file, book=book, user=user, **self.parse_kwargs))
+
+        self.assertEqual([p.line for p in parsed], [1, 2, 3])
+        self.assertIsNone(parsed[0].error)
+        self.assertIsInstance(parsed[1].error, DuplicateEntryError)
+        self.assertEqual(
+            str(parsed[1].error),
+            'Entry already exists: 2020-01-02 Bakery -3.5')
+        self.assertIsNone(parsed[2].error)
+        self.assertEqual(Entry.objects.count(), 2)
+
+
+class RowPlanTestCase(BaseTestCase):
+
+    def make_plan(self, **kwargs):
+        kwargs.setdefault('when', [0])
+        kwargs.setdefault('what', [1])
+        kwargs.setdefault('amount', [2])
+        return RowPlan(self.factory.make_parser_config(
+            date_format='%d/%m/%Y', country='FR', ignore_rows=0, **kwargs))
+
+    def test_amount(self):
+        plan = self.make_plan(thousands_sep='.', decimal_point=',')
+
+        for value, expected in (
+                ('1.234,56', '1234.56'), ('-1.000', '-1000'), ('', '0'),
+                ('EUR 12,5', '12.5'), ('1.234.567,8 ', '1234567.8')):
+            self.assertEqual(
+                plan.amount(['', '', value]), Decimal(expected), value)
+
+    def test_amount_default_separators(self):
+        plan = self.make_plan()
+
+        self.assertEqual(plan.amount(['', '', '1,234.56']), Decimal('1234.56'))
+        self.assertEqual(plan.amount(['', '', '$-7.5']), Decimal('-7.5'))
+
+    def test_amount_expense_and_income(self):
+        plan = self.make_plan(amount=[2, 3])
+
+        self.assertEqual(plan.amount(['', '', '10', '']), Decimal('-10'))
+        self.assertEqual(plan.amount(['', '', '-10', '']), Decimal('-10'))
+        self.assertEqual(plan.amount(['', '', '', '3.5']), Decimal('3.5'))
+
+    def test_invalid_amount(self):
+        plan = self.make_plan()
+
+        with self.assertRaisesMessage(
+                AssertionError, "Can not convert '1.2.3' to Decimal"):
+            plan.amount(['', '', '1.2.3'])
+
+    def test_what_and_when_fallbacks(self):
+        plan = self.make_plan(when=[0, 1], what=[2, 3], amount=[4])
+        row = ['', '02/03/2020', '  ', ' Groceries ', '1']
+
+        self.assertEqual(plan.when(row), datetime(2020, 3, 2))
+        self.assertEqual(plan.what(row), 'Groceries')
+        with self.assertRaisesMessage(AssertionError, 'When not found'):
+            plan.when(['', '', 'x', 'y', '1'])
+        with self.assertRaisesMessage(AssertionError, 'What not found'):
+            plan.what(['01/01/2020', '', '', '', '1'])
+
+    def test_dates_parsed_once(self):
+        plan = self.make_plan()
+
+        for i in range(100):
+            plan.when(['%02d/01/2020' % (1 + i % 5), 'x', '1'])
+
+        self.assertEqual(plan.parse_date.cache_info().misses, 5)
+        self.assertEqual(plan.parse_date.cache_info().hits, 95)
+
+    def test_row_cost(self):
+        # Micro-benchmark of the per-row work done before any validation,
+        # set GEM_BENCHMARK to get the figures printed.
+        account = self.factory.make_account(
+            parser_config=self.factory.make_parser_config(
+                when=[1, 2], what=[3], amount=[5, 6], notes=[0, 4, 7],
+                date_format='%d/%m/%Y', country='ES', ignore_rows=1,
+                thousands_sep='.', decimal_point=','))
+        user = self.factory.make_user()
+        with open(self.data_file('bank2.csv')) as f:
+            rows = [r for r in list(csv.reader(f))[1:] if r]
+        parser = CSVParser(account)
+        parser.name = 'bank2.csv'
+        parser.make_data(rows[0], user)  # load the tag matcher
+
+        number = 20
+        cost = min(timeit.repeat(
+            lambda: [parser.make_data(r, user) for r in rows],
+            number=number, repeat=3)) / (number * len(rows))
+
+        if os.environ.get('GEM_BENCHMARK'):
+            print('\nCSVParser.make_data: %.1fus per row' % (cost * 1e6))
+        self.assertLess(cost, 0.001, 'Parsing a row takes %ss' % cost)
+
+
+class EntryKeysTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(EntryKeysTestCase, self).setUp()
+        self.book = self.factory.make_book()
+        self.account = self.factory.make_account()
+        self.entries = [
+            self.factory.make_entry(
+                book=self.book, account=self.account, what='Rent',
+                amount=Decimal('500'), when=date(2020, 1, 1) + delta)
+            for delta in (
+                timedelta(days=0), timedelta(days=300),
+                timedelta(days=600))]
+        # other accounts or books are never loaded
+        self.factory.make_entry(
+            book=self.book, what='Rent', amount=Decimal('500'),
+            when=date(2020, 1, 1))
+        self.factory.make_entry(
+            account=self.account, what='Rent', amount=Decimal('500'),
+            when=date(2020, 1, 1))
+
+    def make_key(self, when, **kwargs):
+        data = dict(
+            account=self.account.id, when=when, what='Rent',
+            amount=Decimal('500.0'), is_income=False)
+        data.update(kwargs)
+        return EntryKeys.key(data)
+
+    def test_exists(self):
+        keys = EntryKeys(self.book, self.account)
+
+        for entry in self.entries:
+            self.assertTrue(keys.exists(self.make_key(
+                datetime.combine(entry.when, datetime.min.time()))))
+        self.assertFalse(keys.exists(self.make_key(datetime(2020, 1, 2))))
+        self.assertFalse(keys.exists(
+            self.make_key(datetime(2020, 1, 1), is_income=True)))
+        self.assertFalse(keys.exists(
+            self.make_key(datetime(2020, 1, 1), what='Bakery')))
+        self.assertEqual(len(keys.keys), 3)
+
+    def test_range_loaded_once(self):
+        keys = EntryKeys(self.book, self.account)
+
+        with self.assertNumQueries(1):
+            keys.exists(self.make_key(datetime(2020, 10, 27)))
+            keys.exists(self.make_key(datetime(2020, 1, 1)))
+            keys.exists(self.make_key(datetime(2021, 8, 23)))
+        with self.assertNumQueries(1):
+            keys.exists(self.make_key(datetime(2019, 1, 1)))
+            keys.exists(self.make_key(datetime(2018, 12, 1)))
+        self.assertEqual(len(keys.keys), 3)
+
+    def test_add(self):
+        keys = EntryKeys(self.book, self.account)
+        key = self.make_key(datetime(2020, 1, 2))
+
+        keys.add(key)
+
+        self.assertTrue(keys.exists(key))
+
+
+class FileFormatsTestCase(BaseTestCase):
+
+    expected = [
+        (datetime(2020, 1, 2), Decimal('3.50'), False),
+        (datetime(2020, 1, 15), Decimal('1500'), True),
+        (datetime(2020, 1, 20), Decimal('42.10'), False),
+    ]
+
+    def do_parse(self, file_format, filename, **kwargs):
+        config = self.factory.make_parser_config(
+            file_format=file_format, country='DE', ignore_rows=0, **kwargs)
+        user = self.factory.make_user()
+        account = self.factory.make_account(users=[user], parser_config=config)
+        book = self.factory.make_book(users=[user])
+        with open(self.data_file(filename)) as f:
+            result = get_parser(account).parse(f, book=book, user=user)
+        self.assertEqual(dict(result['errors']), {})
+        return result['entries']
+
+    def assert_entries(self, entries, what):
+        self.assertEqual(
+            [(e.when, e.amount, e.is_income) for e in entries],
+            [(w.date(), a, i) for w, a, i in self.expected])
+        self.assertEqual([e.what for e in entries], what)
+
+    def test_get_parser(self):
+        for file_format, parser_class in (
+                ('csv', CSVParser), ('ofx', OFXParser), ('qif', QIFParser),
+                ('camt.053', Camt053Parser)):
+            account = self.factory.make_account(
+                parser_config=self.factory.make_parser_config(
+                    file_format=file_format, country='DE', ignore_rows=0))
+
+            self.assertIs(type(get_parser(account)), parser_class)
+
+    def test_ofx(self):
+        entries = self.do_parse('ofx', 'bank5.ofx')
+
+        self.assert_entries(
+            entries, ['Bakery & Co', 'ACME Payroll', 'Electricity bill'])
+        self.assertEqual(
+            entries[0].notes.split(' | ')[:2], ['Card 1234', '2020010201'])
+
+    def test_qif(self):
+        entries = self.do_parse(
+            'qif', 'bank6.qif', date_format='%d/%m/%Y')
+
+        self.assert_entries(
+            entries, ['Bakery', 'ACME Payroll', 'Electricity bill'])
+        self.assertTrue(
+            entries[1].notes.startswith('1001 | source: '), entries[1].notes)
+
+    def test_qif_other_sections(self):
+        # account lists, categories and memorized payees are not entries
+        entries = self.do_parse(
+            'qif', 'bank8.qif', date_format='%d/%m/%Y')
+
+        self.assert_entries(
+            entries, ['Bakery', 'ACME Payroll', 'Electricity bill'])
+
+    def test_camt053(self):
+        entries = self.do_parse('camt.053', 'bank7.xml')
+
+        # the pending entry is left out
+        self.assert_entries(
+            entries, ['Bäckerei Müller', 'ACME GmbH', 'Electricity bill'])
+        self.assertEqual(
+            entries[0].notes.split(' | ')[:2], ['Card 1234 Berlin', 'REF-1'])
+
+    def test_rows_read_as_consumed(self):
+        parser = OFXParser(self.factory.make_account(
+            parser_config=self.factory.make_parser_config(
+                file_format='ofx', country='DE', ignore_rows=0)))
+        with open(self.data_file('bank5.ofx')) as f:
+            lines = iter(f)
+            rows = parser.read_rows(lines)
+
+            self.assertEqual(next(rows)[0], 32)
+            # the closing tag is only known when reading the next one
+            self.assertEqual(next(lines), '<TRNTYPE>CREDIT\n')
+
+    def test_csv_columns_required(self):
+        config = self.factory.make_parser_config(
+            file_format='csv', country='DE', ignore_rows=0)
+
+        with self.assertRaises(ValidationError) as cm:
+            config.full_clean()
+        self.assertEqual(
+            sorted(cm.exception.message_dict), ['amount', 'what', 'when'])
+
+        config.file_format = 'ofx'
+        config.full_clean()
+
+    def test_parse_command(self):
+        user = self.factory.make_user()
+        book = self.factory.make_book(users=[user])
+        account = self.factory.make_account(
+            users=[user], parser_config=self.factory.make_parser_config(
+                file_format='camt.053', country='DE', ignore_rows=0))
+
+        out = StringIO()
+        call_command(
+            'parse', '--file', self.data_file('bank7.xml'),
+            '--account', account.slug, '--book', book.slug,
+            '--user', user.username, stdout=out)
+
+        self.assertEqual(Entry.objects.filter(account=account).count(), 3)
+        self.assertIn(
+            'rows/s): 3 entries, 0 duplicates, 0 errors', out.getvalue())
+
+
+class DecodeChunksTestCase(BaseTestCase):
+
+    def chunks(self, data, size=3):
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def decode(self, data, size=3):
+        return ''.join(decode_chunks(self.chunks(data, size)))
+
+    def test_utf8(self):
+        text = 'Dépôt,1\nCafé,2\n'
+
+        self.assertEqual(self.decode(text.encode('utf-8')), text)
+        self.assertEqual(
+            self.decode(codecs.BOM_UTF8 + text.encode('utf-8')), text)
+
+    def test_utf16(self):
+        text = 'Dépôt,1\nCafé,2\n'
+
+        self.assertEqual(self.decode(text.encode('utf-16'), size=64), text)
+        self.assertEqual(self.decode(text.encode('utf-16'), size=5), text)
+
+    def test_single_byte_encodings(self):
+        self.assertEqual(
+            self.decode('Dépôt €5\n'.encode('cp1252'), size=64),
+            'Dépôt €5\n')
+        self.assertEqual(self.decode(b'\x81\xe9\n', size=64), '\x81é\n')
+
+    def test_newlines(self):
+        self.assertEqual(self.decode(b'a\r\nb\rc\nd', size=2), 'a\nb\nc\nd')
+
+    def test_bom_split(self):
+        text = 'Dépôt,1\n'
+
+        self.assertEqual(
+            self.decode(codecs.BOM_UTF8 + text.encode('utf-8'), size=1), text)
+
+    def test_ascii_head(self):
+        # the encoding is detected once non ASCII bytes show up
+        data = b'a,1\n' * 100 + 'Dépôt,2\n'.encode('cp1252')
+
+        self.assertEqual(self.decode(data, size=64), data.decode('cp1252'))
+        self.assertEqual(
+            self.decode(b'a,1\n' + codecs.BOM_UTF16_LE + b'\n', size=4),
+            'a,1\nÿþ\n')
+
+    def test_utf8_lead_byte_at_end_of_chunk(self):
+        # 'é' in cp1252 could start a UTF-8 sequence, the next chunk tells
+        text = 'a' * 99 + 'é' + 'b' * 100
+        data = text.encode('cp1252')
+
+        for size in (1, 3, 64, 100):
+            self.assertEqual(self.decode(data, size=size), text)
+
+    def test_utf8_lead_byte_at_end_of_file(self):
+        text = 'a' * 100 + 'é'
+        data = text.encode('cp1252')
+
+        for size in (1, 3, 64, 100, 101):
+            self.assertEqual(self.decode(data, size=size), text)
+        self.assertEqual(self.decode(text.encode('utf-8'), size=101), text)
+
+    def test_mixed_encodings(self):
+        data = 'é,1\n'.encode('utf-8') + b'a' * 64 + 'é,2\n'.encode('cp1252')
+
+        with self.assertRaises(UnicodeDecodeError):
+            self.decode(data, size=16)
+
+    def test_lazy(self):
+        chunks = iter(self.chunks('a,1\nb,2\n'.encode('utf-8'), size=4))
+
+        lines = iter(ChunkedTextFile(decode_chunks(chunks)))
+
+        self.assertEqual(next(lines), 'a,1\n')
+        self.assertEqual(list(chunks), [b'b,2\n'])
+
+    def test_lines(self):
+        lines = ChunkedTextFile(['a,"multi', '\nline",1\nb', ',2\n', 'c,3'])
+
+        self.assertEqual(
+            list(lines), ['a,"multi\n', 'line",1\n', 'b,2\n', 'c,3'])
+        self.assertEqual(
+            list(csv.reader(lines)),
+            [['a', 'multi\nline', '1'], ['b', '2'], ['c', '3']])
+
+    def test_parse(self):
+        user = self.factory.make_user()
+        account = self.factory.make_account(
+            users=[user], parser_config=self.factory.make_parser_config(
+                when=[1, 2], what=[3], amount=[5, 6], notes=[0, 4, 7],
+                date_format='%d/%m/%Y', country='ES', ignore_rows=1,
+                thousands_sep='.', decimal_point=','))
+        book = self.factory.make_book(users=[user])
+        with open(self.data_file('bank2.csv'), 'rb') as f:
+            data = f.read()
+        csv_file = ChunkedTextFile(
+            decode_chunks(self.chunks(data, 100)), name='bank2.csv')
+
+        result = CSVParser(account).parse(csv_file, book=book, user=user)
+
+        self.assertEqual(dict(result['errors']), {})
+        self.assertEqual(len(result['entries']), 78)
+
+
+class BulkCSVParserTestCase(CSVParserTestCase):
+
+    parse_kwargs = {'bulk': True, 'batch_size': 50}
+
+    def test_batched_queries(self):
+        account = self.make_bank1_account()
+        user = account.users.get()
+        book = self.factory.make_book(users=[user])
+
+        # user, accounts, tag regexes, 2 ranges of existing entries and 5
+        # batches of (insert + totals + book version)
+        with self.assertNumQueries(3 + 2 + 5 * 5):
+            result, rows = self.do_parse(account, 'bank1.csv', book=book)
+
+        self.assert_result(result, errors=0, entries=225)
+
+    def test_duplicates_not_inserted(self):
+        account = self.make_bank1_account()
+        user = account.users.get()
+        book = self.factory.make_book(users=[user])
+        self.do_parse(account, 'bank1.csv', book=book)
+
+        # user, accounts and 2 ranges of existing entries (the tag matcher
+        # was cached by the first parse)
+        with self.assertNumQueries(2 + 2):
+            result, rows = self.do_parse(account, 'bank1.csv', book=book)
+
+        self.assertEqual(len(result['duplicates']), 225)
+        self.assertEqual(Entry.objects.count(), 225)
+
+    def test_integrity_errors_reported(self):
+        account = self.make_bank1_account()
+        user = account.users.get()
+        other = self.factory.make_account(users=[user])
+        self.factory.make_tag_regex(
+            account=account, regex='.*', tag='imported', transfer=other)
+        book = self.factory.make_book(users=[user])
+        self.do_parse(account, 'bank1.csv', book=book)
+        # the transfers still exist, only known when inserting
+        entry = Entry.objects.filter(account=account).order_by('id')[100]
+        entry.delete()
+
+        result, rows = self.do_parse(account, 'bank1.csv', book=book)
+
+        self.assertEqual(list(result['errors']), ['IntegrityError'])
+        self.assertEqual(len(result['errors']['IntegrityError']), 1)
+        self.assertEqual(len(result['duplicates']), 224)
+        self.assertEqual(result['entries'], [])
+        self.assertEqual(Entry.objects.count(), 2 * 225 - 1)
+        totals = MonthTotal.objects.aggregate(count=Sum('entry_count'))
+        self.assertEqual(totals['count'], 2 * 225 - 1)
+
+    def test_transfers(self):
+        account = self.make_bank1_account()
+        user = account.users.get()
+        other = self.factory.make_account(users=[user])
+        self.factory.make_tag_regex(
+            account=account, regex='.*', tag='imported', transfer=other)
+        book = self.factory.make_book(users=[user])
+
+        result, rows = self.do_parse(account, 'bank1.csv', book=book)
+
+        self.assertEqual(len(result['errors']), 0)
+        self.assertEqual(len(result['entries']), 225)
+        self.assertEqual(Entry.objects.filter(account=account).count(), 225)
+        self.assertEqual(Entry.objects.filter(account=other).count(), 225)
+        self.assertEqual(
+            MonthTotal.objects.filter(account=other).aggregate(
+                count=Sum('entry_count'))['count'], 225)
+
+    def test_validation_errors_as_entry_form(self):
+        account = self.make_bank1_account()
+        book = self.factory.make_book(users=[self.factory.make_user()])
+
+        bulk, rows = self.do_parse(account, 'bank1.csv', book=book)
+        single, rows = self.do_parse(
+            account, 'bank1.csv', book=book, bulk=False)
+
+        self.assertEqual(list(bulk['errors']), ['ValueError'])
+        self.assertEqual(
+            [(str(e), d) for e, d in bulk['errors']['ValueError']],
+            [(str(e), d) for e, d in single['errors']['ValueError']])
+        self.assertIn(
+            'account: Select a valid choice.',
+            str(bulk['errors']['ValueError'][0][0]))
+        self.assertEqual(Entry.objects.count(), 0)
+
+
+class ParseCommandTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(ParseCommandTestCase, self).setUp()
+        parser = self.make_bank1_parser_config()
+        self.user = self.factory.make_user()
+        self.account = self.factory.make_account(
+            users=[self.user], parser_config=parser)
+
+    def do_parse(self, book, *args):
+        out = StringIO()
+        call_command(
+            'parse', '--file', self.data_file('bank1.csv'),
+            '--account', self.account.slug, '--book', book.slug,
+            '--user', self.user.username, *args, stdout=out)
+        return out.getvalue().splitlines()
+
+    def test_progress(self):
+        book = self.factory.make_book(users=[self.user])
+
+        lines = self.do_parse(book, '--bulk', '--progress-every', '0')
+
+        self.assertEqual(Entry.objects.count(), 225)
+        self.assertEqual(len(lines), 1 + 225 + 1)
+        self.assertTrue(
+            lines[1].startswith('1 rows in '), lines[1])
+        self.assertTrue(
+            lines[-1].startswith('225 rows in '), lines[-1])
+        self.assertTrue(
+            lines[-1].endswith('rows/s): 225 entries, 0 duplicates, 0 errors'),
+            lines[-1])
+
+    def test_duplicates(self):
+        book = self.factory.make_book(users=[self.user])
+        self.do_parse(book)
+
+        lines = self.do_parse(book, '--dry-run')
+
+        self.assertEqual(Entry.objects.count(), 225)
+        self.assertTrue(lines[1].startswith('=== DUPLICATE: Entry already '))
+        self.assertTrue(lines[1].endswith(' (line 2) ==='), lines[1])
+        self.assertTrue(
+            lines[-1].endswith(
+                'rows/s): 0 entries, 225 duplicates, 0 errors'),
+            lines[-1])
+
+    def test_errors(self):
+        book = self.factory.make_book(users=[self.factory.make_user()])
+
+        lines = self.do_parse(book)
+
+        self.assertEqual(Entry.objects.count(), 0)
+        self.assertEqual(lines[1], '=== ERROR: ValueError (line 2) ===')
+        self.assertIn('account: Select a valid choice.', lines[2])
+        self.assertTrue(
+            lines[-1].endswith(
+                'rows/s): 0 entries, 0 duplicates, 225 errors '
+                '(225 ValueError)'),
+            lines[-1])
+
+    def test_many_files(self):
+        book = self.factory.make_book(users=[self.user])
+        other = self.factory.make_account(
+            users=[self.user], parser_config=self.account.parser_config)
+
+        lines = self.do_parse(
+            book, '--import', other.slug, self.data_file('bank[1].csv'))
+
+        self.assertEqual(Entry.objects.filter(account=other).count(), 225)
+        self.assertEqual(
+            Entry.objects.filter(account=self.account).count(), 225)
+        self.assertEqual(lines[-2], 'Total for 2 files:')
+        self.assertIn(
+            'rows/s): 450 entries, 0 duplicates, 0 errors', lines[-1])
+
+    def test_no_matching_files(self):
+        book = self.factory.make_book(users=[self.user])
+
+        with self.assertRaisesMessage(CommandError, 'No file matches'):
+            self.do_parse(book, '--file', self.data_file('nope*.csv'))
+
+    def test_group_imports(self):
+        accounts = [self.factory.make_account() for i in range(5)]
+        self.factory.make_tag_regex(
+            regex='foo', tag='food', account=accounts[0],
+            transfer=accounts[2])
+        self.factory.make_tag_regex(
+            regex='foo', tag='food', account=accounts[3],
+            transfer=accounts[2])
+        imports = [(a, 'file%s.csv' % i) for i, a in enumerate(accounts)]
+        imports.append((accounts[1], 'other.csv'))
+
+        groups = group_imports(imports)
+
+        self.assertEqual(groups, [
+            [imports[0], imports[2], imports[3]],
+            [imports[1], imports[5]],
+            [imports[4]],
+        ])
+
+
+class RunImportsCommandTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(RunImportsCommandTestCase, self).setUp()
+        self.user = self.factory.make_user()
+        self.book = self.factory.make_book(users=[self.user])
+        self.account = self.factory.make_account(
+            users=[self.user],
+            parser_config=self.make_bank1_parser_config())
+        with open(self.data_file('bank1.csv')) as f:
+            self.content = f.read()
+
+    def make_job(self, content=None, **kwargs):
+        if content is None:
+            content = self.content
+        kwargs.setdefault('account', self.account)
+        job = ImportJob.objects.create(
+            book=self.book, who=self.user, name='bank1.csv', **kwargs)
+        job.add_content(
+            content[i:i + 1000] for i in range(0, len(content), 1000))
+        return job
+
+    def run_imports(self):
+        out = StringIO()
+        call_command('run_imports', '--once', stdout=out)
+        return out.getvalue().splitlines()
+
+    def test_claim(self):
+        first = self.make_job()
+        second = self.make_job()
+        done = self.make_job(status=ImportJob.DONE)
+
+        self.assertEqual(ImportJob.objects.claim(), first)
+        self.assertEqual(ImportJob.objects.claim(), second)
+        self.assertIsNone(ImportJob.objects.claim())
+        first.refresh_from_db()
+        self.assertEqual(first.status, ImportJob.RUNNING)
+        self.assertIsNotNone(first.started)
+        done.refresh_from_db()
+        self.assertIsNone(done.started)
+
+    def test_fail_stale(self):
+        stale = self.make_job(
+            status=ImportJob.RUNNING, started=now() - timedelta(hours=2),
+            updated=now() - timedelta(hours=2))
+        # a long import still making progress
+        running = self.make_job(
+            status=ImportJob.RUNNING, started=now() - timedelta(hours=2),
+            updated=now() - timedelta(minutes=5))
+
+        lines = self.run_imports()
+
+        self.assertEqual(lines, ['Marked 1 stale imports as failed.'])
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, ImportJob.FAILED)
+        self.assertTrue(stale.is_finished)
+        self.assertIn('made no progress', stale.failure)
+        self.assertFalse(stale.importchunk_set.exists())
+        running.refresh_from_db()
+        self.assertEqual(running.status, ImportJob.RUNNING)
+        self.assertTrue(running.importchunk_set.exists())
+
+    def test_run(self):
+        first = self.make_job()
+        second = self.make_job()
+
+        lines = self.run_imports()
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(Entry.objects.count(), 225)
+        self.assertEqual(
+            (first.status, first.rows, first.entries, first.duplicates),
+            (ImportJob.DONE, 225, 225, 0))
+        self.assertEqual(
+            (second.status, second.rows, second.entries, second.duplicates),
+            (ImportJob.DONE, 225, 0, 225))
+        self.assertEqual(first.errors, {})
+        self.assertEqual(ImportChunk.objects.count(), 0)
+        self.assertIsNotNone(first.finished)
+        self.assertGreater(first.updated, first.started)
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(
+            lines[-1].endswith(
+                's: 225 rows, 0 entries, 225 duplicates, 0 errors'),
+            lines[-1])
+
+    def test_errors(self):
+        job = self.make_job(
+            account=self.factory.make_account(
+                parser_config=self.account.parser_config))
+
+        self.run_imports()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.DONE)
+        self.assertEqual((job.rows, job.entries), (225, 0))
+        self.assertEqual(job.errors, {'ValueError': 225})
+        self.assertEqual(len(job.messages), ImportJob.MAX_MESSAGES)
+        self.assertTrue(
+            job.messages[0].startswith('Line 2: ValueError: account: '),
+            job.messages[0])
+
+    def test_failure(self):
+        job = self.make_job(content='Fecha,Concepto,Importe\n' + self.content)
+
+        self.run_imports()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertIn('Can not convert', job.failure)
+        self.assertEqual(ImportChunk.objects.count(), 0)
+        self.assertEqual(Entry.objects.count(), 0)
+
+
+class ParallelParseCommandTestCase(TransactionTestCase):
+    """Workers use their own connections, data has to be committed."""
+
+    factory = Factory()
+    make_bank1_parser_config = BaseTestCase.make_bank1_parser_config
+
+    def setUp(self):
+        super(ParallelParseCommandTestCase, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        data = os.path.join(os.path.dirname(__file__), 'data')
+        for name in ('a.csv', 'b.csv', 'c.csv'):
+            shutil.copy(
+                os.path.join(data, 'bank1.csv'), os.path.join(self.tmp, name))
+        shutil.copy(
+            os.path.join(data, 'bank2.csv'), os.path.join(self.tmp, 'd.csv'))
+
+    def test_jobs(self):
+        user = self.factory.make_user()
+        book = self.factory.make_book(users=[user])
+        config1 = self.make_bank1_parser_config()
+        config2 = self.factory.make_parser_config(
+            when=[1, 2], what=[3], amount=[5, 6], notes=[0, 4, 7],
+            date_format='%d/%m/%Y', country='ES', ignore_rows=1,
+            thousands_sep='.', decimal_point=',')
+        account1 = self.factory.make_account(
+            users=[user], parser_config=config1)
+        account2 = self.factory.make_account(
+            users=[user], parser_config=config2)
+        account3 = self.factory.make_account(
+            users=[user], parser_config=config1)
+
+        out = StringIO()
+        call_command(
+            'parse', '--jobs', '3', '--bulk', '--book', book.slug,
+            '--user', user.username,
+            '--import', account1.slug, os.path.join(self.tmp, '[ab].csv'),
+            '--import', account2.slug, os.path.join(self.tmp, 'd.csv'),
+            '--import', account3.slug, os.path.join(self.tmp, 'c.csv'),
+            stdout=out)
+        lines = out.getvalue().splitlines()
+
+        self.assertEqual(Entry.objects.filter(account=account1).count(), 225)
+        self.assertEqual(Entry.objects.filter(account=account2).count(), 78)
+        self.assertEqual(Entry.objects.filter(account=account3).count(), 225)
+        totals = MonthTotal.objects.aggregate(count=Sum('entry_count'))
+        self.assertEqual(totals['count'], 225 * 2 + 78)
+
+        # the duplicates are always reported for the second file
+        reports = dict(zip(lines[0:-2:2], lines[1:-2:2]))
+        self.assertEqual(len(reports), 4)
+        a = 'Parsed %s for %s' % (os.path.join(self.tmp, 'a.csv'), account1)
+        b = 'Parsed %s for %s' % (os.path.join(self.tmp, 'b.csv'), account1)
+        self.assertIn(
+            'rows/s): 225 entries, 0 duplicates, 0 errors', reports[a])
+        self.assertIn(
+            'rows/s): 0 entries, 225 duplicates, 0 errors', reports[b])
+        self.assertEqual(lines[-2], 'Total for 4 files:')
+        self.assertIn(
+            'rows/s): 528 entries, 225 duplicates, 0 errors', lines[-1])
@@ -0,0 +1,137 @@
+from django.db import connection
+from django.test import RequestFactory
+
+from gemcore.models import TAGS, Entry
+from gemcore.tests.helpers import BaseTestCase
+from gemcore.views import parse_request
+
+
+class ParseRequestQueryPlanTestCase(BaseTestCase):
+    """The main parse_request queries must not scan the whole entry table."""
+
+    books = 100
+    entries_per_book = 500
+
+    @classmethod
+    def setUpTestData(cls):
+        super(ParseRequestQueryPlanTestCase, cls).setUpTestData()
+        cls.user = cls.factory.make_user()
+        cls.accounts = [cls.factory.make_account() for i in range(20)]
+        cls.book = cls.factory.make_book(users=[cls.user])
+        for i in range(cls.books - 1):
+            cls.factory.make_book()
+
+        # 'trips' is kept as a rare tag, for the tags index to be useful
+        tags = [t for t in TAGS if t != 'trips']
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO gemcore_entry (book_id, who_id, "when", what, '
+                'account_id, amount, is_income, tags, country, notes) '
+                "SELECT book.id, %s, DATE '2000-01-01' + (i %% 7000), "
+                "'entry ' || i, (%s::int[])[1 + i %% 20], i %% 1000, "
+                'i %% 5 = 0, ARRAY[(%s::text[])[1 + i %% 15]], '
+                "(ARRAY['AR', 'UY', 'FR'])[1 + i %% 3], '' "
+                'FROM gemcore_book AS book, generate_series(1, %s) AS i',
+                [cls.user.id, [a.id for a in cls.accounts], tags,
+                 cls.entries_per_book])
+            cursor.execute(
+                "UPDATE gemcore_entry SET tags = tags || '{trips}' "
+                'WHERE id % 997 = 0')
+            cursor.execute('ANALYZE gemcore_entry')
+
+    def setUp(self):
+        super(ParseRequestQueryPlanTestCase, self).setUp()
+        assert Entry.objects.count() == self.books * self.entries_per_book
+
+    def plan_nodes(self, plan):
+        yield plan
+        for subplan in plan.get('Plans', []):
+            yield from self.plan_nodes(subplan)
+
+    def assert_no_seq_scan(self, entries, index_fields=None):
+        sql, params = entries.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            nodes = list(self.plan_nodes(cursor.fetchone()[0][0]['Plan']))
+
+        scanned = [
+            n['Relation Name'] for n in nodes if n['Node Type'] == 'Seq Scan']
+        self.assertNotIn('gemcore_entry', scanned, entries.explain())
+        if index_fields is not None:
+            # any index led by the given fields, unique_together ones too
+            columns = [Entry._meta.get_field(f).column for f in index_fields]
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(
+                    cursor, Entry._meta.db_table)
+            indexes = {
+                name for name, c in constraints.items()
+                if (c['index'] or c['unique']) and
+                c['columns'][:len(columns)] == columns}
+            used = {n.get('Index Name') for n in nodes}
+            self.assertTrue(indexes & used, entries.explain())
+
+    def assert_parse_request_no_seq_scan(
+            self, order_by=None, index_fields=None, **params):
+        request = RequestFactory().get('/', params)
+        entries, filters, available = parse_request(request, self.book)
+        if order_by:
+            entries = entries.order_by(*order_by)[:25]
+        self.assert_no_seq_scan(entries, index_fields=index_fields)
+
+    def test_book(self):
+        self.assert_parse_request_no_seq_scan()
+
+    def test_book_entries_page(self):
+        self.assert_parse_request_no_seq_scan(
+            order_by=('-when', 'what', 'id'), index_fields=['book', 'when'])
+
+    def test_when(self):
+        self.assert_parse_request_no_seq_scan(
+            when='2005-05-05', index_fields=['book', 'when'])
+
+    def test_year(self):
+        self.assert_parse_request_no_seq_scan(
+            year='2005', index_fields=['book', 'when'])
+
+    def test_start_end(self):
+        self.assert_parse_request_no_seq_scan(
+            start='2005-01-01', end='2005-03-31',
+            index_fields=['book', 'when'])
+
+    def test_account(self):
+        self.assert_parse_request_no_seq_scan(account=self.accounts[3].slug)
+
+    def test_account_start_end(self):
+        self.assert_parse_request_no_seq_scan(
+            account=self.accounts[3].slug, start='2005-01-01',
+            end='2005-03-31')
+
+    def test_currency(self):
+        self.assert_parse_request_no_seq_scan(currency='USD')
+
+    def test_country(self):
+        self.assert_parse_request_no_seq_scan(country='UY')
+
+    def test_who(self):
+        self.assert_parse_request_no_seq_scan(who=self.user.username)
+
+    def test_tag(self):
+        self.assert_parse_request_no_seq_scan(tag='food')
+
+    def test_include_tag(self):
+        self.assert_parse_request_no_seq_scan(include_tag=['food', 'car'])
+
+    def test_tags_contains(self):
+        self.assert_no_seq_scan(
+            Entry.objects.filter(tags__contains=['trips']),
+            index_fields=['tags'])
+
+    def test_tags_contained_by(self):
+        self.assert_no_seq_scan(
+            Entry.objects.filter(tags__contained_by=['trips']),
+            index_fields=['tags'])
+
+    def test_account_balance(self):
+        # either the book index or the unique (book, account, ...) one
+        self.assert_no_seq_scan(self.book.entry_set.filter(
+            account__in=self.accounts[:2]).order_by().values('when'))
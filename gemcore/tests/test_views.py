@@ -1,7 +1,17 @@
+import codecs
 
+from datetime import date
+from decimal import Decimal
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
+from gemcore.models import Entry, ImportJob
 from gemcore.tests.helpers import BaseTestCase
+from gemcore.views import ENTRIES_PER_PAGE, IMPORT_JOB_REFRESH
 
 
 class BalanceViewTestCase(BaseTestCase):
@@ -31,6 +41,413 @@ class BalanceViewTestCase(BaseTestCase):
         self.assertContains(response, 'Balances for %s' % book.name)
 
 
+class RunningBalanceViewTestCase(BaseTestCase):
+
+    def do_request(self, user, book, account, **kwargs):
+        url = reverse('running-balance', args=[book.slug, account.slug])
+        assert self.client.login(username=user.username, password='test')
+        return self.client.get(url, kwargs)
+
+    def test_get(self):
+        user = self.factory.make_user()
+        book = self.factory.make_book(users=[user])
+        account = self.factory.make_account(users=[user])
+        self.factory.make_entry(
+            book=book, account=account, amount=Decimal('3.5'),
+            when=date(2020, 1, 15))
+        self.factory.make_entry(
+            book=book, account=account, amount=Decimal('10'),
+            when=date(2020, 2, 15), is_income=True)
+
+        response = self.do_request(user, book, account)
+
+        self.assertContains(response, 'Running balance for %s' % account)
+        self.assertEqual(response.context['period'], 'month')
+        self.assertEqual(
+            [i['balance'] for i in response.context['balance']],
+            [Decimal('-3.5'), Decimal('6.5')])
+
+    def test_monthly_balance_link(self):
+        user = self.factory.make_user()
+        book = self.factory.make_book(users=[user])
+        account = self.factory.make_account(users=[user])
+        self.factory.make_entry(book=book, account=account)
+        url = reverse(
+            'balance',
+            kwargs=dict(book_slug=book.slug, account_slug=account.slug))
+
+        response = self.do_request(user, book, account)
+        self.assertContains(response, 'href="%s"' % url)
+        response = self.client.get(url)
+
+        self.assertContains(response, 'Balances for %s' % book.name)
+
+    def test_get_by_day(self):
+        user = self.factory.make_user()
+        book = self.factory.make_book(users=[user])
+        account = self.factory.make_account(users=[user])
+        self.factory.make_entry(book=book, account=account)
+
+        response = self.do_request(user, book, account, by='day')
+
+        self.assertEqual(response.context['period'], 'day')
+        self.assertEqual(len(response.context['balance']), 1)
+
+    def test_get_account_not_in_book(self):
+        user = self.factory.make_user()
+        book = self.factory.make_book(users=[user])
+        account = self.factory.make_account()
+
+        response = self.do_request(user, book, account)
+
+        self.assertEqual(response.status_code, 404)
+
+
+class EntriesPaginationTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(EntriesPaginationTestCase, self).setUp()
+        self.user = self.factory.make_user()
+        self.book = self.factory.make_book(users=[self.user])
+        # plenty of ties on when and what, for the id to break them
+        for i in range(ENTRIES_PER_PAGE * 3 + 5):
+            self.factory.make_entry(
+                book=self.book, when=date(2020, 1, 1 + i % 4),
+                what='Entry %s' % (i % 3))
+        self.expected = list(
+            self.book.entry_set.order_by('-when', 'what', 'id'))
+
+    def do_request(self, **kwargs):
+        url = reverse('entries', args=[self.book.slug])
+        assert self.client.login(username=self.user.username, password='test')
+        return self.client.get(url, kwargs)
+
+    def test_first_page(self):
+        response = self.do_request()
+
+        entries = response.context['entries']
+        self.assertTrue(response.context['keyset'])
+        self.assertEqual(list(entries), self.expected[:ENTRIES_PER_PAGE])
+        self.assertFalse(entries.has_previous)
+        self.assertTrue(entries.has_next)
+        self.assertContains(response, 'after=%s' % entries.next_cursor)
+        self.assertNotContains(response, 'before=')
+
+    def test_walk_forward_and_back(self):
+        pages = []
+        entries = self.do_request().context['entries']
+        pages.append(list(entries))
+        while entries.has_next:
+            entries = self.do_request(
+                after=entries.next_cursor).context['entries']
+            pages.append(list(entries))
+
+        self.assertEqual(len(pages), 4)
+        self.assertEqual(sum(pages, []), self.expected)
+
+        back = [list(entries)]
+        while entries.has_previous:
+            entries = self.do_request(
+                before=entries.previous_cursor).context['entries']
+            back.append(list(entries))
+
+        self.assertEqual(back, pages[::-1])
+
+    def test_no_count_nor_offset(self):
+        entries = self.do_request().context['entries']
+        for i in range(2):
+            with CaptureQueriesContext(connection) as first:
+                self.do_request()
+            with CaptureQueriesContext(connection) as deep:
+                self.do_request(after=entries.next_cursor)
+
+        self.assertEqual(len(first), len(deep))
+        entry_queries = [
+            q['sql'] for q in deep.captured_queries
+            if 'FROM "gemcore_entry"' in q['sql']]
+        self.assertNotEqual(entry_queries, [])
+        for sql in entry_queries:
+            self.assertNotIn('OFFSET', sql)
+            self.assertNotIn('__count', sql)
+
+    def test_invalid_cursor(self):
+        for cursor in ('foo', 'W10', 'WyIyMDIwIiwiYSIsMV0', '!!!'):
+            response = self.do_request(after=cursor)
+
+            self.assertEqual(
+                list(response.context['entries']),
+                self.expected[:ENTRIES_PER_PAGE])
+
+    def test_filters_reset_cursor(self):
+        entries = self.do_request().context['entries']
+
+        response = self.do_request(after=entries.next_cursor)
+
+        self.assertContains(response, 'year=2020')
+        self.assertNotContains(response, 'year=2020&amp;after=')
+        self.assertNotContains(response, 'after=%s&amp;year=2020')
+
+    def test_page_parameter(self):
+        response = self.do_request(page=2)
+
+        self.assertNotIn('keyset', response.context)
+        self.assertEqual(
+            list(response.context['entries']),
+            self.expected[ENTRIES_PER_PAGE:ENTRIES_PER_PAGE * 2])
+
+
+class LoadFromFileTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(LoadFromFileTestCase, self).setUp()
+        self.user = self.factory.make_user()
+        self.book = self.factory.make_book(users=[self.user])
+        self.account = self.factory.make_account(
+            users=[self.user],
+            parser_config=self.factory.make_parser_config(
+                when=[0], what=[1], amount=[2], date_format='%d/%m/%Y',
+                country='FR', ignore_rows=0))
+        assert self.client.login(username=self.user.username, password='test')
+
+    def do_post(self, **data):
+        url = reverse('load-from-file', args=[self.book.slug])
+        return self.client.post(url, dict(data, account=self.account.id))
+
+    def test_post_content_queues_job(self):
+        response = self.do_post(csv_content='02/01/2020,Bakery,-3.50\n')
+
+        job = ImportJob.objects.get()
+        self.assertRedirects(
+            response, reverse('import-job', args=[self.book.slug, job.id]))
+        self.assertEqual(job.status, ImportJob.QUEUED)
+        self.assertEqual(job.book, self.book)
+        self.assertEqual(job.account, self.account)
+        self.assertEqual(job.who, self.user)
+        self.assertEqual(
+            list(job.iter_content()), ['02/01/2020,Bakery,-3.50'])
+        self.assertEqual(Entry.objects.count(), 0)
+
+    # stored in a temporary file, read in many chunks
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_post_file_queues_job(self):
+        content = 'Dépôt,02/01/2020\r\n' * 10000
+        csv_file = SimpleUploadedFile(
+            'bank.csv', codecs.BOM_UTF8 + content.encode('utf-8'))
+
+        self.do_post(csv_file=csv_file)
+
+        job = ImportJob.objects.get()
+        self.assertEqual(job.name, 'bank.csv')
+        chunks = list(job.iter_content())
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), content.replace('\r\n', '\n'))
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_post_file_late_non_ascii(self):
+        content = 'a' * 2 ** 17 + 'Dépôt'
+        csv_file = SimpleUploadedFile('bank.csv', content.encode('cp1252'))
+
+        self.do_post(csv_file=csv_file)
+
+        job = ImportJob.objects.get()
+        self.assertEqual(''.join(job.iter_content()), content)
+
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_post_file_not_decoded(self):
+        csv_file = SimpleUploadedFile(
+            'bank.csv', 'Dépôt'.encode('utf-8') + b'a' * 2 ** 17 +
+            'Dépôt'.encode('cp1252'))
+
+        response = self.do_post(csv_file=csv_file)
+
+        self.assertContains(response, 'The file could not be decoded')
+        self.assertEqual(ImportJob.objects.count(), 0)
+
+    def test_job_page(self):
+        job = ImportJob.objects.create(
+            book=self.book, account=self.account, who=self.user,
+            name='bank.csv', rows=10, entries=7, duplicates=2,
+            errors={'ValueError': 1}, messages=['Line 3: ValueError: Oops'])
+        url = reverse('import-job', args=[self.book.slug, job.id])
+
+        response = self.client.get(url)
+
+        self.assertContains(
+            response, '<meta http-equiv="refresh" content="%s">' %
+            IMPORT_JOB_REFRESH)
+        self.assertContains(response, 'Waiting to be imported')
+        self.assertContains(response, 'Line 3: ValueError: Oops')
+
+        job.status = ImportJob.DONE
+        job.save()
+        response = self.client.get(url)
+
+        self.assertNotContains(response, 'http-equiv="refresh"')
+        self.assertContains(response, 'Import finished.')
+
+    def test_job_of_other_book(self):
+        job = ImportJob.objects.create(
+            book=self.factory.make_book(users=[self.user]),
+            account=self.account, who=self.user)
+        url = reverse('import-job', args=[self.book.slug, job.id])
+
+        response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 404)
+
+
+class ConditionalGetTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(ConditionalGetTestCase, self).setUp()
+        self.user = self.factory.make_user()
+        self.book = self.factory.make_book(users=[self.user])
+        self.account = self.factory.make_account(users=[self.user])
+        self.factory.make_entry(book=self.book, account=self.account)
+        assert self.client.login(username=self.user.username, password='test')
+        # The ETag depends on the CSRF cookie, since the pages embed the
+        # token: get it set as a browser would on its first visit.
+        self.client.get(reverse('entries', args=[self.book.slug]))
+
+    def assert_not_modified(self, url, **kwargs):
+        response = self.client.get(url, kwargs)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        with CaptureQueriesContext(connection) as queries:
+            again = self.client.get(
+                url, kwargs, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+        # no entry is read, parse_request is not even called
+        self.assertFalse(
+            [q for q in queries if 'gemcore_entry' in q['sql']])
+        return response
+
+    def test_entries(self):
+        self.assert_not_modified(reverse('entries', args=[self.book.slug]))
+
+    def test_balance(self):
+        self.assert_not_modified(
+            reverse('balance', kwargs=dict(
+                book_slug=self.book.slug, account_slug=self.account.slug)))
+
+    def test_books(self):
+        self.assert_not_modified(reverse('books'))
+
+    def test_if_modified_since(self):
+        url = reverse('entries', args=[self.book.slug])
+        response = self.client.get(url)
+
+        again = self.client.get(
+            url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+
+        self.assertEqual(again.status_code, 304)
+
+    def test_modified_by_entry_change(self):
+        url = reverse('entries', args=[self.book.slug])
+        response = self.assert_not_modified(url)
+
+        self.factory.make_entry(book=self.book, account=self.account)
+        again = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+        self.assertEqual(again.status_code, 200)
+        self.assertNotEqual(again['ETag'], response['ETag'])
+
+    def test_etag_per_query_string(self):
+        url = reverse('entries', args=[self.book.slug])
+        response = self.assert_not_modified(url, year=2020)
+
+        again = self.client.get(
+            url, {'year': 2021}, HTTP_IF_NONE_MATCH=response['ETag'])
+
+        self.assertEqual(again.status_code, 200)
+
+    def test_etag_per_user(self):
+        url = reverse('entries', args=[self.book.slug])
+        response = self.assert_not_modified(url)
+
+        other = self.factory.make_user()
+        self.book.users.add(other)
+        response = self.client.get(url)
+        assert self.client.login(username=other.username, password='test')
+        again = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+
+        self.assertEqual(again.status_code, 200)
+
+    def test_pending_messages_rendered(self):
+        url = reverse('entries', args=[self.book.slug])
+        etag = self.assert_not_modified(url)['ETag']
+
+        # no entry selected, an error message is shown after the redirect
+        response = self.client.post(url, {'change-account': 1})
+        self.assertEqual(response.status_code, 302)
+        again = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(again.status_code, 200)
+        self.assertContains(again, 'no entries selected')
+
+
+class EntriesQueryBudgetTestCase(BaseTestCase):
+    """The entries list and bulk actions run a fixed amount of queries."""
+
+    # the bulk actions post every entry id, and Django takes no more than
+    # DATA_UPLOAD_MAX_NUMBER_FIELDS fields per request
+    sizes = (25, 250, 900)
+
+    def make_book(self, size):
+        users = [self.factory.make_user() for i in range(2)]
+        book = self.factory.make_book(users=users)
+        accounts = [
+            self.factory.make_account(users=users[:1 + i % 2])
+            for i in range(3)]
+        Entry.objects.bulk_create(
+            Entry(book=book, who=users[i % 2], account=accounts[i % 3],
+                  when=date(2020, 1, 1 + i % 28), what='Entry %s' % i,
+                  amount=Decimal(i), country='AR', notes='Notes %s' % i,
+                  tags=['food'])
+            for i in range(size))
+        assert self.client.login(username=users[0].username, password='test')
+        return book
+
+    def assert_budget(self, expected, request):
+        """Check request(book) runs the expected queries for any book size."""
+        for size in self.sizes:
+            book = self.make_book(size)
+            with self.subTest(size=size), self.assertNumQueries(expected):
+                response = request(book)
+            self.assertIn(response.status_code, (200, 302))
+
+    def post_selected(self, book, data):
+        """Post data with every entry of book selected (1 query)."""
+        url = reverse('entries', args=[book.slug])
+        data['entry'] = list(book.entry_set.values_list('id', flat=True))
+        return self.client.post(url, data)
+
+    def test_list(self):
+        self.assert_budget(11, lambda book: self.client.get(
+            reverse('entries', args=[book.slug])))
+
+    def test_list_numbered_page(self):
+        self.assert_budget(12, lambda book: self.client.get(
+            reverse('entries', args=[book.slug]), {'page': 2}))
+
+    def test_remove_selected(self):
+        self.assert_budget(1 + 7, lambda book: self.post_selected(
+            book, {'remove-selected': 1}))
+
+    def test_change_account(self):
+        def request(book):
+            account = book.entry_set.first().account_id
+            return self.post_selected(
+                book, {'change-account': 1, 'target': account})
+
+        # the target account and the selection are read first
+        self.assert_budget(1 + 1 + 14, request)
+
+    def test_books(self):
+        self.assert_budget(7, lambda book: self.client.get(reverse('books')))
+
+
 class MultipleRemoveTestCase(BaseTestCase):
 
     remove_btn = (
@@ -1,5 +1,6 @@
 from django.urls import path
 
+import gemcore.api
 import gemcore.views
 
 
@@ -10,11 +11,15 @@ urlpatterns = [
     path('<slug:book_slug>/', gemcore.views.book, name='book'),
     path('<slug:book_slug>/fromfile/', gemcore.views.load_from_file,
          name='load-from-file'),
+    path('<slug:book_slug>/fromfile/<int:job_id>/', gemcore.views.import_job,
+         name='import-job'),
     path('<slug:book_slug>/transfer/', gemcore.views.account_transfer,
          name='account-transfer'),
     # entries
     path('<slug:book_slug>/entry/',
          gemcore.views.entries, name='entries'),
+    path('<slug:book_slug>/entry/export.csv',
+         gemcore.views.entries_export, name='export-entries'),
     path('<slug:book_slug>/entry/add/',
          gemcore.views.entry, name='add-entry'),
     path('<slug:book_slug>/entry/<int:entry_id>/',
@@ -31,4 +36,15 @@ urlpatterns = [
          gemcore.views.balance, name='balance'),
     path('<slug:book_slug>/balance/currency/<str:currency>/',
          gemcore.views.balance, name='balance'),
+    path('<slug:book_slug>/balance/<slug:account_slug>/running/',
+         gemcore.views.running_balance, name='running-balance'),
+    # read-only JSON API
+    path('api/<slug:book_slug>/entries/',
+         gemcore.api.entries, name='api-entries'),
+    path('api/<slug:book_slug>/balance/',
+         gemcore.api.balance, name='api-balance'),
+    path('api/<slug:book_slug>/breakdown/month/',
+         gemcore.api.month_breakdown, name='api-month-breakdown'),
+    path('api/<slug:book_slug>/breakdown/year/',
+         gemcore.api.year_breakdown, name='api-year-breakdown'),
 ]
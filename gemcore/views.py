@@ -1,19 +1,29 @@
+import hashlib
+
 from datetime import datetime, timedelta
-from io import StringIO, TextIOWrapper
 from urllib.parse import urlencode
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
-from django.http import Http404, HttpResponseRedirect
+from django.db import transaction
+from django.http import (
+    Http404,
+    HttpResponseRedirect,
+    StreamingHttpResponse,
+)
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.views.decorators.http import (
+    condition,
     require_GET,
     require_POST,
     require_http_methods,
 )
 
+from gemcore.cache import book_cache
+from gemcore.export import iter_csv
 from gemcore.forms import (
     AccountBalanceForm,
     AccountTransferForm,
@@ -24,12 +34,21 @@ from gemcore.forms import (
     EntryForm,
     EntryMergeForm,
 )
-from gemcore.models import Account, Book, Entry
-from gemcore.parser import CSVParser
+from gemcore.models import (
+    RUNNING_BALANCE_PERIODS,
+    Account,
+    Book,
+    Entry,
+    ImportJob,
+)
+from gemcore.pagination import InvalidCursor, KeysetPage
+from gemcore.parser import decode_chunks
 
 
 ENTRIES_PER_PAGE = 25
 MAX_PAGES = 4
+# Seconds between reloads of the page of an import job, until finished.
+IMPORT_JOB_REFRESH = 2
 
 
 @require_GET
@@ -43,8 +62,54 @@ def home(request):
     return HttpResponseRedirect(url)
 
 
+def book_states(request, book_slug=None):
+    """Return the (id, version, modified) of the books for the request.
+
+    These are the books of the request user, or the one with book_slug
+    among them, read once per request.
+
+    """
+    key = book_slug or ''
+    cached = getattr(request, '_book_states', {})
+    if key not in cached:
+        books = request.user.book_set.all()
+        if book_slug:
+            books = books.filter(slug=book_slug)
+        cached[key] = list(
+            books.order_by('id').values_list('id', 'version', 'modified'))
+        request._book_states = cached
+    return cached[key]
+
+
+def book_etag(request, book_slug=None, **kwargs):
+    # Pending messages are shown by the page, so it has to be rendered.
+    if request.method not in ('GET', 'HEAD') or messages.get_messages(
+            request):
+        return None
+    states = book_states(request, book_slug)
+    if book_slug and not states:
+        return None
+    value = '%s|%s|%s|%s' % (
+        states, request.user.id,
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME),
+        request.META.get('QUERY_STRING', ''))
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+
+def book_last_modified(request, book_slug=None, **kwargs):
+    if book_etag(request, book_slug, **kwargs) is None:
+        return None
+    return max((m for i, v, m in book_states(request, book_slug)),
+               default=None)
+
+
+book_condition = condition(
+    etag_func=book_etag, last_modified_func=book_last_modified)
+
+
 @require_GET
 @login_required
+@book_condition
 def books(request):
     books = request.user.book_set.all()
     context = dict(books=books)
@@ -68,8 +133,8 @@ def book(request, book_slug=None):
     return render(request, 'gemcore/book.html', dict(form=form, book=book))
 
 
-def parse_request(request, book, **kwargs):
-    params = request.GET
+def filter_entries(params, book, **kwargs):
+    """Return the book entries matching the query params, and the filters."""
     q = params.get('q')
     if q:
         entries = book.by_text(q)
@@ -119,15 +184,15 @@ def parse_request(request, book, **kwargs):
     if used_tags:
         entries = entries.filter(tags__contains=used_tags)
 
-    include_tags = request.GET.getlist('include_tag')
+    include_tags = params.getlist('include_tag')
     if include_tags:
         entries = entries.filter(tags__contained_by=include_tags)
 
-    exclude_tags = request.GET.getlist('exclude_tag')
+    exclude_tags = params.getlist('exclude_tag')
     if exclude_tags:
         entries = entries.exclude(tags__contained_by=exclude_tags)
 
-    start = request.GET.get('start')
+    start = params.get('start')
     if start:
         try:
             start = datetime.strptime(start, '%Y-%m-%d').date()
@@ -136,7 +201,7 @@ def parse_request(request, book, **kwargs):
         else:
             entries = entries.filter(when__gte=start)
 
-    end = request.GET.get('end')
+    end = params.get('end')
     if end:
         try:
             end = datetime.strptime(end, '%Y-%m-%d').date()
@@ -164,20 +229,83 @@ def parse_request(request, book, **kwargs):
         'who': who,
         'year': year,
     }
+    return entries, filters
+
+
+def parse_request(request, book, **kwargs):
+    entries, filters = filter_entries(request.GET, book, **kwargs)
+    params = dict(filters, **kwargs)
+    del params['qs']
+    facets = book_cache.get_or_set(
+        book, 'facets', params, lambda: book.facets(entries))
     available = {
-        'countries': sorted(book.countries(entries).items()),
-        'currencies': sorted(book.currencies(entries).items()),
+        'countries': sorted(facets['countries'].items()),
+        'currencies': sorted(facets['currencies'].items()),
         'months': [(d.strftime('%b').lower(), i)
-                   for d, i in sorted(book.months(entries).items())],
-        'tags': sorted(book.tags(entries).items()),
-        'users': sorted(book.who(entries).items()),
-        'years': sorted(book.years(entries).items()),
+                   for d, i in sorted(facets['months'].items())],
+        'tags': sorted(facets['tags'].items()),
+        'users': sorted(facets['who'].items()),
+        'years': sorted(facets['years'].items()),
     }
     return entries, filters, available
 
 
+def keyset_page(request, entries):
+    """Seek the page of entries following (or preceding) the given cursor."""
+    after = request.GET.get('after') or None
+    before = request.GET.get('before') or None
+    try:
+        entries = KeysetPage(
+            entries, ENTRIES_PER_PAGE, after=after, before=before)
+    except InvalidCursor:
+        # If the cursor is garbage, deliver first page.
+        entries = KeysetPage(entries, ENTRIES_PER_PAGE)
+    return {'entries': entries, 'keyset': True}
+
+
+def offset_page(request, entries):
+    """Numbered pages, kept for the links using the page parameter."""
+    entries = entries.order_by(*KeysetPage.ordering)
+    paginator = Paginator(entries, ENTRIES_PER_PAGE)
+    page = request.GET.get('page')
+    try:
+        entries = paginator.page(page)
+    except PageNotAnInteger:
+        # If page is not an integer, deliver first page.
+        page = 1
+        entries = paginator.page(page)
+    except EmptyPage:
+        # If page is out of range (e.g. 9999), deliver last page of results.
+        page = paginator.num_pages
+        entries = paginator.page(paginator.num_pages)
+    else:
+        page = int(page)
+
+    if paginator.num_pages <= MAX_PAGES:
+        start = 1
+        end = paginator.num_pages
+    else:
+        half = MAX_PAGES // 2
+        start = page - half
+        end = page + half
+        if start < 1 and end - start < paginator.num_pages:
+            end = end - start + 1
+            start = 1
+        if end > paginator.num_pages and start > 1:
+            start = start - (end - paginator.num_pages)
+            end = paginator.num_pages
+
+    return {
+        'entries': entries,
+        'page_end': end,
+        'page_range': range(start, end + 1),
+        'page_start': start,
+    }
+
+
 @require_http_methods(['GET', 'POST'])
 @login_required
+@book_condition
 def entries(request, book_slug):
     book = get_object_or_404(Book, slug=book_slug, users=request.user)
     entries, filters, available = parse_request(request, book)
@@ -192,7 +320,7 @@ def entries(request, book_slug):
             messages.error(request, 'Invalid request, no entries selected.')
             return HttpResponseRedirect(here)
 
-        entries = entries.filter(id__in=ids)
+        entries = entries.filter(id__in=ids).for_display()
         if entries.count() != len(ids):
             messages.error(
                 request, 'Invalid request, invalid choices for entries.')
@@ -206,9 +334,9 @@ def entries(request, book_slug):
                         request, 'Invalid request, target account is empty.')
                 else:
                     entries.update(account=target)
-                    msg = (', '.join(str(e) for e in entries), target)
                     messages.success(
-                        request, 'Entries "%s" changed to account %s.' % msg)
+                        request, '%s entries changed to account %s.' % (
+                            len(ids), target))
             else:
                 messages.error(
                     request, 'Invalid request for changing the account: %s' %
@@ -246,36 +374,11 @@ def entries(request, book_slug):
         return render(request, template, context)
 
     # Process GET.
-    entries = entries.order_by('-when', 'what', 'id')
-
-    paginator = Paginator(entries, ENTRIES_PER_PAGE)
-    page = request.GET.get('page')
-    try:
-        entries = paginator.page(page)
-    except PageNotAnInteger:
-        # If page is not an integer, deliver first page.
-        page = 1
-        entries = paginator.page(page)
-    except EmptyPage:
-        # If page is out of range (e.g. 9999), deliver last page of results.
-        page = paginator.num_pages
-        entries = paginator.page(paginator.num_pages)
+    entries = entries.for_display().defer('notes')
+    if 'page' in request.GET:
+        page_context = offset_page(request, entries)
     else:
-        page = int(page)
-
-    if paginator.num_pages <= MAX_PAGES:
-        start = 1
-        end = paginator.num_pages
-    else:
-        half = MAX_PAGES // 2
-        start = page - half
-        end = page + half
-        if start < 1 and end - start < paginator.num_pages:
-            end = end - start + 1
-            start = 1
-        if end > paginator.num_pages and start > 1:
-            start = start - (end - paginator.num_pages)
-            end = paginator.num_pages
+        page_context = keyset_page(request, entries)
 
     when = filters['when']
     if when:
@@ -289,19 +392,28 @@ def entries(request, book_slug):
         'book': book,
         'filters': filters,
         'available': available,
-        'entries': entries,
         'when_next': when_next,
         'when_prev': when_prev,
-        'page_end': end,
-        'page_range': range(start, end + 1),
-        'page_start': start,
         'edit_account_form': ChooseForm(queryset=accounts),
         'account_balance_form': AccountBalanceForm(queryset=accounts),
         'currency_balance_form': CurrencyBalanceForm(choices=currencies),
     }
+    context.update(page_context)
     return render(request, 'gemcore/entries.html', context)
 
 
+@require_GET
+@login_required
+def entries_export(request, book_slug):
+    book = get_object_or_404(Book, slug=book_slug, users=request.user)
+    entries, filters = filter_entries(request.GET, book)
+    response = StreamingHttpResponse(
+        iter_csv(entries), content_type='text/csv; charset=utf-8')
+    response['Content-Disposition'] = (
+        'attachment; filename="%s.csv"' % book.slug)
+    return response
+
+
 @require_http_methods(['GET', 'POST'])
 @login_required
 def entry(request, book_slug, entry_id=None):
@@ -366,7 +478,8 @@ def entry(request, book_slug, entry_id=None):
 @login_required
 def entry_remove(request, book_slug, entry_id=None):
     book = get_object_or_404(Book, slug=book_slug, users=request.user)
-    entries, filters, available = parse_request(request, book)
+    entries, filters = filter_entries(request.GET, book)
+    entries = entries.for_display()
     if request.method == 'GET':
         entries = entries.filter(id=entry_id)
     elif request.method == 'POST':
@@ -396,8 +509,9 @@ def entry_remove(request, book_slug, entry_id=None):
 def entry_merge(request, book_slug):
     assert request.method == 'POST'
     book = get_object_or_404(Book, slug=book_slug, users=request.user)
-    entries, filters, available = parse_request(
-        request, book, id__in=request.POST.getlist('entry'))
+    entries, filters = filter_entries(
+        request.GET, book, id__in=request.POST.getlist('entry'))
+    entries = entries.for_display()
 
     if not entries:
         raise Http404()
@@ -431,19 +545,6 @@ def load_from_file(request, book_slug):
         form = CSVExpenseForm(
             book=book, data=request.POST, files=request.FILES)
         if form.is_valid():
-            csv_file = form.cleaned_data.get('csv_file')
-            if csv_file:
-                # Hack around: "iterator should return strings, not bytes
-                # (did you open the file in text mode?)"
-                csv_file.readable = lambda: True
-                csv_file.writable = lambda: False
-                csv_file = TextIOWrapper(csv_file, encoding='utf-8')
-                # end hack
-            else:
-                csv_content = form.cleaned_data.get('csv_content')
-                csv_file = StringIO(csv_content)
-                csv_file.name = ''
-
             account = form.cleaned_data['account']
             if account.parser_config is None:
                 messages.error(
@@ -451,32 +552,27 @@ def load_from_file(request, book_slug):
                     'Parser config for account %s is not set.' % account)
                 return HttpResponseRedirect('.')
 
-            result = CSVParser(account).parse(
-                csv_file, book=book, user=request.user)
-            success = len([e for e in result['entries'] if e])
-            errors = [
-                '%s %s' % (len(v), k) for k, v in result['errors'].items()]
-            if not errors:
-                messages.success(
-                    request, 'File %s successfully parsed (%s entries added).'
-                    % (csv_file.name, success))
-            elif success:
-                messages.warning(
-                    request,
-                    'File %s partially parsed (%s successes, %s errors).' %
-                    (csv_file.name, success, errors))
+            csv_file = form.cleaned_data.get('csv_file')
+            if csv_file:
+                name = csv_file.name
+                content = decode_chunks(csv_file.chunks())
             else:
-                messages.error(
-                    request, 'File %s could not be parsed (%s).' %
-                    (csv_file.name, ', '.join(errors)))
-
-            if errors:
-                for e, errors in result['errors'].items():
-                    error_msg = ', '.join(str(i) for i in errors)
-                    messages.error(request, '%s: %s' % (e, error_msg))
+                name = ''
+                content = [form.cleaned_data.get('csv_content')]
 
-            return HttpResponseRedirect(
-                reverse('entries', kwargs=dict(book_slug=book_slug)))
+            # Imported by the run_imports command, see the job page.
+            try:
+                with transaction.atomic():
+                    job = ImportJob.objects.create(
+                        book=book, account=account, who=request.user,
+                        name=name)
+                    job.add_content(content)
+            except UnicodeDecodeError as e:
+                form.add_error(
+                    'csv_file', 'The file could not be decoded (%s).' % e)
+            else:
+                return HttpResponseRedirect(
+                    reverse('import-job', args=(book_slug, job.id)))
     else:
         form = CSVExpenseForm(book=book)
 
@@ -484,6 +580,18 @@ def load_from_file(request, book_slug):
     return render(request, 'gemcore/load.html', context)
 
 
+@require_GET
+@login_required
+def import_job(request, book_slug, job_id):
+    book = get_object_or_404(Book, slug=book_slug, users=request.user)
+    job = get_object_or_404(
+        ImportJob.objects.select_related('account'), id=job_id, book=book)
+    context = dict(
+        book=book, job=job,
+        refresh=None if job.is_finished else IMPORT_JOB_REFRESH)
+    return render(request, 'gemcore/import-job.html', context)
+
+
 @require_http_methods(['GET', 'POST'])
 @login_required
 def account_transfer(request, book_slug):
@@ -528,6 +636,7 @@ def account_transfer(request, book_slug):
 
 @require_http_methods(['GET', 'POST'])
 @login_required
+@book_condition
 def balance(
         request, book_slug, account_slug=None, currency=None,
         start=None, end=None):
@@ -575,7 +684,16 @@ def balance(
     if chosen_accounts:
         entries, filters, available = parse_request(
             request, book, account__in=chosen_accounts)
-        balance = book.balance(entries)
+        params = dict(filters, accounts=chosen_accounts)
+        del params['qs']
+        if request.GET:
+            balance = book_cache.get_or_set(
+                book, 'balance', params, lambda: book.balance(entries))
+        else:
+            # no filtering other than the accounts, use the month totals
+            balance = book_cache.get_or_set(
+                book, 'totals_balance', params,
+                lambda: book.totals_balance(accounts=chosen_accounts))
 
     account_balance_form = AccountBalanceForm(
         queryset=accounts,
@@ -594,3 +712,25 @@ def balance(
         'available': available,
     }
     return render(request, 'gemcore/balance.html', context)
+
+
+@require_GET
+@login_required
+def running_balance(request, book_slug, account_slug):
+    book = get_object_or_404(Book, slug=book_slug, users=request.user)
+    account = get_object_or_404(
+        Account.objects.by_book(book), slug=account_slug)
+    period = request.GET.get('by')
+    if period not in RUNNING_BALANCE_PERIODS:
+        period = 'month'
+
+    entries, filters = filter_entries(request.GET, book, account=account)
+    context = {
+        'account': account,
+        'balance': book.running_balance(entries, period=period),
+        'book': book,
+        'filters': filters,
+        'period': period,
+        'periods': RUNNING_BALANCE_PERIODS,
+    }
+    return render(request, 'gemcore/running-balance.html', context)